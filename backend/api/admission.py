@@ -0,0 +1,142 @@
+# admission.py
+import os
+import math
+import time
+import threading
+
+# Shed /publish load when the estimated queue wait would outlast the message TTL:
+# such jobs would only expire into the dead-letter exchange after the user has waited
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "true").lower() in ("1", "true", "yes")
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", 300))  # seconds, the queue's x-message-ttl
+ADMISSION_REFRESH = float(os.getenv("ADMISSION_REFRESH", 2))  # seconds between queue depth / throughput reads
+ADMISSION_JOB_SECONDS = float(os.getenv("ADMISSION_JOB_SECONDS", 3))  # assumed per-consumer job time until measured
+# With no consumer attached (warmup, rolling restart) the queue buffers jobs until one is; admit as many
+# as a single consumer could drain within the TTL by default, so they do not all expire unprocessed
+ADMISSION_NO_CONSUMER_DEPTH = int(os.getenv(
+    "ADMISSION_NO_CONSUMER_DEPTH", int(ADMISSION_MAX_WAIT / ADMISSION_JOB_SECONDS)
+))
+NO_CONSUMER_RETRY_AFTER = 10
+
+# Finished jobs are counted in Redis per THROUGHPUT_BUCKET-second bucket (by the API or the worker,
+# whichever records the completion); throughput is averaged over the last THROUGHPUT_WINDOW full buckets
+THROUGHPUT_KEY_PREFIX = "jobs_done:"
+THROUGHPUT_BUCKET = 10
+THROUGHPUT_WINDOW = 6
+THROUGHPUT_MIN_SAMPLES = 5
+
+
+def completion_bucket_key(now=None):
+    return f"{THROUGHPUT_KEY_PREFIX}{int((now or time.time()) // THROUGHPUT_BUCKET)}"
+
+
+def throughput_keys(now=None):
+    """Keys of the last THROUGHPUT_WINDOW complete buckets (the current one is still filling)."""
+    current = int((now or time.time()) // THROUGHPUT_BUCKET)
+    return [f"{THROUGHPUT_KEY_PREFIX}{bucket}" for bucket in range(current - THROUGHPUT_WINDOW, current)]
+
+
+def record_completions(pipe, count=1):
+    """Queue the throughput counter update on an existing Redis pipeline."""
+    key = completion_bucket_key()
+    pipe.incrby(key, count)
+    pipe.expire(key, THROUGHPUT_BUCKET * (THROUGHPUT_WINDOW + 2))
+
+
+def estimate_throughput(counts, consumers, saturated):
+    """
+    Jobs per second the workers can sustain. Completions only measure capacity
+    while a backlog kept every consumer busy for the whole window (saturated);
+    otherwise they measure demand, so the consumer-based estimate is a floor.
+    """
+    assumed = consumers / ADMISSION_JOB_SECONDS
+    finished = sum(int(count or 0) for count in counts)
+    if finished < THROUGHPUT_MIN_SAMPLES:
+        return assumed
+    measured = finished / (THROUGHPUT_BUCKET * THROUGHPUT_WINDOW)
+    return measured if saturated else max(measured, assumed)
+
+
+class AdmissionState:
+    """
+    Per-process snapshot of the job queue depth and worker throughput.
+    One request refreshes it every ADMISSION_REFRESH seconds (the caller does
+    the I/O, sync or async); every other request decides from the cached
+    values. Jobs that get past the session lock are added to the cached depth
+    (admitted()) until the next refresh.
+    If a refresh fails, requests are admitted (fail open) until one succeeds.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.consumers = 0
+        self.throughput = 0.0
+        self.known = False
+        self._backlog_since = None
+        self._updated = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def needs_refresh(self):
+        """True for exactly one caller once the snapshot is stale; that caller must update() or refresh_failed()."""
+        with self._lock:
+            if self._refreshing or time.monotonic() - self._updated < ADMISSION_REFRESH:
+                return False
+            self._refreshing = True
+            return True
+
+    def update(self, depth, consumers, counts):
+        """Store a fresh reading: ready messages, consumer count and the throughput bucket counts."""
+        now = time.monotonic()
+        with self._lock:
+            if depth == 0:
+                self._backlog_since = None
+            elif self._backlog_since is None:
+                self._backlog_since = now
+            saturated = self._backlog_since is not None and now - self._backlog_since >= THROUGHPUT_BUCKET * THROUGHPUT_WINDOW
+            self.depth, self.consumers = depth, consumers
+            self.throughput = estimate_throughput(counts, consumers, saturated)
+            self.known = True
+            self._updated = now
+            self._refreshing = False
+
+    def refresh_failed(self):
+        with self._lock:
+            self.known = False
+            self._updated = time.monotonic()
+            self._refreshing = False
+
+    def decide(self):
+        """
+        Returns (admit, eta_seconds, retry_after_seconds).
+        eta is the estimated time until a job admitted now has been processed.
+        Call admitted() once the job is actually going to be enqueued.
+        """
+        if not ADMISSION_CONTROL:
+            return True, None, None
+        with self._lock:
+            if not self.known:
+                return True, None, None
+            if self.throughput <= 0:
+                # No consumers and no recent completions: the queue buffers until a worker attaches
+                if self.depth < ADMISSION_NO_CONSUMER_DEPTH:
+                    return True, None, None
+                return False, None, NO_CONSUMER_RETRY_AFTER
+
+            eta = (self.depth + 1) / self.throughput
+            if eta > ADMISSION_MAX_WAIT:
+                retry_after = min(max(math.ceil(eta - ADMISSION_MAX_WAIT), 1), math.ceil(ADMISSION_MAX_WAIT))
+                return False, eta, retry_after
+            return True, eta, None
+
+    def admitted(self):
+        """Count a job that passed decide() and the session lock into the cached depth."""
+        with self._lock:
+            self.depth += 1
+
+
+def busy_body(eta, retry_after):
+    """JSON body of a 503 from /publish."""
+    body = {"error": "Server busy, please retry later", "retryAfter": retry_after}
+    if eta is not None:
+        body["etaSeconds"] = round(eta, 1)
+    return body
@@ -0,0 +1,558 @@
+# asgi.py
+"""
+Async serving mode: `uvicorn asgi:app`.
+
+The upload, status and result-file routes (/health, /publish, /publish_batch,
+/publish_video, /status/*, /results/*) are served natively on the event loop with non-blocking Redis,
+MongoDB and RabbitMQ clients, and uploads are streamed to disk. Every other
+route (internal worker endpoints, OAuth) is delegated to the Flask app from
+server.py, so routes and response shapes are identical in both modes.
+"""
+import os
+import json
+import time
+import uuid
+import shutil
+from contextlib import asynccontextmanager
+
+import aio_pika
+import redis.asyncio as aioredis
+from a2wsgi import WSGIMiddleware
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import OperationFailure
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, StreamingResponse, FileResponse, Response
+from werkzeug.security import safe_join
+from starlette.routing import Route, Mount
+
+from server import (
+    app as flask_app, STATUS_STREAM_TIMEOUT, STATUS_WAIT_MAX, STATUS_HEARTBEAT, STATUS_RETRY_AFTER,
+    RESULTS_DIR, RESULT_CACHE_CONTROL, MAX_BATCH_TARGETS, MAX_FACE_SWAPS, result_etag
+)
+from helpers import (
+    RABBITMQ_URL, QUEUE_NAME, QUEUE_ARGS, REDIS_URL, STATUS_CACHE_TTL, TERMINAL_STATUSES,
+    SESSION_LOCK_TTL, MESSAGE_TTL_MS, status_channel, status_cache_key, status_payload, parse_face_map,
+    session_lock_key, busy_response, ingest_uploads, new_job, job_message, publish_failed_update, accepted_body
+)
+from db import (
+    MONGO_URI, MONGO_DB, BATCH_JOB_PREFIX, VIDEO_JOB_PREFIX, STATUS_DETAIL_PROJECTION,
+    status_query, needs_status_detail,
+)
+from admission import AdmissionState, throughput_keys
+from metrics import observe_request
+from uploads import StreamingFormParser, UploadError, MAX_UPLOAD_BYTES
+from ingest import MAX_VIDEO_BYTES, IngestError
+
+NO_CACHE_HEADERS = {
+    "Cache-Control": "no-store, no-cache, must-revalidate, max-age=0",
+    "Pragma": "no-cache",
+    "Expires": "0",
+}
+
+redis_client = aioredis.from_url(REDIS_URL, decode_responses=True)
+jobs_collection = AsyncIOMotorClient(MONGO_URI)[MONGO_DB]["jobs"]
+rabbit = {}
+admission = AdmissionState()
+
+
+class RequestMetricsMiddleware:
+    """
+    Latency histogram for the natively served routes, same series as the Flask
+    after_request hook. Requests that fall through to the Flask mount are
+    timed by Flask itself.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+
+        async def send_and_time(message):
+            if message["type"] == "http.response.start":
+                # Latency until headers, like Flask's after_request (streams stay open much longer);
+                # the router has set scope["endpoint"] by now, but not for the Flask mount
+                endpoint = scope.get("endpoint")
+                if endpoint is not None:
+                    observe_request(endpoint.__name__, message["status"], time.perf_counter() - started)
+            await send(message)
+
+        await self.app(scope, receive, send_and_time)
+
+
+def json_response(payload, status_code=200, headers=None):
+    return JSONResponse(payload, status_code=status_code, headers={**NO_CACHE_HEADERS, **(headers or {})})
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Robust connection reconnects on its own; the queue is declared once per process
+    connection = await aio_pika.connect_robust(RABBITMQ_URL)
+    channel = await connection.channel(publisher_confirms=True)
+    await channel.declare_queue(QUEUE_NAME, durable=True, arguments=QUEUE_ARGS)
+    rabbit["connection"], rabbit["channel"] = connection, channel
+    try:
+        yield
+    finally:
+        await connection.close()
+        await redis_client.aclose()
+
+
+async def health(request):
+    return json_response({"status": "ok", "service": "asgi-api", "random": os.urandom(8).hex()})
+
+
+async def check_admission():
+    """Async twin of helpers.check_admission (passive declare over aio-pika, counters via redis.asyncio)."""
+    if admission.needs_refresh():
+        try:
+            # robust=False: a passive check must not be re-declared on reconnect
+            queue = await rabbit["channel"].declare_queue(QUEUE_NAME, passive=True, robust=False)
+            declared = queue.declaration_result
+            counts = await redis_client.mget(throughput_keys())
+            admission.update(declared.message_count, declared.consumer_count, counts)
+        except Exception as e:
+            print(f" Admission control could not read queue state: {e}")
+            admission.refresh_failed()
+    return admission.decide()
+
+
+async def acquire_lock(session_id):
+    """Async twin of helpers.acquire_lock"""
+    try:
+        return await redis_client.set(session_lock_key(session_id), "locked", nx=True, ex=SESSION_LOCK_TTL)
+    except Exception:
+        return False
+
+
+async def release_lock(session_id):
+    """Async twin of helpers.release_lock"""
+    try:
+        await redis_client.delete(session_lock_key(session_id))
+    except Exception as e:
+        print(f" Failed to release lock: {e}")
+
+
+async def cache_status(job_id, payload):
+    """Async twin of helpers.cache_status (seeding a new job's entry)"""
+    try:
+        await redis_client.set(status_cache_key(job_id), json.dumps(payload), ex=STATUS_CACHE_TTL)
+    except Exception as e:
+        print(f" Failed to cache status for job {job_id}: {e}")
+
+
+async def publish_job(message):
+    """Async twin of helpers.publish_job for a helpers.job_message body; awaits the broker confirm"""
+    await rabbit["channel"].default_exchange.publish(
+        aio_pika.Message(
+            body=json.dumps(message).encode(),
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            content_type="application/json",
+            expiration=MESSAGE_TTL_MS / 1000  # seconds
+        ),
+        routing_key=QUEUE_NAME
+    )
+
+
+async def publish(request):
+    """
+    Same contract as the Flask /publish, but the multipart body is parsed as it
+    streams in and file parts are written to /tmp/<job_id>/ chunk by chunk,
+    with MAX_UPLOAD_BYTES enforced per file. Admission control runs before
+    any of the body is read, and both images are normalized
+    (helpers.ingest_uploads) in the thread pool before the job is enqueued.
+    """
+    admitted, eta, retry_after = await check_admission()
+    if not admitted:
+        body, headers = busy_response(eta, retry_after)
+        return json_response(body, 503, headers)
+
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > 2 * MAX_UPLOAD_BYTES + 64 * 1024:
+        return json_response({"error": "Upload too large"}, 413)
+
+    job_id = str(uuid.uuid4())
+    job_dir = f"/tmp/{job_id}"
+    try:
+        os.makedirs(job_dir, exist_ok=True)
+    except Exception as e:
+        return json_response({"error": f"Failed to create job dir: {e}"}, 500)
+
+    # Chunks go to the page cache with plain writes; they are small enough not to stall the loop
+    form = None
+    try:
+        form = StreamingFormParser(request.headers.get("content-type"), job_dir)
+        async for chunk in request.stream():
+            form.write(chunk)
+        form.finalize()
+    except Exception as e:
+        if form is not None:
+            form.cleanup()
+        shutil.rmtree(job_dir, ignore_errors=True)
+        if isinstance(e, UploadError):
+            return json_response({"error": str(e)}, e.status_code)
+        return json_response({"error": f"Failed to save files: {e}"}, 500)
+
+    session_id = form.fields.get("sessionId")
+    if not session_id:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        return json_response({"error": "Missing sessionId"}, 400)
+
+    try:
+        face_map = parse_face_map(form.fields.get("faceMap"), MAX_FACE_SWAPS)
+    except ValueError as e:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        return json_response({"error": str(e)}, 400)
+
+    #  Acquire lock (one active job per session)
+    if not await acquire_lock(session_id):
+        shutil.rmtree(job_dir, ignore_errors=True)
+        return json_response({"error": "Previous job still processing"}, 429)
+    admission.admitted()
+
+    if "image1" not in form.files or "image2" not in form.files:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        await release_lock(session_id)
+        return json_response({"error": "Missing image1 or image2"}, 400)
+
+    print(f"🆕 Generated NEW job_id: {job_id} for session: {session_id}")
+    try:
+        (img1_path, img2_path), ingest_ms = await run_in_threadpool(
+            ingest_uploads, [form.files["image1"]["path"], form.files["image2"]["path"]]
+        )
+    except IngestError as e:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        await release_lock(session_id)
+        return json_response({"error": str(e)}, e.status_code)
+
+    #  Create MongoDB record
+    job, initial_status = new_job(job_id, session_id, ingest_ms)
+    try:
+        await jobs_collection.insert_one(job)
+    except Exception as e:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        await release_lock(session_id)
+        return json_response({"error": f"DB error: {e}"}, 500)
+
+    # Seed the status cache before the worker can see the job
+    await cache_status(job_id, initial_status)
+
+    #  Publish to RabbitMQ (awaits the broker confirm without blocking other requests)
+    try:
+        await publish_job(job_message(job_id, img1_path, session_id, img2_path=img2_path, face_map=face_map))
+    except Exception as e:
+        await jobs_collection.update_one({"jobId": job_id}, publish_failed_update())
+        await release_lock(session_id)
+        return json_response({"error": f"Failed to publish job: {e}"}, 500)
+
+    return json_response(accepted_body(job_id, eta))
+
+
+async def publish_batch(request):
+    """
+    Same contract as the Flask /publish_batch: one `source` and up to
+    MAX_BATCH_TARGETS `targets` parts, streamed to disk like /publish.
+    """
+    admitted, eta, retry_after = await check_admission()
+    if not admitted:
+        body, headers = busy_response(eta, retry_after)
+        return json_response(body, 503, headers)
+
+    content_length = request.headers.get("content-length")
+    max_body = (MAX_BATCH_TARGETS + 1) * MAX_UPLOAD_BYTES + 64 * 1024
+    if content_length and content_length.isdigit() and int(content_length) > max_body:
+        return json_response({"error": "Upload too large"}, 413)
+
+    job_id = f"{BATCH_JOB_PREFIX}{uuid.uuid4()}"
+    job_dir = f"/tmp/{job_id}"
+    try:
+        os.makedirs(job_dir, exist_ok=True)
+    except Exception as e:
+        return json_response({"error": f"Failed to create job dir: {e}"}, 500)
+
+    form = None
+    try:
+        form = StreamingFormParser(request.headers.get("content-type"), job_dir, max_files=MAX_BATCH_TARGETS + 1)
+        async for chunk in request.stream():
+            form.write(chunk)
+        form.finalize()
+    except Exception as e:
+        if form is not None:
+            form.cleanup()
+        shutil.rmtree(job_dir, ignore_errors=True)
+        if isinstance(e, UploadError):
+            return json_response({"error": str(e)}, e.status_code)
+        return json_response({"error": f"Failed to save files: {e}"}, 500)
+
+    session_id = form.fields.get("sessionId")
+    if not session_id:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        return json_response({"error": "Missing sessionId"}, 400)
+
+    targets = [info["path"] for name, info in form.file_list if name == "targets"]
+    if "source" not in form.files or not targets:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        return json_response({"error": "Missing source or targets"}, 400)
+
+    if not await acquire_lock(session_id):
+        shutil.rmtree(job_dir, ignore_errors=True)
+        return json_response({"error": "Previous job still processing"}, 429)
+    admission.admitted()
+
+    print(f"🆕 Generated NEW batch job_id: {job_id} for session: {session_id} ({len(targets)} targets)")
+    try:
+        (source_path, *target_paths), ingest_ms = await run_in_threadpool(
+            ingest_uploads, [form.files["source"]["path"]] + targets
+        )
+    except IngestError as e:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        await release_lock(session_id)
+        return json_response({"error": str(e)}, e.status_code)
+
+    job, initial_status = new_job(job_id, session_id, ingest_ms, target_count=len(target_paths))
+    try:
+        await jobs_collection.insert_one(job)
+    except Exception as e:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        await release_lock(session_id)
+        return json_response({"error": f"DB error: {e}"}, 500)
+
+    await cache_status(job_id, initial_status)
+
+    try:
+        await publish_job(job_message(job_id, source_path, session_id, target_paths=target_paths))
+    except Exception as e:
+        await jobs_collection.update_one({"jobId": job_id}, publish_failed_update())
+        await release_lock(session_id)
+        return json_response({"error": f"Failed to publish job: {e}"}, 500)
+
+    return json_response(accepted_body(job_id, eta, target_count=len(target_paths)))
+
+
+async def publish_video(request):
+    """
+    Same contract as the Flask /publish_video: one `source` image and one `video`
+    clip, streamed to disk like /publish (the clip is format-checked as it arrives).
+    """
+    admitted, eta, retry_after = await check_admission()
+    if not admitted:
+        body, headers = busy_response(eta, retry_after)
+        return json_response(body, 503, headers)
+
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES + MAX_VIDEO_BYTES + 64 * 1024:
+        return json_response({"error": "Upload too large"}, 413)
+
+    job_id = f"{VIDEO_JOB_PREFIX}{uuid.uuid4()}"
+    job_dir = f"/tmp/{job_id}"
+    try:
+        os.makedirs(job_dir, exist_ok=True)
+    except Exception as e:
+        return json_response({"error": f"Failed to create job dir: {e}"}, 500)
+
+    form = None
+    try:
+        form = StreamingFormParser(request.headers.get("content-type"), job_dir, max_files=2, video_fields=("video",))
+        async for chunk in request.stream():
+            form.write(chunk)
+        form.finalize()
+    except Exception as e:
+        if form is not None:
+            form.cleanup()
+        shutil.rmtree(job_dir, ignore_errors=True)
+        if isinstance(e, UploadError):
+            return json_response({"error": str(e)}, e.status_code)
+        return json_response({"error": f"Failed to save files: {e}"}, 500)
+
+    session_id = form.fields.get("sessionId")
+    if not session_id:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        return json_response({"error": "Missing sessionId"}, 400)
+
+    if "source" not in form.files or "video" not in form.files:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        return json_response({"error": "Missing source or video"}, 400)
+
+    if not await acquire_lock(session_id):
+        shutil.rmtree(job_dir, ignore_errors=True)
+        return json_response({"error": "Previous job still processing"}, 429)
+    admission.admitted()
+
+    print(f"🆕 Generated NEW video job_id: {job_id} for session: {session_id}")
+    try:
+        (source_path,), ingest_ms = await run_in_threadpool(
+            ingest_uploads, [form.files["source"]["path"]], form.files["video"]["path"]
+        )
+    except IngestError as e:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        await release_lock(session_id)
+        return json_response({"error": str(e)}, e.status_code)
+
+    job, initial_status = new_job(job_id, session_id, ingest_ms, video=True)
+    try:
+        await jobs_collection.insert_one(job)
+    except Exception as e:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        await release_lock(session_id)
+        return json_response({"error": f"DB error: {e}"}, 500)
+
+    await cache_status(job_id, initial_status)
+
+    try:
+        await publish_job(job_message(job_id, source_path, session_id, video_path=form.files["video"]["path"]))
+    except Exception as e:
+        await jobs_collection.update_one({"jobId": job_id}, publish_failed_update())
+        await release_lock(session_id)
+        return json_response({"error": f"Failed to publish job: {e}"}, 500)
+
+    return json_response(accepted_body(job_id, eta))
+
+
+async def find_status(job_id):
+    """Same reads as db.find_status, shaped as the /status body (None if the job does not exist)"""
+    try:
+        job = await jobs_collection.find_one({"jobId": job_id}, **status_query(job_id))
+    except OperationFailure as e:
+        print(f" /status index hint failed, querying without it: {e}")
+        job = await jobs_collection.find_one({"jobId": job_id}, **status_query(job_id, hint=False))
+    if not job:
+        return None
+    if needs_status_detail(job_id, job):
+        job.update(await jobs_collection.find_one({"jobId": job_id}, projection=STATUS_DETAIL_PROJECTION) or {})
+    return status_payload(job)
+
+
+async def status(request):
+    """Same contract as the Flask /status (status cache first, then MongoDB)."""
+    job_id = request.path_params["job_id"]
+
+    cache_state = "HIT"
+    payload = None
+    try:
+        raw = await redis_client.get(status_cache_key(job_id))
+        payload = json.loads(raw) if raw else None
+    except Exception as e:
+        print(f" Status cache read failed for job {job_id}: {e}")
+
+    if payload is None:
+        cache_state = "MISS"
+        payload = await find_status(job_id)
+        if payload is None:
+            return json_response({"status": "not_found"}, 404)
+        try:
+            await redis_client.set(status_cache_key(job_id), json.dumps(payload), ex=STATUS_CACHE_TTL, nx=True)
+        except Exception as e:
+            print(f" Failed to cache status for job {job_id}: {e}")
+
+    headers = {"X-Cache": cache_state}
+    if payload["status"] not in TERMINAL_STATUSES:
+        headers["Retry-After"] = str(STATUS_RETRY_AFTER)
+    return json_response(payload, headers=headers)
+
+
+async def subscribe_status(job_id):
+    """Subscribe first, then read the current status once (see server.subscribe_status)."""
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    await pubsub.subscribe(status_channel(job_id))
+    payload = await find_status(job_id)
+    if payload is None:
+        await pubsub.aclose()
+    return pubsub, payload
+
+
+async def status_stream(request):
+    """Same contract as the Flask /status/<job_id>/stream."""
+    pubsub, payload = await subscribe_status(request.path_params["job_id"])
+    if payload is None:
+        return json_response({"status": "not_found"}, 404)
+
+    async def events():
+        try:
+            yield f"data: {json.dumps(payload)}\n\n"
+            if payload["status"] in TERMINAL_STATUSES:
+                return
+
+            deadline = time.monotonic() + STATUS_STREAM_TIMEOUT
+            while time.monotonic() < deadline:
+                message = await pubsub.get_message(timeout=STATUS_HEARTBEAT)
+                if message is None:
+                    yield ": keepalive\n\n"
+                    continue
+
+                update = json.loads(message["data"])
+                yield f"data: {json.dumps(update)}\n\n"
+                if update.get("status") in TERMINAL_STATUSES:
+                    return
+        finally:
+            await pubsub.aclose()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={**NO_CACHE_HEADERS, "X-Accel-Buffering": "no"}
+    )
+
+
+async def status_wait(request):
+    """Same contract as the Flask /status/<job_id>/wait."""
+    try:
+        timeout = min(float(request.query_params.get("timeout", STATUS_WAIT_MAX)), STATUS_WAIT_MAX)
+    except ValueError:
+        return json_response({"error": "Invalid timeout"}, 400)
+
+    pubsub, payload = await subscribe_status(request.path_params["job_id"])
+    if payload is None:
+        return json_response({"status": "not_found"}, 404)
+
+    try:
+        deadline = time.monotonic() + timeout
+        while payload["status"] not in TERMINAL_STATUSES:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            message = await pubsub.get_message(timeout=remaining)
+            if message is not None:
+                payload = json.loads(message["data"])
+    finally:
+        await pubsub.aclose()
+
+    return json_response(payload)
+
+
+async def serve_result(request):
+    """Same contract as the Flask /results/<filename> (ETag/304, Range, immutable caching)."""
+    filename = request.path_params["filename"]
+    file_path = safe_join(RESULTS_DIR, filename)
+    if file_path is None or not os.path.isfile(file_path):
+        return json_response({"error": "File not found"}, 404)
+
+    etag = f'"{result_etag(filename)}"'
+    headers = {"ETag": etag, "Cache-Control": RESULT_CACHE_CONTROL}
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    # FileResponse keeps our ETag and answers Range / If-Range itself
+    return FileResponse(file_path, headers=headers)
+
+
+app = Starlette(
+    routes=[
+        Route("/health", health, methods=["GET"]),
+        Route("/publish", publish, methods=["POST"]),
+        Route("/publish_batch", publish_batch, methods=["POST"]),
+        Route("/publish_video", publish_video, methods=["POST"]),
+        Route("/status/{job_id}", status, methods=["GET"]),
+        Route("/status/{job_id}/stream", status_stream, methods=["GET"]),
+        Route("/status/{job_id}/wait", status_wait, methods=["GET"]),
+        Route("/results/{filename}", serve_result, methods=["GET", "HEAD"]),
+        # Everything else keeps running on the Flask app (in a thread pool)
+        Mount("/", app=WSGIMiddleware(flask_app)),
+    ],
+    middleware=[Middleware(RequestMetricsMiddleware)],
+    lifespan=lifespan,
+)
@@ -1,16 +1,137 @@
 # db.py
 import os
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
 import redis
 
 # ---------- MongoDB ----------
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
 MONGO_DB = os.getenv("MONGO_DB", "face_swap")
 
+# Finished jobs are deleted this long after they finished (0 keeps them forever)
+JOBS_TTL_SECONDS = int(os.getenv("JOBS_TTL_SECONDS", 7 * 24 * 3600))
+FINISHED_STATUSES = ["completed", "failed", "error"]
+# Only terminal status writes set finishedAt, so a plain TTL index on it never touches unfinished
+# jobs (a partial filter on status would need MongoDB 6.0 for $in)
+TTL_INDEX = "finishedAt_ttl"
+LEGACY_TTL_INDEXES = ["updatedAt_ttl"]
+
 mongo_client = MongoClient(MONGO_URI)
 mongo_db = mongo_client[MONGO_DB]
 jobs_collection = mongo_db["jobs"]
 
+# /status reads these short scalar fields first; the STATUS_INDEX index holds all of them,
+# so that query is answered from the index without fetching the document
+STATUS_INDEX = "jobId_status_urls_cover"
+STATUS_PROJECTION = {"_id": 0, "status": 1, "resultUrl": 1, "thumbnailUrl": 1}
+# Older covering indexes, replaced when the projection changed
+LEGACY_STATUS_INDEXES = ["jobId_status_cover", "jobId_status_thumb_cover", "jobId_status_faces_cover"]
+
+# Free-text error and the faces sub-document stay out of the index (every write would update them
+# there); finished jobs read them in a second point lookup, which the status cache makes rare
+STATUS_DETAIL_PROJECTION = {"_id": 0, "error": 1, "faces": 1}
+DETAIL_STATUSES = ["completed", "failed"]
+
+# /publish_batch jobs also return their per-target array, which no index can cover;
+# their jobIds carry this prefix so /status knows which query to run without a lookup
+BATCH_JOB_PREFIX = "batch-"
+BATCH_STATUS_PROJECTION = {**STATUS_PROJECTION, **STATUS_DETAIL_PROJECTION, "targets": 1, "done": 1}
+
+# Same for /publish_video jobs and their progress percentage (most reads hit the status cache anyway)
+VIDEO_JOB_PREFIX = "video-"
+VIDEO_STATUS_PROJECTION = {**STATUS_PROJECTION, **STATUS_DETAIL_PROJECTION, "progress": 1}
+
+
+def status_query(job_id, hint=True):
+    """find_one keyword arguments for a job's /status fields"""
+    if job_id.startswith(BATCH_JOB_PREFIX):
+        return {"projection": BATCH_STATUS_PROJECTION}
+    if job_id.startswith(VIDEO_JOB_PREFIX):
+        return {"projection": VIDEO_STATUS_PROJECTION}
+    if not hint:
+        return {"projection": STATUS_PROJECTION}
+    return {"projection": STATUS_PROJECTION, "hint": STATUS_INDEX}
+
+
+def needs_status_detail(job_id, job):
+    """Whether a job read with status_query still lacks the error / faces its /status body shows"""
+    return (not job_id.startswith((BATCH_JOB_PREFIX, VIDEO_JOB_PREFIX))
+            and job.get("status") in DETAIL_STATUSES)
+
+
+def find_status(job_id):
+    """
+    A job's /status fields from MongoDB, or None if it does not exist. Falls back to an
+    unhinted query while STATUS_INDEX is missing (index setup failed or is still building).
+    """
+    try:
+        job = jobs_collection.find_one({"jobId": job_id}, **status_query(job_id))
+    except OperationFailure as e:
+        print(f" /status index hint failed, querying without it: {e}")
+        job = jobs_collection.find_one({"jobId": job_id}, **status_query(job_id, hint=False))
+    if job and needs_status_detail(job_id, job):
+        job.update(jobs_collection.find_one({"jobId": job_id}, projection=STATUS_DETAIL_PROJECTION) or {})
+    return job
+
+
+def ensure_indexes():
+    """Create the jobs collection indexes (idempotent, run at startup)."""
+    try:
+        jobs_collection.create_index([("jobId", ASCENDING)], unique=True, name="jobId_unique")
+    except OperationFailure as e:
+        print(f"❌ Could not create unique jobId index (duplicate jobIds?): {e}")
+
+    jobs_collection.create_index(
+        [("jobId", ASCENDING), ("status", ASCENDING), ("resultUrl", ASCENDING), ("thumbnailUrl", ASCENDING)],
+        name=STATUS_INDEX
+    )
+    existing = jobs_collection.index_information()
+    for name in LEGACY_STATUS_INDEXES:
+        if name in existing:
+            jobs_collection.drop_index(name)
+
+    # Per-session history, newest first
+    jobs_collection.create_index([("sessionId", ASCENDING), ("createdAt", DESCENDING)], name="sessionId_createdAt")
+
+    ensure_ttl_index()
+
+
+def ensure_ttl_index():
+    """TTL index on finishedAt (see TTL_INDEX); follows JOBS_TTL_SECONDS changes."""
+    indexes = jobs_collection.index_information()
+    for name in LEGACY_TTL_INDEXES:
+        if name in indexes:
+            jobs_collection.drop_index(name)
+    existing = indexes.get(TTL_INDEX)
+
+    if JOBS_TTL_SECONDS <= 0:
+        if existing:
+            jobs_collection.drop_index(TTL_INDEX)
+        return
+
+    if existing is None:
+        # Jobs finished before finishedAt was written expire from their last update instead
+        jobs_collection.update_many(
+            {"status": {"$in": FINISHED_STATUSES}, "finishedAt": {"$exists": False}},
+            [{"$set": {"finishedAt": "$updatedAt"}}]
+        )
+        jobs_collection.create_index(
+            [("finishedAt", ASCENDING)],
+            name=TTL_INDEX,
+            expireAfterSeconds=JOBS_TTL_SECONDS
+        )
+    elif existing.get("expireAfterSeconds") != JOBS_TTL_SECONDS:
+        mongo_db.command("collMod", jobs_collection.name, index={
+            "name": TTL_INDEX,
+            "expireAfterSeconds": JOBS_TTL_SECONDS
+        })
+
+
+try:
+    ensure_indexes()
+except Exception as e:
+    print(f"❌ MongoDB index setup failed: {e}")
+
 # ---------- Redis ----------
 REDIS_URL = os.getenv("REDIS_URL")
 
@@ -1,9 +1,16 @@
 import json
 import os
+import time
 import uuid
+import threading
+from datetime import datetime
 import pika
 import redis
 from db import jobs_collection
+from publisher import ChannelPool, ConfirmingPublisher
+from admission import AdmissionState, record_completions, throughput_keys, busy_body
+from ingest import normalize_image, check_video
+from metrics import QUEUE_DEPTH, QUEUE_CONSUMERS, SESSION_LOCKS
 
 # ================== REDIS (Upstash) SETUP ==================
 REDIS_URL = os.getenv("REDIS_URL")
@@ -18,65 +25,228 @@ RABBITMQ_PASS = os.getenv("RABBITMQ_DEFAULT_PASS", "changeme123")
 # Build RabbitMQ URL without vhost (uses default '/')
 RABBITMQ_URL = f"amqp://{RABBITMQ_USER}:{RABBITMQ_PASS}@{RABBITMQ_HOST}:{RABBITMQ_PORT}"
 
+# Persistent channels shared by request threads; confirms are optional and batched across requests
+RABBITMQ_POOL_SIZE = int(os.getenv("RABBITMQ_POOL_SIZE", 4))
+RABBITMQ_CONFIRMS = os.getenv("RABBITMQ_CONFIRMS", "false").lower() in ("1", "true", "yes")
+RABBITMQ_CONFIRM_BATCH = int(os.getenv("RABBITMQ_CONFIRM_BATCH", 50))
+
+# Ensure queue exists with same args as definitions.json
+QUEUE_NAME = "face_swap_jobs"
+QUEUE_ARGS = {
+    'x-message-ttl': 300000,  # 5 minutes
+    'x-dead-letter-exchange': 'dlx_face_swap'  # Failed messages
+}
+
+_pool = None
+_publisher = None
+_publisher_lock = threading.Lock()
+
+def get_publisher():
+    """
+    Lazily build the process-wide publisher (after gunicorn forks, so every
+    worker process gets its own connections).
+    """
+    global _pool, _publisher
+    if _publisher is None:
+        with _publisher_lock:
+            if _publisher is None:
+                _pool = ChannelPool(RABBITMQ_URL, QUEUE_NAME, QUEUE_ARGS, size=RABBITMQ_POOL_SIZE)
+                if RABBITMQ_CONFIRMS:
+                    _publisher = ConfirmingPublisher(_pool, max_batch=RABBITMQ_CONFIRM_BATCH)
+                else:
+                    _publisher = _pool
+    return _publisher
+
+def get_channel_pool():
+    get_publisher()
+    return _pool
+
+# ================== HELPER: Admission control ==================
+admission = AdmissionState()
+
+def check_admission():
+    """
+    Decide whether /publish may enqueue another job: (admit, eta_seconds, retry_after).
+    Queue depth (passive declare) and throughput (Redis counters) are re-read
+    at most every ADMISSION_REFRESH seconds per process.
+    """
+    if admission.needs_refresh():
+        try:
+            depth, consumers = get_channel_pool().queue_depth()
+            counts = redis_client.mget(throughput_keys())
+            admission.update(depth, consumers, counts)
+        except Exception as e:
+            print(f" Admission control could not read queue state: {e}")
+            admission.refresh_failed()
+    return admission.decide()
+
+def record_admission():
+    """Count an admitted job into the admission snapshot; call once its session lock is held."""
+    admission.admitted()
+
 # ================== HELPER: Publish to RabbitMQ ==================
-def publish_job(job_id, img1_path, img2_path, session_id):
+def publish_job(job_id, img1_path, img2_path, session_id, target_paths=None, face_map=None, video_path=None):
     """
-    Publish a face swap job to RabbitMQ queue.
+    Publish a face swap job to RabbitMQ queue over a pooled, persistent channel.
+    A /publish_batch job passes its destination images as target_paths instead of img2_path,
+    a /publish_video job its clip as video_path.
+    face_map (from parse_face_map) asks for several swaps on the destination in one job.
     """
     try:
-        # Connect to RabbitMQ
-        params = pika.URLParameters(RABBITMQ_URL)
-        connection = pika.BlockingConnection(params)
-        channel = connection.channel()
-        
-        # Ensure queue exists with same args as definitions.json
-        queue_args = {
-            'x-message-ttl': 300000,  # 5 minutes
-            'x-dead-letter-exchange': 'dlx_face_swap'  # Failed messages
-        }
-        channel.queue_declare(
-            queue="face_swap_jobs", 
-            durable=True,
-            arguments=queue_args
-        )
-        
-        # Prepare message - use consistent field names
-        message = {
-            "jobId": job_id,
-            "img1_path": img1_path,
-            "img2_path": img2_path,
-            "sessionId": session_id
-        }
+        message = job_message(job_id, img1_path, session_id, img2_path, target_paths, face_map, video_path)
         
         print(f"📤 Publishing job {job_id}: {json.dumps(message, indent=2)}")
         
         # Publish message with persistent delivery
-        channel.basic_publish(
-            exchange="",  # Default exchange (direct to queue)
-            routing_key="face_swap_jobs",
-            body=json.dumps(message),
-            properties=pika.BasicProperties(
+        get_publisher().publish(
+            json.dumps(message),
+            pika.BasicProperties(
                 delivery_mode=2,  # Make message persistent
                 content_type="application/json",
-                expiration="300000"  # Match TTL (5 minutes in ms)
+                expiration=str(MESSAGE_TTL_MS)
             )
         )
         
-        
-        # Close connection
-        connection.close()
-        
     except Exception as e:
         print(f"❌ Failed to publish job {job_id}: {e}")
         raise e
 
 
+# ================== HELPER: Job submission ==================
+# Steps every /publish* route shares. Both front ends (server.py and the native routes in
+# asgi.py) build their jobs, messages and responses here; only the I/O clients differ.
+SESSION_LOCK_TTL = int(os.getenv("SESSION_LOCK_TTL", 300))  # the worker extends it while a long job reports progress
+MESSAGE_TTL_MS = QUEUE_ARGS['x-message-ttl']
+
+
+def session_lock_key(session_id):
+    """Redis key of a session's one-active-job lock"""
+    return f"session_lock:{session_id}"
+
+
+def busy_response(eta, retry_after):
+    """503 body and headers for a job check_admission turned away"""
+    return busy_body(eta, retry_after), {"Retry-After": str(retry_after)}
+
+
+def ingest_uploads(image_paths, video_path=None):
+    """
+    Normalize the uploaded images (and check the clip, if any) for the worker.
+    Returns (normalized image paths, ingestMs); raises IngestError for a bad upload.
+    """
+    started = time.perf_counter()
+    paths = [normalize_image(path) for path in image_paths]
+    if video_path is not None:
+        check_video(video_path)
+    return paths, round((time.perf_counter() - started) * 1000, 1)
+
+
+def new_job(job_id, session_id, ingest_ms, target_count=None, video=False):
+    """
+    MongoDB document of a newly accepted job, and the /status body the cache is seeded
+    with before the job is published (so the worker's update always lands last).
+    """
+    now = datetime.utcnow()
+    job = {
+        "sessionId": session_id,
+        "jobId": job_id,
+        "status": "processing",  # frontend expects "processing" or "completed"
+        "resultUrl": None,
+        "timings": {"ingestMs": ingest_ms},
+        "createdAt": now,
+        "updatedAt": now
+    }
+    if target_count is not None:
+        job["targets"] = [{"status": "processing"} for _ in range(target_count)]
+    if video:
+        job["progress"] = 0
+    return job, status_payload(job)
+
+
+def job_message(job_id, img1_path, session_id, img2_path=None, target_paths=None, face_map=None, video_path=None):
+    """RabbitMQ message body of a job (job kinds as in publish_job)"""
+    message = {
+        "jobId": job_id,
+        "img1_path": img1_path,
+        "sessionId": session_id,
+        "enqueuedAt": time.time()  # worker measures queue wait from this
+    }
+    if target_paths is not None:
+        message["targets"] = target_paths
+    elif video_path is not None:
+        message["video_path"] = video_path
+    else:
+        message["img2_path"] = img2_path
+    if face_map is not None:
+        message["faceMap"] = face_map
+    return message
+
+
+def publish_failed_update():
+    """Mongo update for a job whose message never reached the queue (finishedAt: see db.ensure_ttl_index)"""
+    failed_at = datetime.utcnow()
+    return {"$set": {"status": "error", "updatedAt": failed_at, "finishedAt": failed_at}}
+
+
+def accepted_body(job_id, eta, target_count=None):
+    """/publish* response body for an enqueued job"""
+    body = {"status": "processing", "jobId": job_id}
+    if target_count is not None:
+        body["targets"] = target_count
+    body["etaSeconds"] = round(eta, 1) if eta is not None else None
+    return body
+
+
+# ================== HELPER: Face map ==================
+def parse_face_map(raw, max_pairs):
+    """
+    Parse /publish's optional faceMap field: a JSON list of [sourceFace, destFace]
+    pairs (1-based, as in /status "faces"), e.g. "[[1, 2], [2, 1]]".
+    Each destination face may appear once. Returns the list of pairs, or None
+    if the field is empty; raises ValueError with a client-facing message.
+    """
+    if raw is None or not raw.strip():
+        return None
+    try:
+        pairs = json.loads(raw)
+    except ValueError:
+        raise ValueError("faceMap must be JSON, e.g. [[1, 2], [2, 1]]")
+    if not isinstance(pairs, list) or not pairs:
+        raise ValueError("faceMap must be a non-empty list of [sourceFace, destFace] pairs")
+    if len(pairs) > max_pairs:
+        raise ValueError(f"Too many faceMap pairs (max {max_pairs})")
+    for pair in pairs:
+        if (not isinstance(pair, list) or len(pair) != 2
+                or not all(isinstance(idx, int) and not isinstance(idx, bool) and idx >= 1 for idx in pair)):
+            raise ValueError("Each faceMap pair must be two face indices >= 1, e.g. [1, 2]")
+    dest_faces = [dest for _, dest in pairs]
+    if len(set(dest_faces)) != len(dest_faces):
+        raise ValueError("Each destination face may appear only once in faceMap")
+    return pairs
+
+
+# ================== HELPER: Scrape-time gauges ==================
+def refresh_queue_metrics():
+    """Read queue depth / consumers (passive declare) and count held session locks for /metrics"""
+    try:
+        depth, consumers = get_channel_pool().queue_depth()
+        QUEUE_DEPTH.set(depth)
+        QUEUE_CONSUMERS.set(consumers)
+    except Exception as e:
+        print(f" Could not read queue depth for metrics: {e}")
+
+    try:
+        SESSION_LOCKS.set(sum(1 for _ in redis_client.scan_iter(match="session_lock:*", count=1000)))
+    except Exception as e:
+        print(f" Could not count session locks for metrics: {e}")
+
+
 # ================== HELPER: Redis Lock (1 job per session) ==================
-def acquire_lock(session_id, timeout=300):
+def acquire_lock(session_id, timeout=SESSION_LOCK_TTL):
     """Try to acquire a Redis lock so only one active job per session."""
     try:
         # Simple SET NX (set if not exists) with expiration
-        lock_key = f"session_lock:{session_id}"
+        lock_key = session_lock_key(session_id)
         
         # Try to set the key (returns True if set, False if already exists)
         locked = redis_client.set(lock_key, "locked", nx=True, ex=timeout)
@@ -92,28 +262,190 @@ def acquire_lock(session_id, timeout=300):
 def release_lock(session_id):
     """Release the Redis lock by deleting the key."""
     try:
-        lock_key = f"session_lock:{session_id}"
-        
-        # Check if key exists before deletion
-        exists_before = redis_client.exists(lock_key)
-        print(f" Lock key '{lock_key}' exists before deletion: {exists_before}")
-        
-        # Delete the key
-        result = redis_client.delete(lock_key)
+        lock_key = session_lock_key(session_id)
         
-        # Verify deletion
-        exists_after = redis_client.exists(lock_key)
-        
-        if result > 0:
-            if exists_after:
-                print(f" WARNING: Key still exists after deletion!")
-        else:
+        # DEL returns how many keys were removed - no need to check before/after
+        if not redis_client.delete(lock_key):
             print(f" No lock found to release for session: {session_id} (key: {lock_key})")
             
     except Exception as e:
         import traceback
         traceback.print_exc()
 
+# ================== HELPER: Job status push (Redis pub/sub) ==================
+TERMINAL_STATUSES = ("completed", "failed")
+
+# Read-through status cache: Redis entry per job, plus an optional short-lived in-process copy
+STATUS_CACHE_TTL = int(os.getenv("STATUS_CACHE_TTL", 600))
+STATUS_LOCAL_TTL = float(os.getenv("STATUS_LOCAL_TTL", 0))  # seconds, 0 disables
+STATUS_LOCAL_MAX = 10000
+
+_local_status = {}
+_local_status_lock = threading.Lock()
+
+def status_channel(job_id):
+    """Redis pub/sub channel carrying status changes for one job"""
+    return f"job_status:{job_id}"
+
+
+def status_cache_key(job_id):
+    """Redis key holding the cached /status body for one job"""
+    return f"job_status_cache:{job_id}"
+
+
+def status_payload(job):
+    """Shape a job document exactly like the /status response body."""
+    if job.get("targets") is not None:
+        return batch_status_payload(job)
+    if job.get("status") == "completed":
+        payload = {"status": "completed", "image_url": job.get("resultUrl")}
+        if job.get("thumbnailUrl"):
+            payload["thumbnail_url"] = job["thumbnailUrl"]
+    elif job.get("status") == "failed":
+        payload = {"status": "failed", "error": job.get("error")}
+    elif job.get("progress") is not None:
+        # Video jobs: percentage of frames done
+        return {"status": "processing", "progress": job["progress"]}
+    else:
+        return {"status": "processing"}
+    # Faces the worker detected in both images, for building a faceMap
+    if job.get("faces"):
+        payload["faces"] = job["faces"]
+    return payload
+
+
+def batch_status_payload(job):
+    """
+    /status body of a /publish_batch job: the overall status plus one /status-shaped
+    entry per target, in upload order. Stays "processing" until every target is done;
+    then "completed" if any target succeeded, otherwise "failed".
+    """
+    targets = [status_payload(target) for target in job["targets"]]
+    status = job.get("status") if job.get("status") in TERMINAL_STATUSES else "processing"
+    payload = {
+        "status": status,
+        "total": len(targets),
+        # The worker's counter when stored: it orders the job's pushes (see the worker's finish_target)
+        "done": job.get("done", sum(1 for target in targets if target["status"] in TERMINAL_STATUSES)),
+        "targets": targets,
+    }
+    if status == "failed":
+        payload["error"] = job.get("error")
+    return payload
+
+
+def _cache_locally(job_id, payload):
+    if STATUS_LOCAL_TTL <= 0:
+        return
+    with _local_status_lock:
+        if len(_local_status) >= STATUS_LOCAL_MAX:
+            now = time.monotonic()
+            for key in [k for k, (expires, _) in _local_status.items() if expires <= now]:
+                del _local_status[key]
+            if len(_local_status) >= STATUS_LOCAL_MAX:
+                _local_status.clear()
+        _local_status[job_id] = (time.monotonic() + STATUS_LOCAL_TTL, payload)
+
+
+def cache_status(job_id, payload, only_if_missing=False):
+    """
+    Write a job's /status body through to the status cache.
+    only_if_missing is for filling a miss from Mongo: it must not overwrite a
+    newer status the worker wrote after our read.
+    """
+    _cache_locally(job_id, payload)
+    try:
+        redis_client.set(status_cache_key(job_id), json.dumps(payload), ex=STATUS_CACHE_TTL, nx=only_if_missing)
+    except Exception as e:
+        print(f" Failed to cache status for job {job_id}: {e}")
+
+
+def get_cached_status(job_id):
+    """Return the cached /status body for a job, or None on a miss."""
+    if STATUS_LOCAL_TTL > 0:
+        with _local_status_lock:
+            entry = _local_status.get(job_id)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+
+    try:
+        raw = redis_client.get(status_cache_key(job_id))
+    except Exception as e:
+        print(f" Status cache read failed for job {job_id}: {e}")
+        return None
+    if raw is None:
+        return None
+
+    payload = json.loads(raw)
+    _cache_locally(job_id, payload)
+    return payload
+
+
+# ================== HELPER: Job completion ==================
+def completion_update(completion):
+    """
+    Turn a completion ({"jobId", "status", "resultUrl", "thumbnailUrl"?} or
+    {"jobId", "status": "failed", "error", "technicalError"}, either with an
+    optional "timings" dict and "faces" summary) into the Mongo $set fields
+    and the /status body.
+    """
+    if completion.get("status") == "completed":
+        fields = {"status": "completed", "resultUrl": completion.get("resultUrl")}
+        if completion.get("thumbnailUrl"):
+            fields["thumbnailUrl"] = completion["thumbnailUrl"]
+    else:
+        fields = {"status": "failed", "error": completion.get("error") or "Processing failed"}
+        if completion.get("technicalError"):
+            fields["technicalError"] = completion["technicalError"]
+    if isinstance(completion.get("faces"), dict):
+        fields["faces"] = completion["faces"]
+    payload = status_payload(fields)
+    # Dotted keys merge into the timings sub-document instead of replacing ingestMs
+    if isinstance(completion.get("timings"), dict):
+        for key, value in completion["timings"].items():
+            fields[f"timings.{key}"] = value
+    return fields, payload
+
+
+def finish_jobs(completions):
+    """
+    Record terminal job statuses with one find_one_and_update per job (which
+    also returns its sessionId), then release every session lock and write
+    through / publish every status in a single pipelined Redis round-trip.
+    Returns the jobIds that were found.
+    """
+    finished = []
+    for completion in completions:
+        fields, payload = completion_update(completion)
+        # finishedAt drives the TTL cleanup (db.ensure_ttl_index)
+        fields["updatedAt"] = fields["finishedAt"] = datetime.utcnow()
+        job = jobs_collection.find_one_and_update(
+            {"jobId": completion["jobId"]},
+            {"$set": fields},
+            projection={"_id": 0, "sessionId": 1}
+        )
+        if job is not None:
+            finished.append((completion["jobId"], job.get("sessionId"), payload))
+
+    if not finished:
+        return []
+
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for job_id, session_id, payload in finished:
+            if session_id:
+                pipe.delete(session_lock_key(session_id))
+            body = json.dumps(payload)
+            pipe.set(status_cache_key(job_id), body, ex=STATUS_CACHE_TTL)
+            pipe.publish(status_channel(job_id), body)
+            _cache_locally(job_id, payload)
+        record_completions(pipe, len(finished))
+        pipe.execute()
+    except Exception as e:
+        print(f" Failed to release locks / publish statuses: {e}")
+
+    return [job_id for job_id, _, _ in finished]
+
 # ================== HELPER: Job Creation ==================
 def create_job(session_id):
     """Insert a new job document into MongoDB."""
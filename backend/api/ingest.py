@@ -0,0 +1,106 @@
+# ingest.py
+import os
+from PIL import Image, ImageOps
+
+# Uploads are re-encoded once here so the worker always decodes a bounded, compact JPEG
+INGEST_NORMALIZE = os.getenv("INGEST_NORMALIZE", "true").lower() in ("1", "true", "yes")
+INGEST_MAX_EDGE = int(os.getenv("INGEST_MAX_EDGE", 2048))
+INGEST_QUALITY = int(os.getenv("INGEST_QUALITY", 90))
+
+SNIFF_BYTES = 12
+SUPPORTED_FORMATS = "JPEG, PNG, WebP, GIF, BMP, TIFF"
+
+# /publish_video clips are only format-checked here; the worker scales frames while decoding them
+MAX_VIDEO_BYTES = int(os.getenv("MAX_VIDEO_BYTES", 100 * 1024 * 1024))
+SUPPORTED_VIDEO_FORMATS = "MP4, MOV, WebM, GIF"
+
+
+class IngestError(Exception):
+    """Upload that is not a usable image; status_code is the HTTP status to return."""
+
+    def __init__(self, message, status_code=415):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def sniff_format(head):
+    """Identify an image format from its first bytes (ignores filename and Content-Type)."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head.startswith(b"BM"):
+        return "bmp"
+    if head[:4] in (b"II*\x00", b"MM\x00*"):
+        return "tiff"
+    return None
+
+
+def check_image_head(name, head):
+    """Raise IngestError unless the leading bytes belong to a supported image format."""
+    if sniff_format(head) is None:
+        raise IngestError(f"{name} is not a supported image ({SUPPORTED_FORMATS})")
+
+
+def sniff_video_format(head):
+    """Identify a clip's container from its first bytes (ignores filename and Content-Type)."""
+    if head[4:8] == b"ftyp":
+        return "mp4"  # MP4 / MOV / M4V (ISO base media)
+    if head.startswith(b"\x1a\x45\xdf\xa3"):
+        return "webm"  # WebM / Matroska (EBML)
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    return None
+
+
+def check_video_head(name, head):
+    """Raise IngestError unless the leading bytes belong to a supported video container."""
+    if sniff_video_format(head) is None:
+        raise IngestError(f"{name} is not a supported video ({SUPPORTED_VIDEO_FORMATS})")
+
+
+def check_video(path):
+    """Verify an uploaded clip's size and real format; it is not re-encoded. Returns path."""
+    if os.path.getsize(path) > MAX_VIDEO_BYTES:
+        raise IngestError(f"{os.path.basename(path)} exceeds {MAX_VIDEO_BYTES} bytes", status_code=413)
+    with open(path, "rb") as f:
+        check_video_head(os.path.basename(path), f.read(SNIFF_BYTES))
+    return path
+
+
+def normalize_image(path):
+    """
+    Normalize an uploaded image in place for the worker:
+    verify its real format, apply EXIF orientation, downscale so the longest
+    edge is at most INGEST_MAX_EDGE and re-encode as RGB JPEG.
+    Returns the path of the normalized file (extension becomes .jpg).
+    """
+    with open(path, "rb") as f:
+        check_image_head(os.path.basename(path), f.read(SNIFF_BYTES))
+
+    if not INGEST_NORMALIZE:
+        return path
+
+    out_path = os.path.splitext(path)[0] + ".jpg"
+    try:
+        with Image.open(path) as img:
+            # JPEG only: let libjpeg decode at 1/2, 1/4 or 1/8 scale instead of full 48 MP
+            img.draft("RGB", (INGEST_MAX_EDGE, INGEST_MAX_EDGE))
+            img = ImageOps.exif_transpose(img)
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            img.thumbnail((INGEST_MAX_EDGE, INGEST_MAX_EDGE), Image.LANCZOS)
+            img.save(out_path + ".tmp", "JPEG", quality=INGEST_QUALITY, optimize=True)
+    except IngestError:
+        raise
+    except (Image.DecompressionBombError, OSError, SyntaxError, ValueError) as e:
+        raise IngestError(f"Could not decode image: {e}", status_code=400)
+
+    os.replace(out_path + ".tmp", out_path)
+    if out_path != path:
+        os.remove(path)
+    return out_path
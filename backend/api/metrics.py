@@ -0,0 +1,47 @@
+# metrics.py
+import os
+from prometheus_client import (
+    Histogram, Gauge, CollectorRegistry, REGISTRY, generate_latest, multiprocess, CONTENT_TYPE_LATEST
+)
+
+# With several server processes (uvicorn --workers), point PROMETHEUS_MULTIPROC_DIR at an empty
+# directory shared by them and /metrics aggregates every process
+MULTIPROCESS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REQUEST_SECONDS = Histogram(
+    "faceswap_api_request_seconds",
+    "API latency until response headers, by endpoint (publish, status, ...) and HTTP status",
+    ["endpoint", "code"],
+    buckets=REQUEST_BUCKETS,
+)
+QUEUE_DEPTH = Gauge(
+    "faceswap_queue_depth", "Ready messages in the job queue (read at scrape time)",
+    multiprocess_mode="mostrecent",
+)
+QUEUE_CONSUMERS = Gauge(
+    "faceswap_queue_consumers", "Worker consumers attached to the job queue (read at scrape time)",
+    multiprocess_mode="mostrecent",
+)
+SESSION_LOCKS = Gauge(
+    "faceswap_session_locks", "Session locks currently held, i.e. jobs in flight (read at scrape time)",
+    multiprocess_mode="mostrecent",
+)
+
+# Endpoints not worth a latency series
+UNTIMED_ENDPOINTS = {"metrics", "static"}
+
+
+def observe_request(endpoint, code, seconds):
+    if endpoint and endpoint not in UNTIMED_ENDPOINTS:
+        REQUEST_SECONDS.labels(endpoint, str(code)).observe(seconds)
+
+
+def render_metrics():
+    """Return (body, content type) for the /metrics endpoint."""
+    registry = REGISTRY
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,249 @@
+# publisher.py
+import queue
+import threading
+import pika
+from pika.exceptions import AMQPError
+
+# Errors after which a connection is discarded and the publish retried on a fresh one
+RECONNECT_ERRORS = (AMQPError, OSError)
+
+
+# ================== Pooled connection ==================
+class PooledChannel:
+    """One persistent BlockingConnection with a single channel"""
+
+    def __init__(self, params):
+        self.connection = pika.BlockingConnection(params)
+        self.channel = self.connection.channel()
+
+    @property
+    def is_open(self):
+        return self.connection.is_open and self.channel.is_open
+
+    def service(self):
+        """Let pika answer heartbeats and read pending frames; False once the connection is gone"""
+        try:
+            self.connection.process_data_events(time_limit=0)
+        except RECONNECT_ERRORS:
+            return False
+        return self.is_open
+
+    def close(self):
+        try:
+            if self.connection.is_open:
+                self.connection.close()
+        except Exception:
+            pass
+
+
+# ================== Channel pool ==================
+class ChannelPool:
+    """
+    Thread-safe pool of persistent RabbitMQ channels.
+    pika connections are not thread-safe, so each channel is checked out by
+    one request at a time. The queue is declared once per pool, and a publish
+    that hits a dead connection is retried once on a new connection.
+    BlockingConnections only answer heartbeats while pika runs, so connections
+    are serviced on checkout and check-in, and idle ones every KEEPALIVE_INTERVAL;
+    otherwise the broker drops them during quiet periods.
+    """
+
+    KEEPALIVE_INTERVAL = 10  # seconds; well inside RabbitMQ's default 60 s heartbeat
+
+    def __init__(self, url, queue_name, queue_args, size=4):
+        self.params = pika.URLParameters(url)
+        self.queue_name = queue_name
+        self.queue_args = queue_args
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._declare_lock = threading.Lock()
+        self._declared = False
+        self._closed = threading.Event()
+        self._keepalive_thread = threading.Thread(target=self._keepalive, name="rabbitmq-keepalive", daemon=True)
+        self._keepalive_thread.start()
+
+    def connect(self):
+        """Open a new pooled connection, declaring the queue the first time"""
+        pooled = PooledChannel(self.params)
+        if not self._declared:
+            with self._declare_lock:
+                if not self._declared:
+                    pooled.channel.queue_declare(queue=self.queue_name, durable=True, arguments=self.queue_args)
+                    self._declared = True
+        return pooled
+
+    def _acquire(self):
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    pooled = self._idle.get_nowait()
+                except queue.Empty:
+                    return self.connect()
+                # Also notices a connection the broker closed while it sat idle
+                if pooled.service():
+                    return pooled
+                pooled.close()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, pooled, broken=False):
+        if broken or not pooled.service():
+            pooled.close()
+        else:
+            self._idle.put(pooled)
+        self._slots.release()
+
+    def _keepalive(self):
+        """Service the heartbeats of idle connections; checked-out ones are serviced by their user"""
+        while not self._closed.wait(self.KEEPALIVE_INTERVAL):
+            taken = []
+            while self._slots.acquire(blocking=False):
+                try:
+                    taken.append(self._idle.get_nowait())
+                except queue.Empty:
+                    self._slots.release()
+                    break
+            # Put back in the same LIFO order; dead connections are closed and replaced on demand
+            for pooled in reversed(taken):
+                self._release(pooled)
+
+    def publish(self, body, properties):
+        """Publish one message to the job queue, reconnecting once if the pooled connection died"""
+        for attempt in range(2):
+            pooled = self._acquire()
+            try:
+                pooled.channel.basic_publish(
+                    exchange="",  # Default exchange (direct to queue)
+                    routing_key=self.queue_name,
+                    body=body,
+                    properties=properties
+                )
+            except RECONNECT_ERRORS:
+                self._release(pooled, broken=True)
+                if attempt == 1:
+                    raise
+                continue
+            self._release(pooled)
+            return
+
+    def queue_depth(self):
+        """(ready messages, consumers) of the job queue, read with a passive declare"""
+        pooled = self._acquire()
+        try:
+            declared = pooled.channel.queue_declare(queue=self.queue_name, passive=True)
+        except RECONNECT_ERRORS:
+            self._release(pooled, broken=True)
+            raise
+        self._release(pooled)
+        return declared.method.message_count, declared.method.consumer_count
+
+    def close(self):
+        self._closed.set()
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+# ================== Batched confirms ==================
+class PendingPublish:
+    def __init__(self, body, properties):
+        self.body = body
+        self.properties = properties
+        self.done = threading.Event()
+        self.error = None
+
+
+class ConfirmingPublisher:
+    """
+    Publisher with broker confirmation, batched across concurrent requests.
+    Requests hand their message to one publisher thread, which publishes
+    everything waiting on a transactional channel and commits once per batch.
+    pika's BlockingChannel.confirm_delivery() waits for each message's ack
+    separately, so a tx_commit per batch is what amortizes the round-trip.
+    Each request returns only after the commit that covers its message.
+    """
+
+    IDLE_POLL = 5  # seconds between heartbeat servicing while idle
+
+    def __init__(self, pool, max_batch=50, timeout=10):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self._pending = queue.Queue()
+        self._pooled = None
+        self._thread = threading.Thread(target=self._run, name="rabbitmq-confirms", daemon=True)
+        self._thread.start()
+
+    def publish(self, body, properties):
+        item = PendingPublish(body, properties)
+        self._pending.put(item)
+        if not item.done.wait(self.timeout):
+            raise TimeoutError("Timed out waiting for RabbitMQ to confirm the job")
+        if item.error is not None:
+            raise item.error
+
+    def _take_batch(self):
+        while True:
+            try:
+                batch = [self._pending.get(timeout=self.IDLE_POLL)]
+                break
+            except queue.Empty:
+                self._keepalive()
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._pending.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _keepalive(self):
+        """Let pika answer heartbeats so the idle connection is not dropped by the broker"""
+        if self._pooled is None:
+            return
+        try:
+            self._pooled.connection.process_data_events(time_limit=0)
+        except RECONNECT_ERRORS:
+            self._pooled.close()
+            self._pooled = None
+
+    def _commit(self, batch):
+        if self._pooled is None or not self._pooled.is_open:
+            self._pooled = self.pool.connect()
+            self._pooled.channel.tx_select()
+        channel = self._pooled.channel
+        for item in batch:
+            channel.basic_publish(
+                exchange="",
+                routing_key=self.pool.queue_name,
+                body=item.body,
+                properties=item.properties
+            )
+        channel.tx_commit()
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            for attempt in range(2):
+                try:
+                    self._commit(batch)
+                    break
+                except RECONNECT_ERRORS as e:
+                    # An uncommitted transaction is discarded with its connection; a retry can only
+                    # duplicate messages if the broker committed but the commit-ok was lost
+                    if self._pooled is not None:
+                        self._pooled.close()
+                    self._pooled = None
+                    if attempt == 1:
+                        for item in batch:
+                            item.error = e
+                except Exception as e:
+                    for item in batch:
+                        item.error = e
+                    break
+            for item in batch:
+                item.done.set()
@@ -1,18 +1,67 @@
 # server.py
 import datetime
-from flask import Flask, request, jsonify, send_file
+import json
+import time
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context, g
+from werkzeug.security import safe_join
 import uuid
+import shutil
 import os
-from helpers import publish_job, acquire_lock, release_lock
-from db import jobs_collection  
+from helpers import (
+    publish_job, acquire_lock, release_lock,
+    redis_client, status_channel, status_payload, TERMINAL_STATUSES,
+    cache_status, get_cached_status, finish_jobs, check_admission, record_admission, refresh_queue_metrics, parse_face_map,
+    busy_response, ingest_uploads, new_job, publish_failed_update, accepted_body
+)
+from ingest import IngestError
+from metrics import observe_request, render_metrics
+from db import jobs_collection, find_status, BATCH_JOB_PREFIX, VIDEO_JOB_PREFIX
 from oauth_routes import register_oauth_routes
 
 app = Flask(__name__)
 
-# Disable response caching globally
+# Push-based status: how long a stream / long-poll may stay open, and the SSE keepalive interval
+STATUS_STREAM_TIMEOUT = int(os.getenv("STATUS_STREAM_TIMEOUT", 300))
+STATUS_WAIT_MAX = int(os.getenv("STATUS_WAIT_MAX", 30))
+STATUS_HEARTBEAT = int(os.getenv("STATUS_HEARTBEAT", 15))
+
+# Suggested client poll interval (Retry-After) while a job is still processing
+STATUS_RETRY_AFTER = int(os.getenv("STATUS_RETRY_AFTER", 2))
+
+# /publish_batch: destination images per job
+MAX_BATCH_TARGETS = int(os.getenv("MAX_BATCH_TARGETS", 10))
+
+# /publish faceMap: swaps per job
+MAX_FACE_SWAPS = int(os.getenv("MAX_FACE_SWAPS", 8))
+
+# Result files are named after their job and never rewritten, so clients and proxies may keep them
+RESULTS_DIR = "/tmp/results"
+RESULT_MAX_AGE = int(os.getenv("RESULT_MAX_AGE", 365 * 24 * 3600))
+RESULT_CACHE_CONTROL = f"public, max-age={RESULT_MAX_AGE}, immutable"
+CACHEABLE_ENDPOINTS = {"serve_result"}
+
+def result_etag(filename):
+    """Strong ETag for a result file: its name is <jobId>[_thumb].<ext> and is never reused"""
+    return f"result-{filename}"
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    """Per-endpoint latency histogram (publish, status, ...) for /metrics"""
+    started = g.get("request_started")
+    if started is not None:
+        observe_request(request.endpoint, response.status_code, time.perf_counter() - started)
+    return response
+
+# Disable response caching for everything dynamic (status, publish, internal endpoints)
 @app.after_request
 def add_no_cache_headers(response):
-    """Add no-cache headers to all responses"""
+    """Add no-cache headers to all responses except immutable result files"""
+    if request.endpoint in CACHEABLE_ENDPOINTS:
+        return response
     response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
     response.headers['Pragma'] = 'no-cache'
     response.headers['Expires'] = '0'
@@ -30,25 +79,48 @@ def health():
     return jsonify({"status": "ok", "service": "flask-api", "random": random_value}), 200
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus metrics. Queue depth, consumers and held session locks are read at scrape time."""
+    refresh_queue_metrics()
+    body, content_type = render_metrics()
+    return Response(body, headers={"Content-Type": content_type})
+
+
 @app.route("/publish", methods=["POST"])
 def publish():
     """
-     Receive two images + sessionId (multipart/form-data).
+     Receive two images + sessionId (multipart/form-data), and optionally a faceMap
+     (JSON [[sourceFace, destFace], ...]) to swap several faces of image1 into image2 at once.
+    - Reject with 503 + Retry-After when the queue backlog would outlast the message TTL.
     - Enforce one active job per session (via Redis/Redlock).
     - Save files safely to /tmp/<job_id>/...
+    - Normalize both images (real format check, EXIF orientation, max edge, JPEG).
     - Create job record in MongoDB.
     - Publish job to RabbitMQ for processing.
-    Returns: { "status": "processing", "jobId": "<uuid>" }
+    Returns: { "status": "processing", "jobId": "<uuid>", "etaSeconds": <float|null> }
     """
 
+    # Shed load before reading the upload if the job would expire in the queue anyway
+    admitted, eta, retry_after = check_admission()
+    if not admitted:
+        body, headers = busy_response(eta, retry_after)
+        return jsonify(body), 503, headers
+
     session_id = request.form.get("sessionId")
     if not session_id:
         return jsonify({"error": "Missing sessionId"}), 400
 
+    try:
+        face_map = parse_face_map(request.form.get("faceMap"), MAX_FACE_SWAPS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
     #  Acquire lock (one active job per session)
     lock = acquire_lock(session_id)
     if not lock:
         return jsonify({"error": "Previous job still processing"}), 429
+    record_admission()
 
     if "image1" not in request.files or "image2" not in request.files:
         release_lock(session_id)
@@ -85,42 +157,43 @@ def publish():
         release_lock(session_id)
         return jsonify({"error": f"Failed to save files: {e}"}), 500
 
+    # Re-encode once here so the worker never decodes an oversized or mislabeled upload
+    try:
+        (img1_path, img2_path), ingest_ms = ingest_uploads([img1_path, img2_path])
+    except IngestError as e:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        release_lock(session_id)
+        return jsonify({"error": str(e)}), e.status_code
+
     #  Create MongoDB record
+    job, initial_status = new_job(job_id, session_id, ingest_ms)
     try:
-        from datetime import datetime
-        now = datetime.utcnow()
-
-        jobs_collection.insert_one({
-            "sessionId": session_id,
-            "jobId": job_id,
-            "status": "processing",  # frontend expects "processing" or "completed"
-            "resultUrl": None,
-            "createdAt": now,
-            "updatedAt": now
-        })
+        jobs_collection.insert_one(job)
     except Exception as e:
+        shutil.rmtree(job_dir, ignore_errors=True)
         release_lock(session_id)
         return jsonify({"error": f"DB error: {e}"}), 500
 
+    # Seed the status cache before the worker can see the job, so its update always lands last
+    cache_status(job_id, initial_status)
+
     #  Publish to RabbitMQ (worker will process)
     try:
         publish_job(
             job_id=job_id,
             img1_path=img1_path,
             img2_path=img2_path,
-            session_id=session_id
+            session_id=session_id,
+            face_map=face_map
         )
     except Exception as e:
-        jobs_collection.update_one(
-            {"jobId": job_id},
-            {"$set": {"status": "error", "updatedAt": datetime.utcnow()}}
-        )
+        jobs_collection.update_one({"jobId": job_id}, publish_failed_update())
         release_lock(session_id)
         return jsonify({"error": f"Failed to publish job: {e}"}), 500
 
     
     # Create response with explicit no-cache headers
-    response = jsonify({"status": "processing", "jobId": job_id})
+    response = jsonify(accepted_body(job_id, eta))
     response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate'
     response.headers['Pragma'] = 'no-cache'
     response.headers['Expires'] = '0'
@@ -128,26 +201,274 @@ def publish():
     return response, 200
 
 
+@app.route("/publish_batch", methods=["POST"])
+def publish_batch():
+    """
+     Receive one source image + up to MAX_BATCH_TARGETS destination images + sessionId
+     (multipart/form-data: `source`, `targets` repeated once per image).
+    - One job for all targets: the worker detects the source face once, then swaps it
+      onto each target in turn and reports every target's result as soon as it is ready.
+    - Same admission control, session lock and image normalization as /publish.
+    Returns: { "status": "processing", "jobId": "batch-<uuid>", "targets": <n>, "etaSeconds": <float|null> }
+    """
+    admitted, eta, retry_after = check_admission()
+    if not admitted:
+        body, headers = busy_response(eta, retry_after)
+        return jsonify(body), 503, headers
+
+    session_id = request.form.get("sessionId")
+    if not session_id:
+        return jsonify({"error": "Missing sessionId"}), 400
+
+    targets = request.files.getlist("targets")
+    if "source" not in request.files or not targets:
+        return jsonify({"error": "Missing source or targets"}), 400
+    if len(targets) > MAX_BATCH_TARGETS:
+        return jsonify({"error": f"Too many targets (max {MAX_BATCH_TARGETS})"}), 400
+
+    lock = acquire_lock(session_id)
+    if not lock:
+        return jsonify({"error": "Previous job still processing"}), 429
+    record_admission()
+
+    job_id = f"{BATCH_JOB_PREFIX}{uuid.uuid4()}"
+    print(f"🆕 Generated NEW batch job_id: {job_id} for session: {session_id} ({len(targets)} targets)")
+
+    job_dir = f"/tmp/{job_id}"
+    try:
+        os.makedirs(job_dir, exist_ok=True)
+    except Exception as e:
+        release_lock(session_id)
+        return jsonify({"error": f"Failed to create job dir: {e}"}), 500
+
+    try:
+        paths = []
+        for name, upload in [("source", request.files["source"])] + [("targets", target) for target in targets]:
+            ext = os.path.splitext(upload.filename)[1] or ".jpg"
+            path = os.path.join(job_dir, f"{name}_{uuid.uuid4().hex}{ext}")
+            upload.save(path)
+            paths.append(path)
+    except Exception as e:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        release_lock(session_id)
+        return jsonify({"error": f"Failed to save files: {e}"}), 500
+
+    try:
+        (source_path, *target_paths), ingest_ms = ingest_uploads(paths)
+    except IngestError as e:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        release_lock(session_id)
+        return jsonify({"error": str(e)}), e.status_code
+
+    job, initial_status = new_job(job_id, session_id, ingest_ms, target_count=len(target_paths))
+    try:
+        jobs_collection.insert_one(job)
+    except Exception as e:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        release_lock(session_id)
+        return jsonify({"error": f"DB error: {e}"}), 500
+
+    cache_status(job_id, initial_status)
+
+    try:
+        publish_job(job_id=job_id, img1_path=source_path, img2_path=None, session_id=session_id, target_paths=target_paths)
+    except Exception as e:
+        jobs_collection.update_one({"jobId": job_id}, publish_failed_update())
+        release_lock(session_id)
+        return jsonify({"error": f"Failed to publish job: {e}"}), 500
+
+    return jsonify(accepted_body(job_id, eta, target_count=len(target_paths))), 200
+
+
+@app.route("/publish_video", methods=["POST"])
+def publish_video():
+    """
+     Receive one source image + one clip + sessionId (multipart/form-data: `source`, `video`).
+    - The worker swaps the source face onto a tracked face in every frame (MP4 / MOV / WebM
+      come back as MP4, GIF as GIF) and reports progress as it goes.
+    - Same admission control and session lock as /publish; the source is normalized,
+      the clip is only checked (real format, MAX_VIDEO_BYTES).
+    Returns: { "status": "processing", "jobId": "video-<uuid>", "etaSeconds": <float|null> }
+    """
+    admitted, eta, retry_after = check_admission()
+    if not admitted:
+        body, headers = busy_response(eta, retry_after)
+        return jsonify(body), 503, headers
+
+    session_id = request.form.get("sessionId")
+    if not session_id:
+        return jsonify({"error": "Missing sessionId"}), 400
+
+    if "source" not in request.files or "video" not in request.files:
+        return jsonify({"error": "Missing source or video"}), 400
+
+    lock = acquire_lock(session_id)
+    if not lock:
+        return jsonify({"error": "Previous job still processing"}), 429
+    record_admission()
+
+    job_id = f"{VIDEO_JOB_PREFIX}{uuid.uuid4()}"
+    print(f"🆕 Generated NEW video job_id: {job_id} for session: {session_id}")
+
+    job_dir = f"/tmp/{job_id}"
+    try:
+        os.makedirs(job_dir, exist_ok=True)
+    except Exception as e:
+        release_lock(session_id)
+        return jsonify({"error": f"Failed to create job dir: {e}"}), 500
+
+    try:
+        paths = {}
+        for name in ("source", "video"):
+            upload = request.files[name]
+            ext = os.path.splitext(upload.filename)[1] or (".jpg" if name == "source" else ".mp4")
+            paths[name] = os.path.join(job_dir, f"{name}_{uuid.uuid4().hex}{ext}")
+            upload.save(paths[name])
+    except Exception as e:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        release_lock(session_id)
+        return jsonify({"error": f"Failed to save files: {e}"}), 500
+
+    try:
+        (source_path,), ingest_ms = ingest_uploads([paths["source"]], video_path=paths["video"])
+    except IngestError as e:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        release_lock(session_id)
+        return jsonify({"error": str(e)}), e.status_code
+
+    job, initial_status = new_job(job_id, session_id, ingest_ms, video=True)
+    try:
+        jobs_collection.insert_one(job)
+    except Exception as e:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        release_lock(session_id)
+        return jsonify({"error": f"DB error: {e}"}), 500
+
+    cache_status(job_id, initial_status)
+
+    try:
+        publish_job(job_id=job_id, img1_path=source_path, img2_path=None, session_id=session_id, video_path=paths["video"])
+    except Exception as e:
+        jobs_collection.update_one({"jobId": job_id}, publish_failed_update())
+        release_lock(session_id)
+        return jsonify({"error": f"Failed to publish job: {e}"}), 500
+
+    return jsonify(accepted_body(job_id, eta)), 200
+
+
 @app.route("/status/<job_id>", methods=["GET"])
 def status(job_id):
 
     """
-    Return job status from MongoDB in the exact shape frontend expects:
+    Return job status in the exact shape frontend expects:
     - { "status": "processing" }
     - or { "status": "completed", "image_url": "<url>" }
     - or { "status": "not_found" }
+    Served from the status cache when possible, MongoDB otherwise.
+    X-Cache says which; Retry-After suggests when to poll again while processing.
+    """
+
+    payload = get_cached_status(job_id)
+    cache_state = "HIT"
+    if payload is None:
+        cache_state = "MISS"
+        job = find_status(job_id)
+        if not job:
+            return jsonify({"status": "not_found"}), 404
+        payload = status_payload(job)
+        cache_status(job_id, payload, only_if_missing=True)
+
+    response = jsonify(payload)
+    response.headers["X-Cache"] = cache_state
+    if payload["status"] not in TERMINAL_STATUSES:
+        response.headers["Retry-After"] = str(STATUS_RETRY_AFTER)
+    return response, 200
+
+
+def subscribe_status(job_id):
+    """
+    Subscribe to a job's status channel, then read its current state once.
+    Subscribing first means a change published in between is not missed.
+    Returns (pubsub, payload) or (None, None) if the job does not exist.
     """
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(status_channel(job_id))
 
-    job = jobs_collection.find_one({"jobId": job_id}, {"_id": 0})
+    job = find_status(job_id)
     if not job:
+        pubsub.close()
+        return None, None
+    return pubsub, status_payload(job)
+
+
+@app.route("/status/<job_id>/stream", methods=["GET"])
+def status_stream(job_id):
+    """
+    Server-Sent Events stream of a job's status.
+    Sends the current status immediately, then every change pushed through
+    Redis, and closes after a terminal status (completed / failed).
+    Each event's data has the same shape as the /status response.
+    """
+    pubsub, payload = subscribe_status(job_id)
+    if pubsub is None:
         return jsonify({"status": "not_found"}), 404
 
-    if job.get("status") == "completed":
-        return jsonify({"status": "completed", "image_url": job.get("resultUrl")}), 200
-    elif job.get("status") == "failed":
-        return jsonify({"status": "failed", "error": job.get("error")}), 200
-    else:
-        return jsonify({"status": "processing"}), 200
+    def events():
+        try:
+            yield f"data: {json.dumps(payload)}\n\n"
+            if payload["status"] in TERMINAL_STATUSES:
+                return
+
+            deadline = time.monotonic() + STATUS_STREAM_TIMEOUT
+            while time.monotonic() < deadline:
+                message = pubsub.get_message(timeout=STATUS_HEARTBEAT)
+                if message is None:
+                    # Keep proxies from closing an idle connection
+                    yield ": keepalive\n\n"
+                    continue
+
+                update = json.loads(message["data"])
+                yield f"data: {json.dumps(update)}\n\n"
+                if update.get("status") in TERMINAL_STATUSES:
+                    return
+        finally:
+            pubsub.close()
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"X-Accel-Buffering": "no"}
+    )
+
+
+@app.route("/status/<job_id>/wait", methods=["GET"])
+def status_wait(job_id):
+    """
+    Long-poll variant of /status: returns as soon as the job reaches a terminal
+    status, or its current status after ?timeout= seconds (max STATUS_WAIT_MAX).
+    """
+    try:
+        timeout = min(float(request.args.get("timeout", STATUS_WAIT_MAX)), STATUS_WAIT_MAX)
+    except ValueError:
+        return jsonify({"error": "Invalid timeout"}), 400
+
+    pubsub, payload = subscribe_status(job_id)
+    if pubsub is None:
+        return jsonify({"status": "not_found"}), 404
+
+    try:
+        deadline = time.monotonic() + timeout
+        while payload["status"] not in TERMINAL_STATUSES:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            message = pubsub.get_message(timeout=remaining)
+            if message is not None:
+                payload = json.loads(message["data"])
+    finally:
+        pubsub.close()
+
+    return jsonify(payload), 200
 
 
 @app.route("/update_status", methods=["POST"])
@@ -158,28 +479,17 @@ def update_status():
     data = request.get_json(force=True)
     job_id = data.get("jobId")
     result_url = data.get("resultUrl")
-
+    thumbnail_url = data.get("thumbnailUrl")
 
     if not job_id or not result_url:
         return jsonify({"error": "Missing jobId or resultUrl"}), 400
 
-    job = jobs_collection.find_one({"jobId": job_id})
-    if not job:
+    # One find_one_and_update + one Redis pipeline (lock release, status cache, push)
+    if not finish_jobs([{
+        "jobId": job_id, "status": "completed", "resultUrl": result_url, "thumbnailUrl": thumbnail_url
+    }]):
         return jsonify({"error": "Job not found"}), 404
 
-    session_id = job.get("sessionId")
-
-    jobs_collection.update_one(
-        {"jobId": job_id},
-        {"$set": {"status": "completed", "resultUrl": result_url}}
-    )
-
-    # Release session lock (worker finished)
-    try:
-        release_lock(session_id)
-    except Exception as e:
-        print(f" Failed to release lock: {e}")
-
     return jsonify({"status": "updated"}), 200
 
 
@@ -196,40 +506,71 @@ def update_error():
     if not job_id:
         return jsonify({"error": "Missing jobId"}), 400
     
-    job = jobs_collection.find_one({"jobId": job_id})
-    if not job:
+    if not finish_jobs([{"jobId": job_id, "status": "failed", "error": error}]):
         return jsonify({"error": "Job not found"}), 404
     
-    session_id = job.get("sessionId")
-    
-    # Update job status to failed
-    jobs_collection.update_one(
+    return jsonify({"status": "updated"}), 200
+
+
+@app.route("/complete_jobs", methods=["POST"])
+def complete_jobs():
+    """
+    INTERNAL batched completion endpoint for workers.
+    Body: {"jobs": [{"jobId", "status": "completed", "resultUrl", "thumbnailUrl"?} |
+                    {"jobId", "status": "failed", "error", "technicalError"}, ...]}
+    """
+    data = request.get_json(force=True)
+    completions = data.get("jobs") if isinstance(data, dict) else None
+    if not isinstance(completions, list) or not completions:
+        return jsonify({"error": "Missing jobs"}), 400
+
+    for completion in completions:
+        if not isinstance(completion, dict) or not completion.get("jobId"):
+            return jsonify({"error": "Each job needs a jobId"}), 400
+        if completion.get("status") == "completed" and not completion.get("resultUrl"):
+            return jsonify({"error": f"Missing resultUrl for job {completion['jobId']}"}), 400
+
+    updated = finish_jobs(completions)
+    found = set(updated)
+    not_found = [c["jobId"] for c in completions if c["jobId"] not in found]
+    return jsonify({"updated": updated, "notFound": not_found}), 200
+
+
+@app.route("/jobs/<job_id>/timings", methods=["GET"])
+def job_timings(job_id):
+    """
+    INTERNAL endpoint: per-stage timings of one job (ms), recorded by the API
+    (ingest) and the worker (queue wait, decode, detect, swap, encode, upload, status update).
+    """
+    job = jobs_collection.find_one(
         {"jobId": job_id},
-        {"$set": {
-            "status": "failed",
-            "error": error or "Processing failed",
-            "updatedAt": datetime.utcnow()
-        }}
+        {"_id": 0, "jobId": 1, "status": 1, "timings": 1, "createdAt": 1, "updatedAt": 1}
     )
-    
-    # Release session lock
-    try:
-        release_lock(session_id)
-    except Exception as e:
-        print(f"❌ Failed to release lock: {e}")
-    
-    return jsonify({"status": "updated"}), 200
+    if not job:
+        return jsonify({"status": "not_found"}), 404
+
+    for field in ("createdAt", "updatedAt"):
+        if isinstance(job.get(field), datetime.datetime):
+            job[field] = job[field].isoformat() + "Z"
+    job.setdefault("timings", {})
+    return jsonify(job), 200
 
 
 @app.route("/results/<filename>", methods=["GET"])
 def serve_result(filename):
-    """Serve result images (fallback if Firebase is unavailable)"""
+    """
+    Serve result images (fallback if Google Drive is unavailable).
+    Strong ETag + If-None-Match (304), Range requests (206) and immutable caching;
+    the body goes out through the server's file wrapper (sendfile under gunicorn).
+    """
     try:
-        file_path = f"/tmp/results/{filename}"
-        if not os.path.exists(file_path):
+        file_path = safe_join(RESULTS_DIR, filename)
+        if file_path is None or not os.path.isfile(file_path):
             return jsonify({"error": "File not found"}), 404
-        
-        return send_file(file_path, mimetype="image/jpeg")
+
+        response = send_file(file_path, conditional=True, etag=result_etag(filename), max_age=RESULT_MAX_AGE)
+        response.cache_control.immutable = True
+        return response
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -0,0 +1,155 @@
+# uploads.py
+import os
+import uuid
+from python_multipart.multipart import MultipartParser, parse_options_header
+from ingest import SNIFF_BYTES, MAX_VIDEO_BYTES, check_image_head, check_video_head, IngestError
+
+# Per-file upload limit; larger parts abort the request with 413
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 20 * 1024 * 1024))
+MAX_FIELD_BYTES = 4096
+
+
+class UploadError(Exception):
+    """Malformed or rejected upload; status_code is the HTTP status to return."""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class StreamingFormParser:
+    """
+    Push-style multipart/form-data parser that writes file parts straight to
+    disk as chunks arrive, so an upload never sits in memory and a slow client
+    costs an open file instead of a thread.
+
+    Files are written to <job_dir>/<field>_<uuid><ext>, same as the Flask /publish.
+    A file part whose first bytes are not a supported image is rejected with
+    415 as soon as they arrive, before the rest of the upload is read.
+    A field may repeat (e.g. /publish_batch targets): `files` keeps the last
+    part per name, `file_list` every part in order.
+    Fields named in video_fields (e.g. /publish_video's clip) are checked as
+    videos instead, against MAX_VIDEO_BYTES.
+    """
+
+    def __init__(self, content_type, job_dir, max_file_bytes=MAX_UPLOAD_BYTES, max_files=None, video_fields=()):
+        mime, params = parse_options_header(content_type or "")
+        boundary = params.get(b"boundary")
+        if mime != b"multipart/form-data" or not boundary:
+            raise UploadError("Expected multipart/form-data")
+
+        self.job_dir = job_dir
+        self.max_file_bytes = max_file_bytes
+        self.max_files = max_files
+        self.video_fields = video_fields
+        self.fields = {}
+        self.files = {}  # field name -> {"filename", "path", "size"}
+        self.file_list = []  # (field name, same dict) per file part
+
+        self._header_field = b""
+        self._header_value = b""
+        self._headers = {}
+        self._part = None
+        self._parser = MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+        })
+
+    def write(self, chunk):
+        self._parser.write(chunk)
+
+    def finalize(self):
+        self._parser.finalize()
+        if self._part is not None:
+            raise UploadError("Truncated multipart body")
+
+    def cleanup(self):
+        """Close and delete everything written so far."""
+        if self._part and self._part.get("file"):
+            self._part["file"].close()
+        for _, info in self.file_list:
+            try:
+                os.remove(info["path"])
+            except OSError:
+                pass
+
+    # ---------- parser callbacks ----------
+    def _on_part_begin(self):
+        self._headers = {}
+        self._part = None
+
+    def _on_header_field(self, data, start, end):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.strip().lower()] = self._header_value.strip()
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        name = options.get(b"name", b"").decode("utf-8", "replace")
+        if not name:
+            raise UploadError("Multipart part without a name")
+
+        if b"filename" in options:
+            if self.max_files is not None and len(self.file_list) >= self.max_files:
+                raise UploadError(f"Too many files (max {self.max_files})")
+            filename = options[b"filename"].decode("utf-8", "replace")
+            ext = os.path.splitext(filename)[1] or ".jpg"
+            path = os.path.join(self.job_dir, f"{name}_{uuid.uuid4().hex}{ext}")
+            self._part = {
+                "name": name, "filename": filename, "path": path, "size": 0, "head": b"",
+                "video": name in self.video_fields, "file": open(path, "wb")
+            }
+            self.files[name] = {"filename": filename, "path": path, "size": 0}
+            self.file_list.append((name, self.files[name]))
+        else:
+            self._part = {"name": name, "value": b""}
+
+    def _on_part_data(self, data, start, end):
+        part = self._part
+        chunk = data[start:end]
+
+        if "file" in part:
+            part["size"] += len(chunk)
+            max_bytes = MAX_VIDEO_BYTES if part["video"] else self.max_file_bytes
+            if part["size"] > max_bytes:
+                raise UploadError(f"{part['name']} exceeds {max_bytes} bytes", status_code=413)
+            if len(part["head"]) < SNIFF_BYTES:
+                part["head"] += chunk[:SNIFF_BYTES - len(part["head"])]
+                if len(part["head"]) == SNIFF_BYTES:
+                    self._check_head(part)
+            part["file"].write(chunk)
+        else:
+            part["value"] += chunk
+            if len(part["value"]) > MAX_FIELD_BYTES:
+                raise UploadError(f"Field {part['name']} is too large", status_code=413)
+
+    def _on_part_end(self):
+        part = self._part
+        if "file" in part:
+            part["file"].close()
+            if len(part["head"]) < SNIFF_BYTES:
+                self._check_head(part)
+            self.files[part["name"]]["size"] = part["size"]
+        else:
+            self.fields[part["name"]] = part["value"].decode("utf-8", "replace")
+        self._part = None
+
+    def _check_head(self, part):
+        try:
+            if part["video"]:
+                check_video_head(part["name"], part["head"])
+            else:
+                check_image_head(part["name"], part["head"])
+        except IngestError as e:
+            raise UploadError(str(e), status_code=e.status_code)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+End-to-end load test: /publish then /status until each job completes.
+
+Run it against the load-test stack (local Redis + MongoDB, stub swapper worker),
+so the numbers show the queueing / storage / status path at a known service time:
+
+    docker-compose -f docker-compose.yml -f docker-compose.loadtest.yml up -d --build
+    python benchmarks/load_test.py --url http://localhost:8000 --rate 5 --duration 60
+
+--rate N sends jobs as a Poisson process at N jobs/s (open loop), with at most
+--concurrency jobs in flight; latency is measured from each job's scheduled
+arrival, so time spent waiting for a free client slot counts. --rate 0 runs
+--concurrency closed-loop clients instead, each starting a new job as soon as
+its previous one finishes.
+
+Every job gets its own sessionId, so the per-session lock never rejects one.
+Reports end-to-end and /publish latency (p50/p95/p99), completed jobs/s and the
+outcome of every job: completed, failed, rejected (503), busy (429), timeout, ...
+"""
+
+import io
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+TERMINAL_STATUSES = ("completed", "failed")
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    idx = min(int(round(pct / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[idx]
+
+
+def load_image(path, size):
+    """Image bytes for both uploads: the given file, or a generated JPEG (ingest rejects non-images)"""
+    if path:
+        with open(path, "rb") as f:
+            return f.read()
+    from PIL import Image
+
+    img = Image.linear_gradient("L").resize((size, size)).convert("RGB")
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=90)
+    return buf.getvalue()
+
+
+def build_body(boundary, session_id, image):
+    parts = [
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"sessionId\"\r\n\r\n{session_id}\r\n".encode()
+    ]
+    for name in ("image1", "image2"):
+        parts.append(
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"{name}\"; filename=\"{name}.jpg\"\r\n"
+            f"Content-Type: image/jpeg\r\n\r\n".encode() + image + b"\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts)
+
+
+def http(method, url, body=None, headers=None, timeout=60):
+    """Returns (status code, parsed JSON body or None, headers)"""
+    req = urllib.request.Request(url, data=body, headers=headers or {}, method=method)
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return resp.status, json.loads(resp.read() or b"null"), resp.headers
+    except urllib.error.HTTPError as e:
+        try:
+            payload = json.loads(e.read() or b"null")
+        except ValueError:
+            payload = None
+        return e.code, payload, e.headers
+
+
+class LoadTest:
+    def __init__(self, args, image):
+        self.args = args
+        self.image = image
+        self.lock = threading.Lock()
+        self.outcomes = Counter()
+        self.e2e_ms = []
+        self.publish_ms = []
+        self.completed_at = []
+
+    def record(self, outcome, e2e_ms=None, publish_ms=None):
+        with self.lock:
+            self.outcomes[outcome] += 1
+            if publish_ms is not None:
+                self.publish_ms.append(publish_ms)
+            if outcome == "completed":
+                self.e2e_ms.append(e2e_ms)
+                self.completed_at.append(time.perf_counter())
+
+    def run_job(self, scheduled):
+        """One job from its scheduled arrival (perf_counter) until a terminal status or --job-timeout"""
+        try:
+            self._run_job(scheduled)
+        except Exception as e:
+            self.record(f"error:{type(e).__name__}")
+
+    def _run_job(self, scheduled):
+        args = self.args
+        boundary = uuid.uuid4().hex
+        body = build_body(boundary, f"load-{uuid.uuid4().hex}", self.image)
+
+        started = time.perf_counter()
+        code, payload, _ = http(
+            "POST", f"{args.url}/publish", body,
+            {"Content-Type": f"multipart/form-data; boundary={boundary}"},
+        )
+        publish_ms = (time.perf_counter() - started) * 1000
+        if code != 200:
+            self.record({503: "rejected", 429: "busy"}.get(code, f"http_{code}"), publish_ms=publish_ms)
+            return
+
+        job_id = payload["jobId"]
+        deadline = scheduled + args.job_timeout
+        status = payload.get("status")
+        while status not in TERMINAL_STATUSES:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                self.record("timeout", publish_ms=publish_ms)
+                return
+            if args.mode == "wait":
+                code, payload, _ = http(
+                    "GET", f"{args.url}/status/{job_id}/wait?timeout={min(remaining, 30):.1f}", timeout=remaining + 10
+                )
+            else:
+                time.sleep(min(args.poll_interval, remaining))
+                code, payload, _ = http("GET", f"{args.url}/status/{job_id}")
+            if code != 200:
+                self.record(f"status_http_{code}", publish_ms=publish_ms)
+                return
+            status = payload.get("status")
+
+        self.record(status, (time.perf_counter() - scheduled) * 1000, publish_ms)
+
+    def open_loop(self, pool, started):
+        """Poisson arrivals at --rate jobs/s for --duration seconds (or --jobs jobs)"""
+        args = self.args
+        sent = 0
+        next_arrival = started
+        end = started + args.duration
+        while next_arrival < end and (not args.jobs or sent < args.jobs):
+            delay = next_arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(self.run_job, next_arrival)
+            sent += 1
+            next_arrival += random.expovariate(args.rate)
+        return sent
+
+    def closed_loop(self, pool, started):
+        """--concurrency clients, each running jobs back to back until --duration (or --jobs in total)"""
+        args = self.args
+        end = started + args.duration
+        sent = Counter()
+
+        def client():
+            while time.perf_counter() < end:
+                with self.lock:
+                    if args.jobs and sent["jobs"] >= args.jobs:
+                        return
+                    sent["jobs"] += 1
+                self.run_job(time.perf_counter())
+
+        for _ in range(args.concurrency):
+            pool.submit(client)
+        pool.shutdown(wait=True)
+        return sent["jobs"]
+
+    def run(self):
+        args = self.args
+        started = time.perf_counter()
+        pool = ThreadPoolExecutor(max_workers=args.concurrency)
+        if args.rate > 0:
+            sent = self.open_loop(pool, started)
+        else:
+            sent = self.closed_loop(pool, started)
+        arrivals_done = time.perf_counter()
+        pool.shutdown(wait=True)
+        return self.report(sent, started, arrivals_done)
+
+    def report(self, sent, started, arrivals_done):
+        args = self.args
+        e2e = sorted(self.e2e_ms)
+        publish = sorted(self.publish_ms)
+        completed = self.outcomes["completed"]
+        # Throughput over the window in which jobs were both sent and finishing
+        window = (max(self.completed_at) if self.completed_at else arrivals_done) - started
+        return {
+            "url": args.url,
+            "mode": args.mode,
+            "arrival": f"open loop, {args.rate}/s" if args.rate > 0 else "closed loop",
+            "concurrency": args.concurrency,
+            "jobs": sent,
+            "offered_per_s": round(sent / max(arrivals_done - started, 1e-9), 2),
+            "completed_per_s": round(completed / max(window, 1e-9), 2),
+            "error_rate": round((sent - completed) / sent, 4) if sent else 0.0,
+            "outcomes": dict(self.outcomes),
+            "e2e_ms": {
+                "p50": round(percentile(e2e, 50), 1),
+                "p95": round(percentile(e2e, 95), 1),
+                "p99": round(percentile(e2e, 99), 1),
+                "max": round(e2e[-1], 1) if e2e else 0.0,
+            },
+            "publish_ms": {
+                "p50": round(percentile(publish, 50), 1),
+                "p95": round(percentile(publish, 95), 1),
+                "p99": round(percentile(publish, 99), 1),
+                "max": round(publish[-1], 1) if publish else 0.0,
+            },
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--rate", type=float, default=2, help="Arrivals per second (0 = closed loop)")
+    parser.add_argument("--concurrency", type=int, default=64, help="Max jobs in flight / closed-loop clients")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to keep sending jobs")
+    parser.add_argument("--jobs", type=int, default=0, help="Stop after this many jobs (0 = no limit)")
+    parser.add_argument("--mode", choices=("wait", "poll"), default="wait",
+                        help="wait: long-poll /status/<id>/wait; poll: GET /status/<id> every --poll-interval")
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--job-timeout", type=float, default=300, help="Give up on a job after this many seconds")
+    parser.add_argument("--image", help="Image to upload as both image1 and image2 (default: generated JPEG)")
+    parser.add_argument("--size", type=int, default=640, help="Edge of the generated JPEG")
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    result = LoadTest(args, load_image(args.image, args.size)).run()
+
+    print(f"{result['arrival']}, concurrency {result['concurrency']}, {result['mode']} mode: {result['jobs']} jobs")
+    print(f"offered {result['offered_per_s']}/s  completed {result['completed_per_s']}/s  "
+          f"error rate {result['error_rate']:.2%}")
+    print(f"outcomes: {result['outcomes']}")
+    print(f"{'latency (ms)':<14}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for name in ("e2e_ms", "publish_ms"):
+        r = result[name]
+        print(f"{name:<14}{r['p50']:>10}{r['p95']:>10}{r['p99']:>10}{r['max']:>10}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
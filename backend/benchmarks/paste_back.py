@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Paste-back benchmark: full-frame blend (swapper.get(paste_back=True)) vs the ROI-limited
+face_swap.paste_back, over image sizes x face sizes.
+
+For every case it times both paths on the same swapper output and checks that the
+ROI result stays equivalent: max absolute difference, share of differing pixels and
+PSNR against the full-frame result. The swapper output and its alignment matrix are
+synthetic (a random 128x128 face, centred and slightly rotated), so no models are
+needed, only the worker requirements (WORKER_DIR points at the worker code, default ../worker):
+
+    python benchmarks/paste_back.py --sizes 640,1280,1920,3840 --faces 0.1,0.25,0.5 --json paste_back.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+WORKER_DIR = os.getenv("WORKER_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "worker"))
+sys.path.insert(0, WORKER_DIR)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    idx = min(int(round(pct / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[idx]
+
+
+def timeit(fn, repeat, warmup):
+    """Run fn warmup + repeat times; returns latency stats in ms over the timed runs"""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return {
+        "p50_ms": round(percentile(samples, 50), 3),
+        "p95_ms": round(percentile(samples, 95), 3),
+        "mean_ms": round(sum(samples) / len(samples), 3),
+    }
+
+
+def face_matrix(width, height, face_px, angle):
+    """Alignment matrix (target -> 128x128 crop) of a face_px-wide face centred in the image"""
+    import numpy as np
+
+    scale = 128 / face_px
+    rot = scale * np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    shift = np.array([64.0, 64.0]) - rot @ np.array([width / 2, height / 2])
+    return np.hstack([rot, shift[:, None]])
+
+
+def equivalence(reference, result):
+    import numpy as np
+
+    diff = np.abs(reference.astype(np.int16) - result.astype(np.int16))
+    mse = float(np.mean(diff.astype(np.float64) ** 2))
+    return {
+        "max_abs_diff": int(diff.max()),
+        "diff_pixels": round(float(diff.any(axis=2).mean()), 6),
+        "psnr_db": round(10 * np.log10(255 ** 2 / mse), 2) if mse else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="640,1280,1920,3840", help="Long edges of the 4:3 test images")
+    parser.add_argument("--faces", default="0.1,0.25,0.5", help="Face widths as a fraction of the image height")
+    parser.add_argument("--angle", type=float, default=0.2, help="Face roll in radians")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    import numpy as np
+    import face_swap
+
+    rng = np.random.default_rng(args.seed)
+    bgr_fake = rng.integers(0, 256, (128, 128, 3), dtype=np.uint8)
+    cases = []
+    print(f"{'size':>11}{'face':>6}  {'full p50':>10}{'roi p50':>10}{'speedup':>9}"
+          f"{'max diff':>10}{'diff px':>10}{'psnr':>8}")
+    for long_edge in (int(s) for s in args.sizes.split(",")):
+        width, height = long_edge, long_edge * 3 // 4
+        img = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        for fraction in (float(f) for f in args.faces.split(",")):
+            M = face_matrix(width, height, fraction * height, args.angle)
+            # paste_back writes in place, so each ROI run gets a fresh copy (timed as well, on both sides)
+            full = timeit(lambda: face_swap.paste_back_full(img.copy(), bgr_fake, M), args.repeat, args.warmup)
+            roi = timeit(lambda: face_swap.paste_back(img.copy(), bgr_fake, M), args.repeat, args.warmup)
+            check = equivalence(face_swap.paste_back_full(img, bgr_fake, M),
+                                face_swap.paste_back(img.copy(), bgr_fake, M))
+            speedup = full["p50_ms"] / roi["p50_ms"]
+            cases.append({
+                "size": [width, height], "face_fraction": fraction,
+                "full": full, "roi": roi, "speedup": round(speedup, 2), **check,
+            })
+            psnr = f"{check['psnr_db']:.1f}" if check["psnr_db"] is not None else "inf"
+            print(f"{f'{width}x{height}':>11}{fraction:>6.2f}  {full['p50_ms']:>10.2f}{roi['p50_ms']:>10.2f}"
+                  f"{speedup:>8.1f}x{check['max_abs_diff']:>10}{check['diff_pixels']:>10.4%}{psnr:>8}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"angle": args.angle, "repeat": args.repeat, "cases": cases}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
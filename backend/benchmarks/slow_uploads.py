@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Slow-client load test for /publish.
+
+Opens many concurrent connections that trickle a multipart upload at a
+low byte rate (like mobile clients on a bad network). Meanwhile it probes
+/health to see whether the server still answers. Compare:
+
+    SERVER_MODE=gunicorn (default)  vs  SERVER_MODE=asgi (uvicorn asgi:app)
+
+    python benchmarks/slow_uploads.py --url http://localhost:8000 \
+        --clients 2000 --size 200000 --rate 20000
+
+By default image2 is left out, so every upload is fully streamed and parsed
+but answered with 400 "Missing image1 or image2" instead of enqueueing a
+real job. Pass --enqueue to send both images.
+"""
+
+import time
+import uuid
+import asyncio
+import argparse
+from urllib.parse import urlparse
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    idx = min(int(round(pct / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[idx]
+
+
+def build_body(boundary, size, enqueue):
+    image = b"\xff\xd8\xff\xe0" + b"\0" * max(size - 4, 0)
+    parts = []
+    names = ["image1", "image2"] if enqueue else ["image1"]
+    for name in names:
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{name}.jpg"\r\n'
+            f"Content-Type: image/jpeg\r\n\r\n".encode() + image + b"\r\n"
+        )
+    parts.append(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="sessionId"\r\n\r\n{uuid.uuid4()}\r\n'.encode()
+    )
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts)
+
+
+async def read_status(reader):
+    line = await reader.readline()
+    parts = line.split()
+    return int(parts[1]) if len(parts) > 1 else 0
+
+
+async def slow_upload(host, port, args, results):
+    boundary = uuid.uuid4().hex
+    body = build_body(boundary, args.size, args.enqueue)
+    started = time.perf_counter()
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(
+            f"POST /publish HTTP/1.1\r\nHost: {host}\r\n"
+            f"Content-Type: multipart/form-data; boundary={boundary}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+        )
+        chunk = max(args.rate // 10, 1)
+        for offset in range(0, len(body), chunk):
+            writer.write(body[offset:offset + chunk])
+            await writer.drain()
+            await asyncio.sleep(0.1)
+        status = await asyncio.wait_for(read_status(reader), timeout=args.timeout)
+        writer.close()
+        results.append((status, time.perf_counter() - started))
+    except Exception as e:
+        results.append((type(e).__name__, time.perf_counter() - started))
+
+
+async def probe_health(host, port, stop, latencies, failures):
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=5)
+            writer.write(f"GET /health HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode())
+            await writer.drain()
+            await asyncio.wait_for(read_status(reader), timeout=5)
+            writer.close()
+            latencies.append((time.perf_counter() - started) * 1000)
+        except Exception:
+            failures.append(time.perf_counter())
+        await asyncio.sleep(0.5)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--size", type=int, default=200_000, help="Bytes per image")
+    parser.add_argument("--rate", type=int, default=20_000, help="Upload bytes/s per client")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--enqueue", action="store_true", help="Send both images (creates real jobs)")
+    args = parser.parse_args()
+
+    url = urlparse(args.url)
+    host, port = url.hostname, url.port or 80
+
+    results, health_latencies, health_failures = [], [], []
+    stop = asyncio.Event()
+    prober = asyncio.create_task(probe_health(host, port, stop, health_latencies, health_failures))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(slow_upload(host, port, args, results) for _ in range(args.clients)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await prober
+
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    durations = sorted(d for _, d in results)
+    health_latencies.sort()
+
+    print(f"clients={args.clients} size={args.size}B rate={args.rate}B/s elapsed={elapsed:.1f}s")
+    print(f"responses: {statuses}")
+    print(f"upload duration p50={percentile(durations, 50):.1f}s p99={percentile(durations, 99):.1f}s")
+    print(
+        f"/health during load: p50={percentile(health_latencies, 50):.1f}ms "
+        f"p99={percentile(health_latencies, 99):.1f}ms failures={len(health_failures)}"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the swap_faces hot path on CPU ONNX Runtime.
+
+Times each step for a matrix of image resolutions x face counts:
+image load, FaceAnalysis.get per buffalo_l module (and in total), the fast
+pipeline's analyze_faces, sort_faces / get_face, swapper.get with and
+without paste_back, and swap_face (swapper.get + ROI-limited paste_back). Test images are built by tiling one single-face photo
+N times on a canvas of each resolution, so runs are reproducible.
+
+Needs the worker requirements and models, e.g. inside the worker container
+(WORKER_DIR points at the worker code, default ../worker):
+
+    docker-compose run --rm -v "$PWD/benchmarks:/benchmarks" -e WORKER_DIR=/app worker \
+        python /benchmarks/swap_hot_path.py --face /benchmarks/face.jpg --json /benchmarks/before.json
+
+Then, after the change, compare against the earlier run:
+
+    ... --json /benchmarks/after.json --compare /benchmarks/before.json
+
+Worker env vars (DETECTION_PIPELINE, DET_SIZE_*, ORT_INTRA_OP_THREADS) apply as in the worker.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+
+WORKER_DIR = os.getenv("WORKER_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "worker"))
+sys.path.insert(0, WORKER_DIR)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    idx = min(int(round(pct / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[idx]
+
+
+def timeit(fn, repeat, warmup):
+    """Run fn warmup + repeat times; returns latency stats in ms over the timed runs"""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return {
+        "p50_ms": round(percentile(samples, 50), 3),
+        "p95_ms": round(percentile(samples, 95), 3),
+        "mean_ms": round(sum(samples) / len(samples), 3),
+        "min_ms": round(samples[0], 3),
+    }
+
+
+def tile_faces(face_img, faces, long_edge):
+    """A 4:3 canvas with `faces` copies of face_img on a grid"""
+    import cv2
+    import numpy as np
+
+    width, height = long_edge, long_edge * 3 // 4
+    cols = math.ceil(math.sqrt(faces))
+    rows = math.ceil(faces / cols)
+    cell_w, cell_h = width // cols, height // rows
+    scale = min(cell_w / face_img.shape[1], cell_h / face_img.shape[0])
+    tile = cv2.resize(face_img, (int(face_img.shape[1] * scale), int(face_img.shape[0] * scale)),
+                      interpolation=cv2.INTER_AREA)
+
+    canvas = np.full((height, width, 3), 128, dtype=np.uint8)
+    for n in range(faces):
+        y, x = (n // cols) * cell_h, (n % cols) * cell_w
+        canvas[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+    return canvas
+
+
+def metadata(args, app, swapper):
+    import cv2
+    import numpy
+    import onnxruntime
+    import insightface
+    import face_swap
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=WORKER_DIR, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "label": args.label,
+        "commit": commit,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "onnxruntime": onnxruntime.__version__,
+        "insightface": insightface.__version__,
+        "numpy": numpy.__version__,
+        "opencv": cv2.__version__,
+        "providers": swapper.session.get_providers(),
+        "swapper_model": args.model,
+        "modules": sorted(app.models),
+        "detection_pipeline": face_swap.DETECTION_PIPELINE,
+        "det_size_small": face_swap.DET_SIZE_SMALL,
+        "det_size_large": face_swap.DET_SIZE_LARGE,
+        "det_small_max_edge": face_swap.DET_SMALL_MAX_EDGE,
+        "ort_intra_op_threads": face_swap.ORT_INTRA_OP_THREADS,
+        "repeat": args.repeat,
+        "warmup": args.warmup,
+    }
+
+
+def bench_case(app, swapper, source_face, img, path, repeat, warmup):
+    """Every hot-path step for one test image; returns {op: stats}"""
+    from insightface.app.common import Face
+    import face_swap
+
+    ops = {}
+    ops["load_image"] = timeit(lambda: face_swap.load_image(path), repeat, warmup)
+
+    # FaceAnalysis.get, split into its detection call and each per-face module
+    bboxes, kpss = app.det_model.detect(img, max_num=0, metric='default')
+    ops["detection"] = timeit(lambda: app.det_model.detect(img, max_num=0, metric='default'), repeat, warmup)
+    faces = [Face(bbox=bboxes[i, 0:4], kps=kpss[i], det_score=bboxes[i, 4]) for i in range(bboxes.shape[0])]
+    for taskname, model in app.models.items():
+        if taskname == "detection" or not faces:
+            continue
+
+        def run_module(model=model):
+            for face in faces:
+                model.get(img, face)
+        ops[f"module:{taskname}"] = timeit(run_module, repeat, warmup)
+    ops["face_analysis_get"] = timeit(lambda: app.get(img), repeat, warmup)
+
+    # What the worker actually runs (DETECTION_PIPELINE), for source and destination images
+    ops["analyze_faces:source"] = timeit(lambda: face_swap.analyze_faces(app, img, with_embedding=True), repeat, warmup)
+    ops["analyze_faces:dest"] = timeit(lambda: face_swap.analyze_faces(app, img, with_embedding=False), repeat, warmup)
+
+    detected = app.get(img)
+    if detected:
+        ops["sort_faces"] = timeit(lambda: face_swap.sort_faces(detected), repeat, warmup)
+        ops["get_face"] = timeit(lambda: face_swap.get_face(detected, len(detected)), repeat, warmup)
+        target = face_swap.sort_faces(detected)[0]
+        ops["swapper_get:paste_back"] = timeit(
+            lambda: swapper.get(img, target, source_face, paste_back=True), repeat, warmup
+        )
+        ops["swapper_get:no_paste_back"] = timeit(
+            lambda: swapper.get(img, target, source_face, paste_back=False), repeat, warmup
+        )
+        ops["swap_face:roi_paste_back"] = timeit(
+            lambda: face_swap.swap_face(swapper, img.copy(), target, source_face), repeat, warmup
+        )
+    return len(detected), ops
+
+
+def compare(results, baseline_path):
+    """Print the p50 change of every (resolution, faces, op) present in both runs"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    before = {
+        (case["resolution"], case["faces"], op): stats["p50_ms"]
+        for case in baseline["cases"] for op, stats in case["ops"].items()
+    }
+    print(f"\np50 vs {baseline_path} ({baseline['meta'].get('label') or baseline['meta'].get('commit')})")
+    print(f"{'resolution':>10}{'faces':>6}  {'op':<28}{'before':>10}{'after':>10}{'change':>9}")
+    for case in results["cases"]:
+        for op, stats in case["ops"].items():
+            old = before.get((case["resolution"], case["faces"], op))
+            if not old:
+                continue
+            change = (stats["p50_ms"] - old) / old
+            print(f"{case['resolution']:>10}{case['faces']:>6}  {op:<28}{old:>10.2f}{stats['p50_ms']:>10.2f}{change:>+9.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--face", required=True, help="Photo with exactly one face (tiled into the test images)")
+    parser.add_argument("--model", default=os.path.join(WORKER_DIR, "inswapper_128.onnx"))
+    parser.add_argument("--resolutions", default="640,1280,1920,3840", help="Long edges of the 4:3 test images")
+    parser.add_argument("--faces", default="1,2,4,8", help="Face counts per test image")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--label", help="Free-form name for this run (e.g. 'ort 1.20')")
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument("--compare", help="Earlier --json output to print p50 changes against")
+    args = parser.parse_args()
+
+    import insightface
+    from insightface.app import FaceAnalysis
+    from PIL import Image
+    import face_swap
+
+    # Same session options as the worker, but always on CPU
+    face_swap.use_session_options()
+    providers = ["CPUExecutionProvider"]
+    app = FaceAnalysis(name="buffalo_l", providers=providers)
+    app.prepare(ctx_id=-1, det_size=(face_swap.DET_SIZE_LARGE, face_swap.DET_SIZE_LARGE))
+    swapper = insightface.model_zoo.get_model(args.model, download=False, download_zip=False, providers=providers)
+
+    face_img = face_swap.load_image(args.face)[:, :, :3]
+    source_faces = app.get(face_img)
+    if len(source_faces) != 1:
+        sys.exit(f"--face must contain exactly one face, found {len(source_faces)}")
+    source_face = source_faces[0]
+
+    results = {"meta": metadata(args, app, swapper), "cases": []}
+    print(f"{'resolution':>10}{'faces':>6}{'found':>6}  {'op':<28}{'p50':>10}{'p95':>10}{'mean':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for resolution in (int(r) for r in args.resolutions.split(",")):
+            for faces in (int(n) for n in args.faces.split(",")):
+                img = tile_faces(face_img, faces, resolution)
+                path = os.path.join(tmp, f"{resolution}_{faces}.jpg")
+                Image.fromarray(img).save(path, "JPEG", quality=90)
+
+                detected, ops = bench_case(app, swapper, source_face, img, path, args.repeat, args.warmup)
+                results["cases"].append({
+                    "resolution": resolution,
+                    "size": [img.shape[1], img.shape[0]],
+                    "faces": faces,
+                    "detected": detected,
+                    "ops": ops,
+                })
+                for op, stats in ops.items():
+                    print(f"{resolution:>10}{faces:>6}{detected:>6}  {op:<28}"
+                          f"{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['mean_ms']:>10.2f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
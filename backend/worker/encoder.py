@@ -0,0 +1,62 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from metrics import ENCODE_SECONDS
+from timings import JobTimings
+
+# Result encoding: format, quality and entropy coding, plus a preview thumbnail in the same pass
+RESULT_FORMAT = os.getenv("RESULT_FORMAT", "jpeg").lower()  # jpeg | webp
+RESULT_QUALITY = int(os.getenv("RESULT_QUALITY", 90))
+RESULT_PROGRESSIVE = os.getenv("RESULT_PROGRESSIVE", "true").lower() in ("1", "true", "yes")
+RESULT_OPTIMIZE = os.getenv("RESULT_OPTIMIZE", "true").lower() in ("1", "true", "yes")
+WEBP_METHOD = int(os.getenv("WEBP_METHOD", 4))  # 0 (fastest) .. 6 (smallest)
+THUMBNAIL_MAX_EDGE = int(os.getenv("THUMBNAIL_MAX_EDGE", 320))  # 0 disables the thumbnail
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", 75))
+ENCODE_WORKERS = int(os.getenv("ENCODE_WORKERS", 2))
+
+FORMATS = {"jpeg": ("JPEG", ".jpg"), "webp": ("WEBP", ".webp")}
+if RESULT_FORMAT not in FORMATS:
+    raise ValueError(f"RESULT_FORMAT must be one of {sorted(FORMATS)}, got {RESULT_FORMAT!r}")
+PIL_FORMAT, RESULT_EXT = FORMATS[RESULT_FORMAT]
+
+# PIL releases the GIL while encoding, so these threads run in parallel with inference
+encode_pool = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="encode")
+
+
+def save_options(quality):
+    if PIL_FORMAT == "JPEG":
+        return {"quality": quality, "progressive": RESULT_PROGRESSIVE, "optimize": RESULT_OPTIMIZE}
+    return {"quality": quality, "method": WEBP_METHOD}
+
+
+def thumbnail_path(result_path):
+    """Path of the preview thumbnail that goes with a result image"""
+    base, ext = os.path.splitext(result_path)
+    return f"{base}_thumb{ext}"
+
+
+def encode_result(result_image, result_path, timings=None):
+    """
+    Encode an RGB result array to result_path, plus its thumbnail from the same PIL image.
+    Returns the thumbnail path, or None when thumbnails are disabled.
+    """
+    with (timings or JobTimings()).stage("encode", ENCODE_SECONDS):
+        return _encode(result_image, result_path)
+
+
+def _encode(result_image, result_path):
+    img = Image.fromarray(result_image)
+    img.save(result_path, PIL_FORMAT, **save_options(RESULT_QUALITY))
+
+    if THUMBNAIL_MAX_EDGE <= 0:
+        return None
+    thumb = img.copy()
+    thumb.thumbnail((THUMBNAIL_MAX_EDGE, THUMBNAIL_MAX_EDGE), Image.BILINEAR, reducing_gap=2.0)
+    thumb_path = thumbnail_path(result_path)
+    thumb.save(thumb_path, PIL_FORMAT, **save_options(THUMBNAIL_QUALITY))
+    return thumb_path
+
+
+def encode_async(result_image, result_path, timings=None):
+    """Run encode_result on the encoder pool; returns a Future"""
+    return encode_pool.submit(encode_result, result_image, result_path, timings)
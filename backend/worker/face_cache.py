@@ -0,0 +1,172 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Setup environment
+FACE_CACHE_SIZE = int(os.getenv("FACE_CACHE_SIZE", 256))  # 0 disables the cache
+FACE_CACHE_REDIS = os.getenv("FACE_CACHE_REDIS", "false").lower() in ("1", "true", "yes")
+FACE_CACHE_TTL = int(os.getenv("FACE_CACHE_TTL", 3600))  # seconds, Redis entries only
+REDIS_URL = os.getenv("REDIS_URL")
+
+
+def image_digest(data):
+    """Content hash of raw image bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class SourceFaceCache:
+    """
+    LRU cache of detected source faces, one entry per image keyed by its content
+    hash: every face (sorted left to right) plus the image size. Entries live in
+    process memory and, optionally, in Redis with a TTL so several workers share them.
+    Keys also carry a namespace naming the models that produced the faces (set_namespace),
+    so workers with other models or precision never read each other's entries.
+    """
+
+    def __init__(self, max_size=FACE_CACHE_SIZE, redis_client=None, ttl=FACE_CACHE_TTL):
+        self.max_size = max_size
+        self.redis_client = redis_client
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.namespace = ""
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def make_key(self, digest):
+        if self.namespace:
+            return f"source_faces:{self.namespace}:{digest}"
+        return f"source_faces:{digest}"
+
+    def set_namespace(self, namespace):
+        """Key entries under the loaded models' signature; local entries made by other models are dropped"""
+        with self._lock:
+            if namespace != self.namespace:
+                self._entries.clear()
+            self.namespace = namespace
+
+    def get(self, digest):
+        """Return the cached (faces, (width, height)) of an image or None, updating hit/miss counters"""
+        if not self.enabled:
+            return None
+        key = self.make_key(digest)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        entry = self._get_remote(key)
+        with self._lock:
+            if entry is not None:
+                self.hits += 1
+                self._put_local(key, entry)
+            else:
+                self.misses += 1
+        return entry
+
+    def contains(self, digest):
+        """Check the in-process cache without touching counters or LRU order"""
+        if not self.enabled:
+            return False
+        with self._lock:
+            return self.make_key(digest) in self._entries
+
+    def put(self, digest, faces, size):
+        """Store an image's detected Faces and (width, height) locally and in Redis if configured"""
+        if not self.enabled:
+            return
+        key = self.make_key(digest)
+        entry = (faces, size)
+        with self._lock:
+            self._put_local(key, entry)
+        self._put_remote(key, entry)
+
+    def stats(self):
+        """Hit/miss counters for sizing the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "size": len(self._entries),
+                "maxSize": self.max_size,
+            }
+
+    def _put_local(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _get_remote(self, key):
+        if self.redis_client is None:
+            return None
+        try:
+            raw = self.redis_client.get(key)
+            return deserialize_entry(raw) if raw else None
+        except Exception as e:
+            print(f" Face cache Redis read failed: {e}")
+            return None
+
+    def _put_remote(self, key, entry):
+        if self.redis_client is None:
+            return
+        try:
+            self.redis_client.set(key, serialize_entry(*entry), ex=self.ttl)
+        except Exception as e:
+            print(f" Face cache Redis write failed: {e}")
+
+
+def serialize_entry(faces, size):
+    """Keep only what the swapper needs per face: bbox, kps, det_score and embedding"""
+    return json.dumps({
+        "size": list(size),
+        "faces": [{
+            "bbox": np.asarray(face.bbox).tolist(),
+            "kps": np.asarray(face.kps).tolist(),
+            "det_score": float(face.det_score) if face.get("det_score") is not None else None,
+            "embedding": np.asarray(face.embedding).tolist(),
+        } for face in faces],
+    })
+
+
+def deserialize_entry(raw):
+    # Imported here: stub mode (stub_swap.py) loads this module without the model stack
+    from insightface.app.common import Face
+
+    data = json.loads(raw)
+    faces = [
+        Face(
+            bbox=np.array(face["bbox"], dtype=np.float32),
+            kps=np.array(face["kps"], dtype=np.float32),
+            det_score=face["det_score"],
+            embedding=np.array(face["embedding"], dtype=np.float32),
+        )
+        for face in data["faces"]
+    ]
+    return faces, tuple(data["size"])
+
+
+def _make_cache():
+    redis_client = None
+    if FACE_CACHE_REDIS and REDIS_URL:
+        try:
+            import redis
+            redis_client = redis.from_url(REDIS_URL)
+        except Exception as e:
+            print(f" Face cache Redis unavailable, using memory only: {e}")
+    return SourceFaceCache(redis_client=redis_client)
+
+
+source_face_cache = _make_cache()
@@ -1,17 +1,304 @@
+import os
 import insightface
+import onnxruntime
 from insightface.app import FaceAnalysis
+from insightface.model_zoo import model_zoo
+from insightface.model_zoo.arcface_onnx import ArcFaceONNX
+from insightface.model_zoo.inswapper import INSwapper
+from insightface.app.common import Face
+from insightface.utils import face_align
 from PIL import Image
 import numpy as np
+import cv2
+import io
+import time
+import hashlib
+import platform
+from contextlib import closing
+from face_cache import source_face_cache, image_digest
+from metrics import DETECT_SECONDS, SWAP_SECONDS, VIDEO_FRAMES
+from timings import JobTimings
+from video_io import probe, read_frames, VideoWriter
 
 assert insightface.__version__ >= '0.7'
 
+# "fast" loads only detection + recognition and picks det_size per image; "full" runs every buffalo_l model
+DETECTION_PIPELINE = os.getenv("DETECTION_PIPELINE", "fast")
+DET_SIZE_SMALL = int(os.getenv("DET_SIZE_SMALL", 320))
+DET_SIZE_LARGE = int(os.getenv("DET_SIZE_LARGE", 640))
+DET_SMALL_MAX_EDGE = int(os.getenv("DET_SMALL_MAX_EDGE", 720))
+
+# Per-process ONNX Runtime threads (set by supervisor.py so processes x threads = cores); 0 lets ORT decide
+ORT_INTRA_OP_THREADS = int(os.getenv("ORT_INTRA_OP_THREADS", 0))
+ORT_INTER_OP_THREADS = int(os.getenv("ORT_INTER_OP_THREADS", 0))  # only used by the parallel execution mode
+
+# ONNX Runtime session options for every model (FaceAnalysis and swapper)
+ORT_GRAPH_OPT_LEVEL = os.getenv("ORT_GRAPH_OPT_LEVEL", "all").lower()  # disable | basic | extended | all
+ORT_EXECUTION_MODE = os.getenv("ORT_EXECUTION_MODE", "sequential").lower()  # sequential | parallel
+ORT_CPU_MEM_ARENA = os.getenv("ORT_CPU_MEM_ARENA", "true").lower() in ("1", "true", "yes")
+ORT_MEM_PATTERN = os.getenv("ORT_MEM_PATTERN", "true").lower() in ("1", "true", "yes")
+# -1 runs every model on CPUExecutionProvider only; >= 0 lets insightface use the GPU with that id if ORT has one
+ORT_CTX_ID = int(os.getenv("ORT_CTX_ID", 0))
+
+GRAPH_OPT_LEVELS = {
+    "disable": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+EXECUTION_MODES = {
+    "sequential": onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": onnxruntime.ExecutionMode.ORT_PARALLEL,
+}
+if ORT_GRAPH_OPT_LEVEL not in GRAPH_OPT_LEVELS:
+    raise ValueError(f"ORT_GRAPH_OPT_LEVEL must be one of {sorted(GRAPH_OPT_LEVELS)}, got {ORT_GRAPH_OPT_LEVEL!r}")
+if ORT_EXECUTION_MODE not in EXECUTION_MODES:
+    raise ValueError(f"ORT_EXECUTION_MODE must be one of {sorted(EXECUTION_MODES)}, got {ORT_EXECUTION_MODE!r}")
+
+# Video jobs: full detection on keyframes, optical-flow tracking of the target face in between
+VIDEO_KEYFRAME_INTERVAL = int(os.getenv("VIDEO_KEYFRAME_INTERVAL", 12))
+VIDEO_TRACK_MIN_CONFIDENCE = float(os.getenv("VIDEO_TRACK_MIN_CONFIDENCE", 0.8))  # below this, re-detect
+
+# "int8" swaps the swapper and recognizer for dynamic-quantized copies made by quantize_models.py.
+# They live in their own directory: FaceAnalysis loads every *.onnx in the buffalo_l folder.
+MODEL_PRECISION = os.getenv("MODEL_PRECISION", "fp32").lower()  # fp32 | int8
+INT8_MODEL_DIR = os.getenv("INT8_MODEL_DIR", "/app/models_int8")
+SWAPPER_MODEL_PATH = os.getenv("SWAPPER_MODEL_PATH", "inswapper_128.onnx")
+
+# Optimized ONNX graphs are saved here on first load and reused on later starts ("" disables the cache)
+ORT_CACHE_DIR = os.getenv("ORT_CACHE_DIR", "")
+
+# The only FaceAnalysis modules swapper.get needs: bbox/kps from detection, embedding from recognition
+FAST_MODULES = ['detection', 'recognition']
+
+class NoFaceError(Exception):
+    """No face was detected in one of the job's images"""
+
+class FaceIndexError(Exception):
+    """The requested face index does not exist in the image"""
+
+def session_options():
+    """ONNX Runtime session options shared by every model this worker loads"""
+    opts = onnxruntime.SessionOptions()
+    opts.graph_optimization_level = GRAPH_OPT_LEVELS[ORT_GRAPH_OPT_LEVEL]
+    opts.execution_mode = EXECUTION_MODES[ORT_EXECUTION_MODE]
+    opts.enable_cpu_mem_arena = ORT_CPU_MEM_ARENA
+    opts.enable_mem_pattern = ORT_MEM_PATTERN
+    if ORT_INTRA_OP_THREADS > 0:
+        opts.intra_op_num_threads = ORT_INTRA_OP_THREADS
+        opts.inter_op_num_threads = 1
+    if ORT_INTER_OP_THREADS > 0:
+        opts.inter_op_num_threads = ORT_INTER_OP_THREADS
+    return opts
+
+def provider_kwargs():
+    """Execution providers for insightface loaders; empty lets insightface pick (CUDA first, then CPU)"""
+    if ORT_CTX_ID < 0:
+        return {"providers": ['CPUExecutionProvider']}
+    return {}
+
+def int8_model_path(model_path):
+    """Where quantize_models.py puts the INT8 copy of a model"""
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(INT8_MODEL_DIR, f"{stem}.int8.onnx")
+
+_cpu_signature = None
+
+def cpu_signature():
+    """
+    CPU model and instruction-set flags from /proc/cpuinfo: ORT bakes kernels chosen for
+    the CPU's ISA (e.g. AVX-512 vs AVX2) into optimized graphs. platform.processor() elsewhere.
+    """
+    global _cpu_signature
+    if _cpu_signature is None:
+        fields = {}
+        try:
+            with open("/proc/cpuinfo") as f:
+                for line in f:
+                    name, _, value = line.partition(":")
+                    name = name.strip()
+                    # x86 reports "model name"/"flags", arm64 "CPU part"/"Features"
+                    if name in ("model name", "flags", "CPU part", "Features") and name not in fields:
+                        fields[name] = " ".join(sorted(value.split()))
+        except OSError:
+            pass
+        _cpu_signature = "|".join(f"{name}={fields[name]}" for name in sorted(fields)) or platform.processor()
+    return _cpu_signature
+
+def cached_model_path(model_path, session_providers):
+    """
+    Cache file for a model's optimized graph. Optimizations can be specific to the ORT
+    version, execution provider and CPU (architecture, model and instruction-set flags),
+    so all of them are part of the key; hosts sharing ORT_CACHE_DIR only reuse graphs
+    optimized on an identical CPU.
+    """
+    stat = os.stat(model_path)
+    key = "|".join([
+        os.path.abspath(model_path), str(stat.st_size), str(stat.st_mtime_ns),
+        onnxruntime.__version__, platform.machine(), cpu_signature(),
+        repr(session_providers or onnxruntime.get_available_providers()), ORT_GRAPH_OPT_LEVEL,
+    ])
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    os.makedirs(ORT_CACHE_DIR, exist_ok=True)
+    return os.path.join(ORT_CACHE_DIR, f"{name}.{hashlib.sha256(key.encode()).hexdigest()[:16]}.onnx")
+
+def use_session_options():
+    """Make insightface create every InferenceSession with session_options()"""
+    base = model_zoo.PickableInferenceSession
+    if getattr(base, "tuned", False):
+        return
+
+    class TunedInferenceSession(base):
+        tuned = True
+
+        def __init__(self, model_path, **kwargs):
+            if not ORT_CACHE_DIR or "sess_options" in kwargs:
+                kwargs.setdefault("sess_options", session_options())
+                super().__init__(model_path, **kwargs)
+                return
+
+            cached = cached_model_path(model_path, kwargs.get("providers"))
+            if os.path.exists(cached):
+                try:
+                    # Already optimized: skip graph optimization on load
+                    opts = session_options()
+                    opts.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+                    super().__init__(cached, sess_options=opts, **kwargs)
+                    self.model_path = model_path
+                    return
+                except Exception as e:
+                    print(f" Discarding unreadable optimized graph {cached}: {e}")
+                    os.remove(cached)
+
+            # Let ORT write the optimized graph while it builds the session, then publish it atomically
+            # (supervisor children may load the same model at the same time)
+            opts = session_options()
+            tmp_path = f"{cached}.{os.getpid()}.tmp"
+            opts.optimized_model_filepath = tmp_path
+            super().__init__(model_path, sess_options=opts, **kwargs)
+            try:
+                os.replace(tmp_path, cached)
+                print(f" Saved optimized graph for {os.path.basename(model_path)} to {cached}")
+            except OSError as e:
+                print(f" Could not cache optimized graph for {model_path}: {e}")
+
+    # get_model() has no sess_options argument, so swap the session class its ModelRouter builds
+    model_zoo.PickableInferenceSession = TunedInferenceSession
+
 def prepare_app():
     """Initialize face analysis app and swapper model"""
-    app = FaceAnalysis(name='buffalo_l')
-    app.prepare(ctx_id=0, det_size=(640, 640))
-    swapper = insightface.model_zoo.get_model('inswapper_128.onnx', download=False, download_zip=False)
+    use_session_options()
+    if DETECTION_PIPELINE == "full":
+        app = FaceAnalysis(name='buffalo_l', **provider_kwargs())
+    else:
+        app = FaceAnalysis(name='buffalo_l', allowed_modules=FAST_MODULES, **provider_kwargs())
+    app.prepare(ctx_id=ORT_CTX_ID, det_size=(DET_SIZE_LARGE, DET_SIZE_LARGE))
+
+    if MODEL_PRECISION == "int8":
+        recognizer = app.models['recognition']
+        app.models['recognition'] = load_int8(ArcFaceONNX, recognizer.model_file)
+        swapper = load_int8(INSwapper, SWAPPER_MODEL_PATH)
+    else:
+        swapper = insightface.model_zoo.get_model(
+            SWAPPER_MODEL_PATH, download=False, download_zip=False, **provider_kwargs()
+        )
+    source_face_cache.set_namespace(face_cache_namespace(app))
     return app, swapper
 
+def face_cache_namespace(app):
+    """
+    Source face cache namespace: cached faces and embeddings are only valid for the detector,
+    recognizer and precision that produced them (and the detector sizes), so all of them are
+    part of the key; workers sharing the Redis cache only reuse faces from identical models.
+    """
+    recognizer = app.models['recognition']
+    rec_file = int8_model_path(recognizer.model_file) if MODEL_PRECISION == "int8" else recognizer.model_file
+    key = "|".join([
+        MODEL_PRECISION, DETECTION_PIPELINE,
+        os.path.basename(app.det_model.model_file), str(os.path.getsize(app.det_model.model_file)),
+        os.path.basename(rec_file), str(os.path.getsize(rec_file)),
+        str(DET_SIZE_SMALL), str(DET_SIZE_LARGE), str(DET_SMALL_MAX_EDGE),
+    ])
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+def load_int8(model_class, model_path):
+    """
+    Wrap the INT8 session of a model in its insightface class. The class still reads the
+    fp32 file, for constants quantization may move (the swapper's emap, ArcFace input scaling).
+    """
+    quantized = int8_model_path(model_path)
+    if not os.path.exists(quantized):
+        raise FileNotFoundError(f"MODEL_PRECISION=int8 but {quantized} is missing; run quantize_models.py")
+    session_providers = provider_kwargs().get("providers", model_zoo.get_default_providers())
+    session = model_zoo.PickableInferenceSession(quantized, providers=session_providers)
+    model = model_class(model_file=model_path, session=session)
+    # ArcFaceONNX.prepare only pins CPU for ctx_id < 0; INSwapper has no prepare and keeps the session's providers
+    if hasattr(model, "prepare"):
+        model.prepare(ORT_CTX_ID)
+    print(f" Loaded INT8 {model_class.__name__} from {quantized}")
+    return model
+
+def warmup(app, swapper, batch_size=1):
+    """
+    Run every loaded model once on synthetic input, so ORT's lazy initialization
+    (memory arenas, kernel selection per input shape) happens before the first job
+    """
+    img = np.zeros((DET_SIZE_LARGE, DET_SIZE_LARGE, 3), dtype=np.uint8)
+    for size in sorted({DET_SIZE_SMALL, DET_SIZE_LARGE}):
+        app.det_model.detect(img, input_size=(size, size), max_num=0, metric='default')
+
+    for taskname, model in app.models.items():
+        if taskname == 'detection':
+            continue
+        width, height = model.input_size
+        blob = np.zeros((1, 3, height, width), dtype=np.float32)
+        model.session.run(None, {model.session.get_inputs()[0].name: blob})
+
+    limit = swapper_batch_limit(swapper)
+    for n in sorted({1, min(batch_size, limit) if limit else batch_size}):
+        width, height = swapper.input_size
+        swapper.session.run(swapper.output_names, {
+            swapper.input_names[0]: np.zeros((n, 3, height, width), dtype=np.float32),
+            swapper.input_names[1]: np.zeros((n, swapper.emap.shape[1]), dtype=np.float32),
+        })
+
+def pick_det_size(img, min_faces=1):
+    """Small detector input for small single-face images (phone crops), full size for larger photos or multi-face jobs"""
+    if min_faces <= 1 and max(img.shape[:2]) <= DET_SMALL_MAX_EDGE:
+        return (DET_SIZE_SMALL, DET_SIZE_SMALL)
+    return (DET_SIZE_LARGE, DET_SIZE_LARGE)
+
+def analyze_faces(app, img, with_embedding=True, min_faces=1):
+    """
+    Detect faces in an image.
+    In the fast pipeline only the detector runs (at an image-dependent det_size),
+    plus one batched recognition call when embeddings are needed (source faces).
+    min_faces is how many faces the job indexes into (largest face index / faceMap entry).
+    """
+    if DETECTION_PIPELINE == "full":
+        return app.get(img)
+
+    det_size = pick_det_size(img, min_faces)
+    bboxes, kpss = app.det_model.detect(img, input_size=det_size, max_num=0, metric='default')
+    if bboxes.shape[0] != 1 and det_size != (DET_SIZE_LARGE, DET_SIZE_LARGE):
+        # The small size only suits a single face: with none, or a group shot whose small faces
+        # it may have dropped (shifting every index after them), retry at full resolution
+        bboxes, kpss = app.det_model.detect(img, input_size=(DET_SIZE_LARGE, DET_SIZE_LARGE), max_num=0, metric='default')
+
+    faces = [
+        Face(bbox=bboxes[i, 0:4], kps=kpss[i] if kpss is not None else None, det_score=bboxes[i, 4])
+        for i in range(bboxes.shape[0])
+    ]
+
+    if with_embedding and faces:
+        rec_model = app.models['recognition']
+        aimgs = [face_align.norm_crop(img, landmark=face.kps, image_size=rec_model.input_size[0]) for face in faces]
+        embeddings = rec_model.get_feat(aimgs)
+        for face, embedding in zip(faces, embeddings):
+            face.embedding = embedding.flatten()
+
+    return faces
+
 def sort_faces(faces):
     """Sort faces by x-coordinate (left to right)"""
     return sorted(faces, key=lambda x: x.bbox[0])
@@ -19,10 +306,103 @@ def sort_faces(faces):
 def get_face(faces, face_id):
     """Get specific face by index (1-based)"""
     if len(faces) < face_id or face_id < 1:
-        raise Exception(f"The image includes only {len(faces)} faces, however, you asked for face {face_id}")
+        raise FaceIndexError(f"The image includes only {len(faces)} faces, however, you asked for face {face_id}")
     return faces[face_id-1]
 
-def swap_faces(app, swapper, source_img_path, dest_img_path, source_face_idx=1, dest_face_idx=1):
+def load_image(img_path):
+    """Load an image file as a numpy array"""
+    return np.array(Image.open(img_path))
+
+class SourceImage:
+    """Raw source image bytes and their content hash; decoded only when the face is not cached"""
+
+    def __init__(self, data):
+        self.data = data
+        self.digest = image_digest(data)
+        self._img = None
+
+    @property
+    def img(self):
+        if self._img is None:
+            self._img = np.array(Image.open(io.BytesIO(self.data)))
+        return self._img
+
+def image_size(img):
+    """(width, height) of a decoded image"""
+    return (img.shape[1], img.shape[0])
+
+def face_summary(faces, size):
+    """
+    1-based index and bbox of each (sorted) face, as reported in /status.
+    The bbox is [x1, y1, x2, y2] in fractions of the image width / height,
+    since the client's original may be larger than the normalized upload.
+    """
+    width, height = size
+    return [
+        {"index": idx, "bbox": [round(min(max(float(v) / scale, 0.0), 1.0), 4)
+                                for v, scale in zip(face.bbox, (width, height, width, height))]}
+        for idx, face in enumerate(faces, start=1)
+    ]
+
+def decode_images(source_img_path, dest_img_path, timings=None):
+    """
+    Read and decode both job images (the CPU-light stage before inference).
+    Returns (SourceImage, dest numpy array); the source is not decoded on a cache hit.
+    """
+    timings = timings or JobTimings()
+    with timings.stage("decode"):
+        with open(source_img_path, "rb") as f:
+            source = SourceImage(f.read())
+        if not source_face_cache.contains(source.digest):
+            source.img
+        return source, load_image(dest_img_path)
+
+def detect_source_faces(app, source, timings=None, detected=None, min_faces=1):
+    """
+    Return every source face, left to right, served from the source face cache
+    when the same image bytes were seen before (skips decode and inference).
+    detected, if given, receives their face_summary under "source".
+    A cached entry with fewer than min_faces faces is re-detected at full size.
+    """
+    timings = timings or JobTimings()
+    cached = source_face_cache.get(source.digest)
+    if cached is not None and len(cached[0]) >= min_faces:
+        timings.count("sourceCacheHit")
+        faces, size = cached
+    else:
+        # Get faces from source image
+        with timings.stage("sourceDetect", DETECT_SECONDS.labels("source")):
+            faces = sort_faces(analyze_faces(app, source.img, with_embedding=True, min_faces=min_faces))
+        size = image_size(source.img)
+        if faces:
+            source_face_cache.put(source.digest, faces, size)
+
+    if detected is not None:
+        detected["source"] = face_summary(faces, size)
+    if not faces:
+        raise NoFaceError("No faces found in source image")
+    return faces
+
+def detect_source_face(app, source, source_face_idx=1, timings=None, detected=None):
+    """Return the requested source face (see detect_source_faces)"""
+    return get_face(detect_source_faces(app, source, timings, detected, source_face_idx), source_face_idx)
+
+def detect_dest_faces(app, dest_img, timings=None, detected=None, min_faces=1):
+    """Detect every face in the destination image, left to right (see detect_source_faces for detected / min_faces)"""
+    timings = timings or JobTimings()
+    with timings.stage("destDetect", DETECT_SECONDS.labels("dest")):
+        res_faces = sort_faces(analyze_faces(app, dest_img, with_embedding=False, min_faces=min_faces))
+    if detected is not None:
+        detected["dest"] = face_summary(res_faces, image_size(dest_img))
+    if not res_faces:
+        raise NoFaceError("No faces found in destination image")
+    return res_faces
+
+def detect_dest_face(app, dest_img, dest_face_idx=1, timings=None, detected=None):
+    """Detect faces in the destination image and return the requested one"""
+    return get_face(detect_dest_faces(app, dest_img, timings, detected, dest_face_idx), dest_face_idx)
+
+def swap_faces(app, swapper, source_img_path, dest_img_path, source_face_idx=1, dest_face_idx=1, timings=None, detected=None):
     """
     Perform face swap between two images
     Args:
@@ -32,25 +412,405 @@ def swap_faces(app, swapper, source_img_path, dest_img_path, source_face_idx=1,
         dest_img_path: Path to destination image (face to replace)
         source_face_idx: Index of face in source image (1-based)
         dest_face_idx: Index of face in destination image (1-based)
+        timings: optional JobTimings that receives the per-stage durations
+        detected: optional dict that receives the face_summary of each image ("source", "dest")
     Returns:
         numpy array of result image
     """
-    # Load images
-    source_img = np.array(Image.open(source_img_path))
-    dest_img = np.array(Image.open(dest_img_path))
-    
-    # Get faces from source image
-    faces = sort_faces(app.get(source_img))
-    if not faces:
-        raise Exception("No faces found in source image")
-    source_face = get_face(faces, source_face_idx)
-    
+    source, dest_img = decode_images(source_img_path, dest_img_path, timings)
+    return swap_decoded(app, swapper, source, dest_img, source_face_idx, dest_face_idx, timings, detected)
+
+def swap_decoded(app, swapper, source, dest_img, source_face_idx=1, dest_face_idx=1, timings=None, detected=None):
+    """Face swap on images already loaded by decode_images"""
+    timings = timings or JobTimings()
+
+    # Get faces from source image (cached by content hash)
+    source_face = detect_source_face(app, source, source_face_idx, timings, detected)
+
     # Get faces from destination image
-    res_faces = sort_faces(app.get(dest_img))
-    if not res_faces:
-        raise Exception("No faces found in destination image")
-    res_face = get_face(res_faces, dest_face_idx)
-    
+    res_face = detect_dest_face(app, dest_img, dest_face_idx, timings, detected)
+
     # Perform face swap
-    result = swapper.get(dest_img, res_face, source_face, paste_back=True)
-    return result
\ No newline at end of file
+    with timings.stage("swap", SWAP_SECONDS):
+        result = swap_face(swapper, dest_img, res_face, source_face)
+    return result
+
+def swap_faces_mapped(app, swapper, source_img_path, dest_img_path, face_map, timings=None, detected=None):
+    """
+    Perform several face swaps between two images with one detection pass per image
+    Args:
+        face_map: list of (source_face_idx, dest_face_idx) pairs (1-based); each
+                  mapped destination face is replaced by its source face
+        timings: optional JobTimings that receives the per-stage durations
+        detected: optional dict that receives the face_summary of each image ("source", "dest")
+    Returns:
+        numpy array of the result image with every swap applied
+    """
+    timings = timings or JobTimings()
+    source, dest_img = decode_images(source_img_path, dest_img_path, timings)
+    # faceMap jobs index several faces; asking for that many detects at full size, so none are dropped
+    source_faces = detect_source_faces(app, source, timings, detected, max((idx for idx, _ in face_map), default=1))
+    res_faces = detect_dest_faces(app, dest_img, timings, detected, max((idx for _, idx in face_map), default=1))
+    # Resolve the whole mapping first, so a bad index fails the job before any inference
+    pairs = [(get_face(source_faces, source_idx), get_face(res_faces, dest_idx)) for source_idx, dest_idx in face_map]
+
+    # Each swap pastes into the previous one's output; landmarks come from the single detection pass
+    result = dest_img
+    with timings.stage("swap", SWAP_SECONDS):
+        for source_face, res_face in pairs:
+            result = swap_face(swapper, result, res_face, source_face)
+    return result
+
+def swap_faces_many(app, swapper, source_img_path, dest_img_paths, source_face_idx=1, dest_face_idx=1, timings=None):
+    """
+    Swap one source face onto several destination images, detecting the source once
+    Args:
+        dest_img_paths: destination images, in order
+        timings: optional JobTimings shared by every destination (stages accumulate)
+    Yields:
+        (index, numpy result image or the Exception that destination raised), as each swap finishes
+    Raises:
+        if the source image itself is unusable (no face, bad index), before yielding anything
+    """
+    timings = timings or JobTimings()
+    with timings.stage("decode"):
+        with open(source_img_path, "rb") as f:
+            source = SourceImage(f.read())
+    source_face = detect_source_face(app, source, source_face_idx, timings)
+
+    for index, dest_img_path in enumerate(dest_img_paths):
+        try:
+            with timings.stage("decode"):
+                dest_img = load_image(dest_img_path)
+            res_face = detect_dest_face(app, dest_img, dest_face_idx, timings)
+            with timings.stage("swap", SWAP_SECONDS):
+                result = swap_face(swapper, dest_img, res_face, source_face)
+        except Exception as e:
+            yield index, e
+            continue
+        yield index, result
+
+def swap_faces_batch(app, swapper, jobs, timings=None, detected=None):
+    """
+    Perform face swaps for several jobs with one batched swapper run
+    Args:
+        app: FaceAnalysis instance
+        swapper: Face swapper model
+        jobs: list of (source_img_path, dest_img_path, source_face_idx, dest_face_idx)
+        timings: optional list with one JobTimings per job
+        detected: optional list with one face summary dict per job (see swap_faces)
+    Returns:
+        list with, for each job, the numpy result image or the Exception it raised
+    """
+    timings = timings or [JobTimings() for _ in jobs]
+    decoded = []
+    for (source_img_path, dest_img_path, source_face_idx, dest_face_idx), job_timings in zip(jobs, timings):
+        try:
+            source, dest_img = decode_images(source_img_path, dest_img_path, job_timings)
+            decoded.append((source, dest_img, source_face_idx, dest_face_idx))
+        except Exception as e:
+            decoded.append(e)
+    return swap_decoded_batch(app, swapper, decoded, timings, detected)
+
+def swap_decoded_batch(app, swapper, items, timings=None, detected=None):
+    """
+    Batched counterpart of swap_decoded
+    Args:
+        items: list of (SourceImage, dest_img, source_face_idx, dest_face_idx), or an
+               Exception for items that already failed (passed through unchanged)
+        timings: optional list with one JobTimings per item
+        detected: optional list with one face summary dict per item
+    Returns:
+        list with, for each item, the numpy result image or the Exception it raised
+    """
+    timings = timings or [JobTimings() for _ in items]
+    detected = detected or [None] * len(items)
+    results = [None] * len(items)
+    pending = []
+
+    # Detection runs per image: the buffalo_l detector has a fixed batch size of 1
+    for i, item in enumerate(items):
+        if isinstance(item, Exception):
+            results[i] = item
+            continue
+        source, dest_img, source_face_idx, dest_face_idx = item
+        try:
+            source_face = detect_source_face(app, source, source_face_idx, timings[i], detected[i])
+            res_face = detect_dest_face(app, dest_img, dest_face_idx, timings[i], detected[i])
+            pending.append((i, dest_img, res_face, source_face))
+        except Exception as e:
+            results[i] = e
+
+    if not pending:
+        return results
+
+    started = time.perf_counter()
+    try:
+        fakes = swapper_forward_batch(
+            swapper,
+            [dest_img for _, dest_img, _, _ in pending],
+            [res_face for _, _, res_face, _ in pending],
+            [source_face for _, _, _, source_face in pending],
+        )
+    except Exception as e:
+        for i, _, _, _ in pending:
+            results[i] = e
+        return results
+
+    # Each job's swap time is its share of the batched forward pass plus its own paste-back
+    forward_share = (time.perf_counter() - started) / len(pending)
+    for (i, dest_img, _, _), (bgr_fake, _, M) in zip(pending, fakes):
+        paste_started = time.perf_counter()
+        try:
+            results[i] = paste_back(dest_img, bgr_fake, M)
+        except Exception as e:
+            results[i] = e
+        elapsed = forward_share + time.perf_counter() - paste_started
+        timings[i].add("swap", elapsed)
+        SWAP_SECONDS.observe(elapsed)
+
+    return results
+
+def swapper_batch_limit(swapper):
+    """Return the fixed batch size of the swapper model, or None if it is dynamic"""
+    dim = swapper.session.get_inputs()[0].shape[0]
+    if isinstance(dim, int) and dim > 0:
+        return dim
+    return None
+
+def swapper_forward_batch(swapper, dest_imgs, target_faces, source_faces):
+    """
+    Run inswapper inference for several (image, target face, source face) triples
+    Returns:
+        list of (bgr_fake, aligned_crop, affine_matrix) per triple, same as swapper.get(paste_back=False)
+    """
+    aimgs, Ms, latents = [], [], []
+    for img, target_face, source_face in zip(dest_imgs, target_faces, source_faces):
+        aimg, M = face_align.norm_crop2(img, target_face.kps, swapper.input_size[0])
+        aimgs.append(aimg)
+        Ms.append(M)
+
+        latent = source_face.normed_embedding.reshape((1, -1))
+        latent = np.dot(latent, swapper.emap)
+        latent /= np.linalg.norm(latent)
+        latents.append(latent)
+
+    blob = cv2.dnn.blobFromImages(
+        aimgs, 1.0 / swapper.input_std, swapper.input_size,
+        (swapper.input_mean, swapper.input_mean, swapper.input_mean), swapRB=True
+    )
+    latent = np.concatenate(latents, axis=0).astype(np.float32)
+
+    # Fall back to model-sized chunks if the exported graph has a fixed batch dimension
+    step = swapper_batch_limit(swapper) or len(aimgs)
+    preds = []
+    for start in range(0, len(aimgs), step):
+        preds.append(swapper.session.run(swapper.output_names, {
+            swapper.input_names[0]: blob[start:start + step],
+            swapper.input_names[1]: latent[start:start + step],
+        })[0])
+    pred = np.concatenate(preds, axis=0)
+
+    img_fake = pred.transpose((0, 2, 3, 1))
+    bgr_fakes = np.clip(255 * img_fake, 0, 255).astype(np.uint8)[:, :, :, ::-1]
+    return list(zip(bgr_fakes, aimgs, Ms))
+
+def swap_face(swapper, img, target_face, source_face):
+    """
+    swapper.get(img, target_face, source_face, paste_back=True), but pasting back with the
+    ROI-limited paste_back; img must be writable and receives the swapped face in place
+    Returns:
+        img
+    """
+    bgr_fake, M = swapper.get(img, target_face, source_face, paste_back=False)
+    return paste_back(img, bgr_fake, M)
+
+def mask_kernels(mask_size):
+    """Erode and blur kernel sizes insightface uses for a face mask of mask_size pixels"""
+    return max(mask_size // 10, 10), max(mask_size // 20, 5)
+
+def mask_extent(img_mask):
+    """insightface's mask size: geometric mean of the height and width of the mask's solid part"""
+    mask_h_inds, mask_w_inds = np.where(img_mask == 255)
+    mask_h = np.max(mask_h_inds) - np.min(mask_h_inds)
+    mask_w = np.max(mask_w_inds) - np.min(mask_w_inds)
+    return int(np.sqrt(mask_h * mask_w))
+
+def paste_back(target_img, bgr_fake, M):
+    """
+    Blend a swapped face back into the target image, in place, working only around the face
+    The warp, mask erosion/feathering and blend run on the face's footprint in the target
+    (the inverse affine image of the crop) padded by the erode and blur kernels, so the
+    cost follows the face size instead of the image size. Pixels outside that region are
+    exactly those the full-frame blend leaves unchanged; inside, the result matches
+    paste_back_full up to rounding (a level or two on a fraction of a percent of pixels,
+    from the warp's fixed-point coordinates).
+    Args:
+        target_img: writable uint8 image the face was aligned from
+        bgr_fake, M: swapper output and alignment matrix, as from swapper.get(paste_back=False)
+    Returns:
+        target_img
+    """
+    height, width = target_img.shape[:2]
+    crop_h, crop_w = bgr_fake.shape[:2]
+    IM = cv2.invertAffineTransform(M)
+
+    # Bilinear sampling lets the warped crop reach one pixel past its corners
+    corners = np.array([[-1, -1], [crop_w, -1], [-1, crop_h], [crop_w, crop_h]], dtype=np.float64)
+    footprint = corners @ IM[:, :2].T + IM[:, 2]
+    left, top = (int(v) for v in np.floor(footprint.min(axis=0)))
+    right, bottom = (int(v) + 1 for v in np.ceil(footprint.max(axis=0)))
+
+    # Kernels from the footprint are never smaller than those from the mask itself, so this
+    # padding holds the whole eroded and blurred mask with zeros left at the crop's edges
+    erode_k, blur_k = mask_kernels(int(np.sqrt((right - left) * (bottom - top))))
+    pad = erode_k // 2 + blur_k + 2
+    x0, y0 = max(left - pad, 0), max(top - pad, 0)
+    x1, y1 = min(right + pad, width), min(bottom + pad, height)
+
+    IM[:, 2] -= (x0, y0)
+    size = (x1 - x0, y1 - y0)
+    bgr_fake = cv2.warpAffine(bgr_fake, IM, size, borderValue=0.0)
+    img_mask = cv2.warpAffine(np.full((crop_h, crop_w), 255, dtype=np.float32), IM, size, borderValue=0.0)
+    img_mask[img_mask > 20] = 255
+
+    erode_k, blur_k = mask_kernels(mask_extent(img_mask))
+    img_mask = cv2.erode(img_mask, np.ones((erode_k, erode_k), np.uint8), iterations=1)
+    img_mask = cv2.GaussianBlur(img_mask, (2 * blur_k + 1, 2 * blur_k + 1), 0)
+
+    img_mask /= 255
+    img_mask = img_mask[:, :, np.newaxis]
+    roi = target_img[y0:y1, x0:x1]
+    roi[:] = (img_mask * bgr_fake + (1 - img_mask) * roi.astype(np.float32)).astype(np.uint8)
+    return target_img
+
+def paste_back_full(target_img, bgr_fake, M):
+    """
+    Full-frame blend, same output as swapper.get(paste_back=True); returns a new image
+    Reference for paste_back (see benchmarks/paste_back.py)
+    """
+    IM = cv2.invertAffineTransform(M)
+    size = (target_img.shape[1], target_img.shape[0])
+    img_white = np.full(bgr_fake.shape[:2], 255, dtype=np.float32)
+    bgr_fake = cv2.warpAffine(bgr_fake, IM, size, borderValue=0.0)
+    img_white = cv2.warpAffine(img_white, IM, size, borderValue=0.0)
+    img_white[img_white > 20] = 255
+
+    # Erode and feather the warped face mask (insightface also builds a diff mask it never uses)
+    img_mask = img_white
+    erode_k, blur_k = mask_kernels(mask_extent(img_mask))
+    img_mask = cv2.erode(img_mask, np.ones((erode_k, erode_k), np.uint8), iterations=1)
+    img_mask = cv2.GaussianBlur(img_mask, (2 * blur_k + 1, 2 * blur_k + 1), 0)
+
+    img_mask /= 255
+    img_mask = np.reshape(img_mask, [img_mask.shape[0], img_mask.shape[1], 1])
+    fake_merged = img_mask * bgr_fake + (1 - img_mask) * target_img.astype(np.float32)
+    return fake_merged.astype(np.uint8)
+
+def bbox_iou(a, b):
+    """Intersection over union of two [x1, y1, x2, y2] boxes"""
+    inter_w = max(min(a[2], b[2]) - max(a[0], b[0]), 0)
+    inter_h = max(min(a[3], b[3]) - max(a[1], b[1]), 0)
+    inter = inter_w * inter_h
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return float(inter / union) if union > 0 else 0.0
+
+def match_face(faces, face, min_iou=0.3):
+    """The detected face that overlaps a tracked one most, or None if none overlaps enough"""
+    best = max(faces, key=lambda candidate: bbox_iou(candidate.bbox, face.bbox), default=None)
+    if best is None or bbox_iou(best.bbox, face.bbox) < min_iou:
+        return None
+    return best
+
+def track_face(prev_gray, gray, face):
+    """
+    Move a face's 5 landmarks from one frame to the next with pyramidal Lucas-Kanade flow
+    Returns:
+        (tracked Face, confidence): confidence is the share of landmarks that track forward
+        and back again to within 5% of the face size
+    """
+    points = face.kps.reshape(-1, 1, 2).astype(np.float32)
+    face_size = float(max(face.bbox[2] - face.bbox[0], face.bbox[3] - face.bbox[1], 1.0))
+    win = int(np.clip(face_size / 4, 15, 61))
+    lk = dict(winSize=(win, win), maxLevel=3,
+              criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03))
+    moved, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, points, None, **lk)
+    back, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, prev_gray, moved, None, **lk)
+
+    fb_error = np.linalg.norm(points - back, axis=2).ravel()
+    good = (status.ravel() == 1) & (back_status.ravel() == 1) & (fb_error < 0.05 * face_size)
+    if not good.any():
+        return face, 0.0
+
+    kps = moved.reshape(-1, 2)
+    # Landmarks that lost track follow the mean motion of the ones that kept it, and so does the box
+    shift = (kps[good] - face.kps[good]).mean(axis=0)
+    kps[~good] = face.kps[~good] + shift
+    tracked = Face(bbox=(face.bbox + np.tile(shift, 2)).astype(np.float32), kps=kps.astype(np.float32),
+                   det_score=face.det_score)
+    return tracked, float(good.mean())
+
+def swap_video(app, swapper, source_img_path, video_path, result_base, source_face_idx=1, dest_face_idx=1,
+               timings=None, on_progress=None):
+    """
+    Swap the source face onto one tracked face through a video or animated GIF
+    Frames are decoded, swapped and encoded one at a time (video_io), so the clip is never
+    held in memory. The source face is detected once. Destination faces are detected on
+    keyframes (every VIDEO_KEYFRAME_INTERVAL frames) and whenever tracking confidence drops
+    below VIDEO_TRACK_MIN_CONFIDENCE; in between, the target's landmarks are tracked with
+    optical flow. The target is face dest_face_idx of the first frame that has it, then the
+    detected face overlapping it most. Frames without a target pass through unchanged.
+    Args:
+        result_base: result path without extension (MP4, or GIF for GIF input)
+        on_progress: optional callable(frames done, expected frames) after each frame
+    Returns:
+        (result path, first result frame for the poster thumbnail)
+    """
+    timings = timings or JobTimings()
+    clip = probe(video_path)
+    result_path = f"{result_base}{clip.ext}"
+
+    with timings.stage("decode"):
+        with open(source_img_path, "rb") as f:
+            source = SourceImage(f.read())
+    source_face = detect_source_face(app, source, source_face_idx, timings)
+
+    target, prev_gray, since_detect, poster = None, None, 0, None
+    # closing(): a failed frame must not leave the decoder process behind
+    with VideoWriter(clip, result_path) as writer, closing(read_frames(clip)) as frames:
+        while True:
+            with timings.stage("decode"):
+                frame = next(frames, None)
+            if frame is None:
+                break
+            gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+
+            confidence = 0.0
+            if target is not None and since_detect < VIDEO_KEYFRAME_INTERVAL:
+                with timings.stage("track"):
+                    target, confidence = track_face(prev_gray, gray, target)
+            if confidence < VIDEO_TRACK_MIN_CONFIDENCE:
+                with timings.stage("destDetect"):
+                    faces = sort_faces(analyze_faces(app, frame, with_embedding=False, min_faces=dest_face_idx))
+                matched = match_face(faces, target) if target is not None else None
+                target = matched or (faces[dest_face_idx - 1] if len(faces) >= dest_face_idx else None)
+                since_detect = 0
+                timings.count("videoKeyframes")
+                VIDEO_FRAMES.labels("detect" if target is not None else "none").inc()
+            else:
+                since_detect += 1
+                VIDEO_FRAMES.labels("track").inc()
+
+            if target is not None:
+                with timings.stage("swap"):
+                    frame = swap_face(swapper, frame, target, source_face)
+            with timings.stage("encode"):
+                writer.write(frame)
+            if poster is None:
+                poster = frame
+            prev_gray = gray
+            if on_progress is not None:
+                on_progress(writer.frames, clip.frames)
+
+    timings.count("videoFrames", writer.frames)
+    return result_path, poster
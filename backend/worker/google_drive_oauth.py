@@ -71,4 +71,5 @@ except Exception as e:
     print(f"❌ Failed to initialize: {e}")
     import traceback
     traceback.print_exc()
+    credentials = None
     drive_service = None
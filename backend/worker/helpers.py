@@ -1,19 +1,102 @@
 import os
+import json
+import mimetypes
 import shutil
 import time
-from google_drive_oauth import drive_service, GOOGLE_DRIVE_FOLDER_ID
+import threading
+import redis
+from metrics import FALLBACK_UPLOADS
+from google_drive_oauth import drive_service, credentials, GOOGLE_DRIVE_FOLDER_ID
+from googleapiclient.discovery import build
 from googleapiclient.http import MediaFileUpload
 from googleapiclient.errors import HttpError
 
-def upload_to_google_drive(file_path, jobId, max_retries=3):
-    """Upload result image to Google Drive with retry logic"""
+# Must match the API's status cache TTL
+STATUS_CACHE_TTL = int(os.getenv("STATUS_CACHE_TTL", 600))
+
+# Must match the API's session lock timeout (acquire_lock); long jobs extend it as they report progress
+SESSION_LOCK_TTL = int(os.getenv("SESSION_LOCK_TTL", 300))
+
+# Must match the API's admission control buckets (api/admission.py)
+THROUGHPUT_KEY_PREFIX = "jobs_done:"
+THROUGHPUT_BUCKET = 10
+THROUGHPUT_KEY_TTL = 80
+
+_thread_local = threading.local()
+_redis_client = None
+
+def get_redis():
+    """Shared Redis client (connection-pooled, safe across pipeline threads)"""
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.from_url(os.getenv("REDIS_URL"))
+    return _redis_client
+
+def get_drive_service():
+    """googleapiclient services are not thread-safe, so pipeline upload threads each get their own"""
+    if drive_service is None or threading.current_thread() is threading.main_thread():
+        return drive_service
+    if getattr(_thread_local, "drive_service", None) is None:
+        _thread_local.drive_service = build('drive', 'v3', credentials=credentials)
+    return _thread_local.drive_service
+
+def release_lock_and_publish(jobId, sessionId, payload):
+    """
+    Release the session lock, write the status through to the API's /status cache,
+    push it to /status/<jobId>/stream clients and count the job for the API's
+    throughput estimate, all in one Redis round-trip
+    """
+    try:
+        body = json.dumps(payload)
+        pipe = get_redis().pipeline(transaction=False)
+        if sessionId:
+            pipe.delete(f"session_lock:{sessionId}")
+        pipe.set(f"job_status_cache:{jobId}", body, ex=STATUS_CACHE_TTL)
+        pipe.publish(f"job_status:{jobId}", body)
+        # Finished-job counter the API uses to estimate queue wait
+        bucket_key = f"{THROUGHPUT_KEY_PREFIX}{int(time.time() // THROUGHPUT_BUCKET)}"
+        pipe.incr(bucket_key)
+        pipe.expire(bucket_key, THROUGHPUT_KEY_TTL)
+        pipe.execute()
+    except Exception as e:
+        print(f" Could not release lock / publish status for job {jobId}: {e}")
+
+def publish_progress(jobId, sessionId, payload):
+    """
+    Write a non-terminal status through to the /status cache and push it to stream clients,
+    pushing the session lock's expiry out again (long video and multi-target jobs)
+    """
+    try:
+        body = json.dumps(payload)
+        pipe = get_redis().pipeline(transaction=False)
+        if sessionId:
+            pipe.expire(f"session_lock:{sessionId}", SESSION_LOCK_TTL)
+        pipe.set(f"job_status_cache:{jobId}", body, ex=STATUS_CACHE_TTL)
+        pipe.publish(f"job_status:{jobId}", body)
+        pipe.execute()
+    except Exception as e:
+        print(f" Could not publish progress for job {jobId}: {e}")
+
+def upload_to_google_drive(file_path, jobId, max_retries=3, suffix="", timings=None):
+    """
+    Upload result image to Google Drive with retry logic (stored as <jobId><suffix><ext>).
+    Attempts and retries are counted on timings (a JobTimings) when given.
+    """
+    
+    service = get_drive_service()
+    name = f"{jobId}{suffix}{os.path.splitext(file_path)[1] or '.jpg'}"
+    mimetype = mimetypes.guess_type(name)[0] or 'image/jpeg'
     
     for attempt in range(max_retries):
+        if timings is not None:
+            timings.count("uploadAttempts")
+            if attempt > 0:
+                timings.count("uploadRetries")
         try:
             # Check if drive_service is initialized
-            if drive_service is None:
+            if service is None:
                 print("⚠️ Google Drive not initialized - using fallback")
-                return fallback_to_local(file_path, jobId)
+                return fallback_to_local(file_path, jobId, suffix)
             
             if not os.path.exists(file_path):
                 raise FileNotFoundError(f"Result file not found: {file_path}")
@@ -27,7 +110,7 @@ def upload_to_google_drive(file_path, jobId, max_retries=3):
             
             # Prepare file metadata
             file_metadata = {
-                'name': f'{jobId}.jpg',
+                'name': name,
                 'parents': [GOOGLE_DRIVE_FOLDER_ID],
                 'description': f'Face swap result for job {jobId}',
             }
@@ -35,12 +118,12 @@ def upload_to_google_drive(file_path, jobId, max_retries=3):
             # Upload file with chunked upload for large files
             media = MediaFileUpload(
                 file_path,
-                mimetype='image/jpeg',
+                mimetype=mimetype,
                 resumable=True,
             )
             
             
-            file = drive_service.files().create(
+            file = service.files().create(
                 body=file_metadata,
                 media_body=media,
                 fields='id, webViewLink, webContentLink, name'
@@ -54,7 +137,7 @@ def upload_to_google_drive(file_path, jobId, max_retries=3):
                 'type': 'anyone',
                 'role': 'reader'
             }
-            drive_service.permissions().create(
+            service.permissions().create(
                 fileId=file_id,
                 body=permission,
                 fields='id'
@@ -75,7 +158,7 @@ def upload_to_google_drive(file_path, jobId, max_retries=3):
                 continue
             else:
                 print("❌ Max retries reached, using fallback")
-                return fallback_to_local(file_path, jobId)
+                return fallback_to_local(file_path, jobId, suffix)
         
         except (ConnectionError, TimeoutError, OSError) as e:
             print(f"❌ Network error on attempt {attempt + 1}: {type(e).__name__}: {e}")
@@ -85,7 +168,7 @@ def upload_to_google_drive(file_path, jobId, max_retries=3):
                 time.sleep(wait_time)
                 continue
             else:
-                return fallback_to_local(file_path, jobId)
+                return fallback_to_local(file_path, jobId, suffix)
                 
         except HttpError as e:
             error_details = e.error_details if hasattr(e, 'error_details') else str(e)
@@ -98,29 +181,31 @@ def upload_to_google_drive(file_path, jobId, max_retries=3):
                 time.sleep(wait_time)
                 continue
             else:
-                return fallback_to_local(file_path, jobId)
+                return fallback_to_local(file_path, jobId, suffix)
                 
         except Exception as e:
             print(f"❌ Upload error: {type(e).__name__}: {e}")
             import traceback
             traceback.print_exc()
-            return fallback_to_local(file_path, jobId)
+            return fallback_to_local(file_path, jobId, suffix)
     
     # Should never reach here, but just in case
-    return fallback_to_local(file_path, jobId)
+    return fallback_to_local(file_path, jobId, suffix)
 
-def fallback_to_local(file_path, jobId):
+def fallback_to_local(file_path, jobId, suffix=""):
     """Fallback: Save to shared volume and return API URL"""
     print(f"⚠️ Falling back to local storage...")
+    FALLBACK_UPLOADS.inc()
     
     results_dir = "/tmp/results"
     os.makedirs(results_dir, exist_ok=True)
     
-    fallback_path = os.path.join(results_dir, f"{jobId}.jpg")
+    name = f"{jobId}{suffix}{os.path.splitext(file_path)[1] or '.jpg'}"
+    fallback_path = os.path.join(results_dir, name)
     shutil.copy2(file_path, fallback_path)
     
     # Return URL that API can serve
-    fallback_url = f"http://api:5000/results/{jobId}.jpg"
+    fallback_url = f"http://api:5000/results/{name}"
     
     return fallback_url
 
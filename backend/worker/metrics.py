@@ -0,0 +1,97 @@
+import os
+import glob
+import time
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# Prometheus listener port (0 disables); under supervisor.py, child N listens on METRICS_PORT + N
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+# Touched once the worker is warmed up and consuming, for container health checks ("" disables);
+# supervisor.py children use READY_FILE.<index>. Removed again at process start, so a file left
+# by a crash never reports a restarted worker ready before its warmup.
+READY_FILE = os.getenv("READY_FILE", "")
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUEUE_WAIT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+QUEUE_WAIT_SECONDS = Histogram(
+    "faceswap_queue_wait_seconds", "Time from enqueue in /publish to delivery to the worker",
+    buckets=QUEUE_WAIT_BUCKETS,
+)
+DETECT_SECONDS = Histogram(
+    "faceswap_detect_seconds", "Face detection time per image (source misses only; hits skip detection)",
+    ["image"], buckets=STAGE_BUCKETS,
+)
+SWAP_SECONDS = Histogram(
+    "faceswap_swap_seconds", "Swapper inference + paste-back per job (batch time split evenly across its jobs)",
+    buckets=STAGE_BUCKETS,
+)
+ENCODE_SECONDS = Histogram(
+    "faceswap_encode_seconds", "Result and thumbnail encode time per job",
+    buckets=STAGE_BUCKETS,
+)
+UPLOAD_SECONDS = Histogram(
+    "faceswap_upload_seconds", "Upload time per stored file (result or thumbnail)",
+    buckets=STAGE_BUCKETS,
+)
+VIDEO_FRAMES = Counter(
+    "faceswap_video_frames_total", "Video job frames, by how the target face was found (detect, track, none)",
+    ["target"],
+)
+JOBS_TOTAL = Counter("faceswap_jobs_total", "Jobs finished by this worker", ["status"])
+JOB_FAILURES = Counter("faceswap_job_failures_total", "Failed jobs by exception class", ["error_class"])
+FALLBACK_UPLOADS = Counter(
+    "faceswap_fallback_uploads_total", "Files stored on the local results volume because Google Drive was unavailable"
+)
+
+WORKER_READY = Gauge("faceswap_worker_ready", "1 once models are loaded and warmed up and the worker consumes jobs")
+STARTUP_SECONDS = Gauge("faceswap_worker_startup_seconds", "Time spent per startup stage (load, warmup)", ["stage"])
+
+
+def observe_queue_wait(job_data):
+    """
+    Record enqueue -> dequeue time from the publish timestamp the API puts in the message.
+    Returns it in seconds, or None for messages without one.
+    """
+    enqueued_at = job_data.get("enqueuedAt")
+    if not enqueued_at:
+        return None
+    waited = max(time.time() - float(enqueued_at), 0)
+    QUEUE_WAIT_SECONDS.observe(waited)
+    return waited
+
+
+def start_metrics_server():
+    if METRICS_PORT <= 0:
+        return
+    port = METRICS_PORT + int(os.getenv("WORKER_INDEX", 0))
+    start_http_server(port)
+    print(f" Metrics listening on :{port}/metrics")
+
+
+def ready_file_path():
+    index = os.getenv("WORKER_INDEX")
+    return f"{READY_FILE}.{index}" if index is not None else READY_FILE
+
+
+def clear_ready_files():
+    """Remove READY_FILE and every READY_FILE.<index> (stale files from an earlier run of the container)"""
+    if not READY_FILE:
+        return
+    for path in [READY_FILE] + glob.glob(f"{glob.escape(READY_FILE)}.*"):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def set_ready(ready):
+    """Report readiness through the gauge and READY_FILE"""
+    WORKER_READY.set(1 if ready else 0)
+    if not READY_FILE:
+        return
+    path = ready_file_path()
+    if ready:
+        with open(path, "w") as f:
+            f.write(str(os.getpid()))
+    elif os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,108 @@
+import queue
+import threading
+import traceback
+
+
+class PipelineJob:
+    """One queue message moving through the pipeline"""
+
+    def __init__(self, job_data, ack, nack):
+        self.job_data = job_data
+        self.ack = ack
+        self.nack = nack
+        self.result = None  # output of the last stage that ran
+        self.error = None  # first exception raised by a stage
+        self.state = {}  # free-form per-job values shared between stages
+
+
+class Stage:
+    """
+    A pipeline stage.
+    func(job) is called per job, or func(jobs) with up to batch_size jobs
+    that are already waiting when batch_size is set.
+    """
+
+    def __init__(self, name, func, workers=1, batch_size=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.batch_size = batch_size
+
+
+class StagedPipeline:
+    """
+    Runs jobs through stages connected by bounded queues, with dedicated
+    threads per stage, so decode of job N+1 and upload of job N-1 overlap
+    inference of job N.
+
+    A job that fails skips the remaining stages except the last one, which
+    must handle both outcomes. The job is acked once the last stage returns,
+    or nacked if the last stage raises.
+    """
+
+    def __init__(self, stages, queue_size=2):
+        self.stages = stages
+        # The first queue is unbounded: RabbitMQ prefetch already limits what can arrive
+        self.queues = [queue.Queue()] + [queue.Queue(maxsize=queue_size) for _ in stages[1:]]
+
+    def start(self):
+        for idx, stage in enumerate(self.stages):
+            for n in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._run_stage, args=(idx,), name=f"{stage.name}-{n}", daemon=True
+                )
+                thread.start()
+
+    def submit(self, job):
+        self.queues[0].put(job)
+
+    def _take(self, idx):
+        """Block for one job, then take whatever else is already queued up to the stage's batch size"""
+        stage = self.stages[idx]
+        jobs = [self.queues[idx].get()]
+        while stage.batch_size and len(jobs) < stage.batch_size:
+            try:
+                jobs.append(self.queues[idx].get_nowait())
+            except queue.Empty:
+                break
+        return jobs
+
+    def _run_stage(self, idx):
+        stage = self.stages[idx]
+        is_last = idx == len(self.stages) - 1
+
+        while True:
+            jobs = self._take(idx)
+
+            if is_last:
+                for job in jobs:
+                    self._finish(stage, job)
+                continue
+
+            active = [job for job in jobs if job.error is None]
+            if active:
+                if stage.batch_size:
+                    try:
+                        stage.func(active)
+                    except Exception as e:
+                        traceback.print_exc()
+                        for job in active:
+                            job.error = job.error or e
+                else:
+                    for job in active:
+                        try:
+                            stage.func(job)
+                        except Exception as e:
+                            job.error = e
+
+            for job in jobs:
+                self.queues[idx + 1].put(job)
+
+    def _finish(self, stage, job):
+        try:
+            stage.func(job)
+        except Exception:
+            traceback.print_exc()
+            job.nack()
+        else:
+            job.ack()
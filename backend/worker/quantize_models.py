@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Offline INT8 dynamic quantization of the swapper and the buffalo_l recognizer,
+for MODEL_PRECISION=int8.
+
+Writes <name>.int8.onnx files to INT8_MODEL_DIR (not the buffalo_l folder:
+FaceAnalysis loads every *.onnx it finds there):
+
+    python quantize_models.py
+
+With --images it also writes a quality / latency report comparing fp32 and
+int8 on CPU (run it on the node type that serves jobs):
+
+    python quantize_models.py --images faces/*.jpg --json int8_report.json
+
+Report contents:
+  recognizer: cosine similarity of fp32 vs int8 embeddings of every detected face
+  swapper:    PSNR of the int8 swapped face crop against the fp32 one, and the
+              identity similarity (source embedding vs embedding of the swapped
+              face) reached by each precision
+  latency:    p50 / p95 per inference for each model and precision
+"""
+
+import os
+import glob
+import json
+import time
+import argparse
+
+import numpy as np
+import onnxruntime
+from onnxruntime.quantization import QuantType, quantize_dynamic
+from insightface.app import FaceAnalysis
+from insightface.model_zoo import model_zoo
+from insightface.model_zoo.arcface_onnx import ArcFaceONNX
+from insightface.model_zoo.inswapper import INSwapper
+from insightface.utils import face_align
+
+import face_swap
+from face_swap import (
+    DET_SIZE_LARGE, FAST_MODULES, INT8_MODEL_DIR, SWAPPER_MODEL_PATH,
+    int8_model_path, load_image, sort_faces, use_session_options,
+)
+
+CPU = ['CPUExecutionProvider']
+WEIGHT_TYPES = {"quint8": QuantType.QUInt8, "qint8": QuantType.QInt8}
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    idx = min(int(round(pct / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[idx]
+
+
+def recognizer_path():
+    root = os.path.expanduser(os.getenv("INSIGHTFACE_ROOT", "~/.insightface"))
+    paths = glob.glob(os.path.join(root, "models", "buffalo_l", "w600k_*.onnx"))
+    if not paths:
+        raise FileNotFoundError(f"No buffalo_l recognizer under {root}; start the worker once to download it")
+    return paths[0]
+
+
+def quantize(model_path, args):
+    """Dynamic-quantize one model into INT8_MODEL_DIR; returns the output path"""
+    output = int8_model_path(model_path)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    source = model_path
+    if not args.skip_preprocess:
+        # Shape inference + graph cleanup first, as ORT recommends before quantizing
+        from onnxruntime.quantization.shape_inference import quant_pre_process
+        source = f"{output}.pre.onnx"
+        quant_pre_process(model_path, source)
+
+    started = time.perf_counter()
+    quantize_dynamic(
+        source, output,
+        op_types_to_quantize=args.op_types.split(",") if args.op_types else None,
+        per_channel=args.per_channel,
+        weight_type=WEIGHT_TYPES[args.weight_type],
+    )
+    if source != model_path:
+        os.remove(source)
+    size = os.path.getsize(model_path) / 1024 / 1024
+    int8_size = os.path.getsize(output) / 1024 / 1024
+    print(f" {os.path.basename(model_path)}: {size:.0f} MB -> {int8_size:.0f} MB in {time.perf_counter() - started:.0f}s ({output})")
+    return output
+
+
+def timed(fn, repeat):
+    fn()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return {"p50_ms": round(percentile(samples, 50), 2), "p95_ms": round(percentile(samples, 95), 2)}
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float32) - b.astype(np.float32)) ** 2)
+    return float("inf") if mse == 0 else float(10 * np.log10(255 ** 2 / mse))
+
+
+def cosine(a, b):
+    return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+
+def compare(images, rec_path, swapper_path, repeat):
+    """fp32 vs int8 quality and latency on CPU"""
+    use_session_options()
+    app = FaceAnalysis(name='buffalo_l', allowed_modules=FAST_MODULES, providers=CPU)
+    app.prepare(ctx_id=-1, det_size=(DET_SIZE_LARGE, DET_SIZE_LARGE))
+
+    recognizers = {
+        "fp32": app.models['recognition'],
+        "int8": ArcFaceONNX(model_file=rec_path, session=model_zoo.PickableInferenceSession(int8_model_path(rec_path), providers=CPU)),
+    }
+    swappers = {
+        "fp32": INSwapper(model_file=swapper_path, session=model_zoo.PickableInferenceSession(swapper_path, providers=CPU)),
+        "int8": INSwapper(model_file=swapper_path, session=model_zoo.PickableInferenceSession(int8_model_path(swapper_path), providers=CPU)),
+    }
+
+    decoded = [(path, load_image(path)[:, :, :3]) for path in images]
+    faces = [(path, img, sort_faces(app.get(img))) for path, img in decoded]
+    faces = [(path, img, found) for path, img, found in faces if found]
+    if not faces:
+        raise SystemExit("No faces found in --images")
+    _, source_img, source_faces = faces[0]
+    source = source_faces[0]
+
+    rec_similarity, swap_psnr = [], []
+    identity = {"fp32": [], "int8": []}
+    for _, img, found in faces:
+        for face in found:
+            crop = face_align.norm_crop(img, landmark=face.kps, image_size=112)
+            embeddings = {name: rec.get_feat(crop).flatten() for name, rec in recognizers.items()}
+            rec_similarity.append(cosine(embeddings["fp32"], embeddings["int8"]))
+
+            fakes = {name: swapper.get(img, face, source, paste_back=False)[0] for name, swapper in swappers.items()}
+            swap_psnr.append(psnr(fakes["fp32"], fakes["int8"]))
+            for name, swapper in swappers.items():
+                result = swapper.get(img, face, source, paste_back=True)
+                swapped = face_align.norm_crop(result, landmark=face.kps, image_size=112)
+                identity[name].append(cosine(recognizers["fp32"].get_feat(swapped).flatten(), source.embedding))
+
+    _, img, found = faces[0]
+    crop = face_align.norm_crop(img, landmark=found[0].kps, image_size=112)
+    latency = {}
+    for name in ("fp32", "int8"):
+        latency[f"recognizer_{name}"] = timed(lambda: recognizers[name].get_feat(crop), repeat)
+        latency[f"swapper_{name}"] = timed(lambda: swappers[name].get(img, found[0], source, paste_back=False), repeat)
+
+    return {
+        "onnxruntime": onnxruntime.__version__,
+        "ort_intra_op_threads": face_swap.ORT_INTRA_OP_THREADS,
+        "images": len(decoded),
+        "faces": len(rec_similarity),
+        "recognizer_cosine": {"mean": round(float(np.mean(rec_similarity)), 4), "min": round(min(rec_similarity), 4)},
+        "swap_psnr_db": {"mean": round(float(np.mean(swap_psnr)), 2), "min": round(min(swap_psnr), 2)},
+        "identity_similarity": {name: round(float(np.mean(values)), 4) for name, values in identity.items()},
+        "latency": latency,
+    }
+
+
+def print_report(report):
+    print(f"\n{report['faces']} faces in {report['images']} images, ORT {report['onnxruntime']}")
+    print(f"recognizer fp32 vs int8 cosine: mean {report['recognizer_cosine']['mean']}, min {report['recognizer_cosine']['min']}")
+    print(f"swapped crop PSNR int8 vs fp32: mean {report['swap_psnr_db']['mean']} dB, min {report['swap_psnr_db']['min']} dB")
+    print(f"identity similarity to source: fp32 {report['identity_similarity']['fp32']}, int8 {report['identity_similarity']['int8']}")
+    print(f"{'model':<18}{'p50 ms':>10}{'p95 ms':>10}")
+    for name, stats in report["latency"].items():
+        print(f"{name:<18}{stats['p50_ms']:>10}{stats['p95_ms']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--swapper", default=SWAPPER_MODEL_PATH)
+    parser.add_argument("--recognizer", help="Default: the buffalo_l w600k_*.onnx")
+    parser.add_argument("--op-types", help="Comma-separated op types to quantize (default: every type ORT supports)")
+    parser.add_argument("--weight-type", choices=sorted(WEIGHT_TYPES), default="quint8")
+    parser.add_argument("--per-channel", action="store_true")
+    parser.add_argument("--skip-preprocess", action="store_true")
+    parser.add_argument("--report-only", action="store_true", help="Reuse existing INT8 models in INT8_MODEL_DIR")
+    parser.add_argument("--images", nargs="*", help="Face photos for the fp32 vs int8 report")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--json", help="Write the report to this file")
+    args = parser.parse_args()
+
+    rec_path = args.recognizer or recognizer_path()
+    if not args.report_only:
+        print(f" Quantizing into {INT8_MODEL_DIR}")
+        for model_path in (args.swapper, rec_path):
+            quantize(model_path, args)
+
+    if args.images:
+        report = compare(args.images, rec_path, args.swapper, args.repeat)
+        report["quantization"] = {"weight_type": args.weight_type, "per_channel": args.per_channel, "op_types": args.op_types}
+        print_report(report)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
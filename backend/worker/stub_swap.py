@@ -0,0 +1,115 @@
+import os
+import time
+import random
+import numpy as np
+from PIL import Image
+from metrics import SWAP_SECONDS
+from timings import JobTimings
+from video_io import probe, read_frames, VideoWriter
+
+# Stand-in for face_swap.py when SWAPPER_MODE=stub: same functions, no models or GPU.
+# Each "swap" sleeps STUB_SWAP_MS (+ up to STUB_SWAP_JITTER_MS) and returns the destination image,
+# so load tests exercise queueing, encode, upload and status reporting at a chosen service time.
+STUB_SWAP_MS = float(os.getenv("STUB_SWAP_MS", 200))
+STUB_SWAP_JITTER_MS = float(os.getenv("STUB_SWAP_JITTER_MS", 0))
+STUB_FAILURE_RATE = float(os.getenv("STUB_FAILURE_RATE", 0))  # fraction of jobs failing with NoFaceError
+STUB_FRAME_MS = float(os.getenv("STUB_FRAME_MS", 20))  # per video frame
+
+class NoFaceError(Exception):
+    """No face was detected in one of the job's images (raised at STUB_FAILURE_RATE)"""
+
+def prepare_app():
+    """Nothing to load"""
+    print(f" Stub swapper: {STUB_SWAP_MS:.0f} ms (+{STUB_SWAP_JITTER_MS:.0f} ms jitter) per job, "
+          f"failure rate {STUB_FAILURE_RATE:.0%}")
+    return None, None
+
+def warmup(app, swapper, batch_size=1):
+    """No models to warm up"""
+
+def load_image(img_path):
+    """Load an image file as a numpy array"""
+    return np.array(Image.open(img_path))
+
+def decode_images(source_img_path, dest_img_path, timings=None):
+    """Decode the destination image like the real decode stage; the source is never used"""
+    timings = timings or JobTimings()
+    with timings.stage("decode"):
+        return None, load_image(dest_img_path)
+
+def stub_swap(dest_img, timings):
+    with timings.stage("swap", SWAP_SECONDS):
+        time.sleep((STUB_SWAP_MS + random.uniform(0, STUB_SWAP_JITTER_MS)) / 1000)
+        if STUB_FAILURE_RATE and random.random() < STUB_FAILURE_RATE:
+            raise NoFaceError("No faces found in destination image (stub)")
+    return dest_img
+
+def swap_faces(app, swapper, source_img_path, dest_img_path, source_face_idx=1, dest_face_idx=1, timings=None, detected=None):
+    """Sleep for the stub service time and return the destination image (no faces reported)"""
+    timings = timings or JobTimings()
+    _, dest_img = decode_images(source_img_path, dest_img_path, timings)
+    return stub_swap(dest_img, timings)
+
+def swap_faces_mapped(app, swapper, source_img_path, dest_img_path, face_map, timings=None, detected=None):
+    """One stub service time per mapped pair, on a single decoded destination"""
+    timings = timings or JobTimings()
+    _, dest_img = decode_images(source_img_path, dest_img_path, timings)
+    for _ in face_map:
+        dest_img = stub_swap(dest_img, timings)
+    return dest_img
+
+def swap_faces_many(app, swapper, source_img_path, dest_img_paths, source_face_idx=1, dest_face_idx=1, timings=None):
+    """Stub swap onto each destination; yields (index, result image or Exception)"""
+    timings = timings or JobTimings()
+    for index, dest_img_path in enumerate(dest_img_paths):
+        try:
+            _, dest_img = decode_images(source_img_path, dest_img_path, timings)
+            result = stub_swap(dest_img, timings)
+        except Exception as e:
+            yield index, e
+            continue
+        yield index, result
+
+def swap_video(app, swapper, source_img_path, video_path, result_base, source_face_idx=1, dest_face_idx=1,
+               timings=None, on_progress=None):
+    """Re-encode the clip unchanged, sleeping STUB_FRAME_MS per frame; same return value as the real one"""
+    timings = timings or JobTimings()
+    clip = probe(video_path)
+    result_path = f"{result_base}{clip.ext}"
+    poster = None
+    with VideoWriter(clip, result_path) as writer:
+        for frame in read_frames(clip):
+            with timings.stage("swap"):
+                time.sleep(STUB_FRAME_MS / 1000)
+            writer.write(frame)
+            if poster is None:
+                poster = frame
+            if on_progress is not None:
+                on_progress(writer.frames, clip.frames)
+    return result_path, poster
+
+def swap_faces_batch(app, swapper, jobs, timings=None, detected=None):
+    """Batched counterpart of swap_faces; returns a result image or Exception per job"""
+    timings = timings or [JobTimings() for _ in jobs]
+    decoded = []
+    for (source_img_path, dest_img_path, source_face_idx, dest_face_idx), job_timings in zip(jobs, timings):
+        try:
+            source, dest_img = decode_images(source_img_path, dest_img_path, job_timings)
+            decoded.append((source, dest_img, source_face_idx, dest_face_idx))
+        except Exception as e:
+            decoded.append(e)
+    return swap_decoded_batch(app, swapper, decoded, timings)
+
+def swap_decoded_batch(app, swapper, items, timings=None, detected=None):
+    """Stub swap for each decoded item; Exceptions pass through unchanged"""
+    timings = timings or [JobTimings() for _ in items]
+    results = []
+    for item, job_timings in zip(items, timings):
+        if isinstance(item, Exception):
+            results.append(item)
+            continue
+        try:
+            results.append(stub_swap(item[1], job_timings))
+        except Exception as e:
+            results.append(e)
+    return results
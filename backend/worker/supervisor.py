@@ -0,0 +1,135 @@
+import os
+import sys
+import glob
+import time
+import signal
+import multiprocessing
+
+# Setup environment
+WORKER_PROCESSES = max(int(os.getenv("WORKER_PROCESSES", 1)), 1)
+INSIGHTFACE_ROOT = os.path.expanduser(os.getenv("INSIGHTFACE_ROOT", "~/.insightface"))
+SWAPPER_MODEL_PATH = os.getenv("SWAPPER_MODEL_PATH", "inswapper_128.onnx")
+MODEL_PRECISION = os.getenv("MODEL_PRECISION", "fp32").lower()
+INT8_MODEL_DIR = os.getenv("INT8_MODEL_DIR", "/app/models_int8")
+SWAPPER_MODE = os.getenv("SWAPPER_MODE", "model")
+RESTART_BACKOFF_MAX = 30  # seconds
+HEALTHY_RUNTIME = 60  # a child that ran this long before exiting resets its backoff
+
+
+def available_cores():
+    """CPU cores this container may use (respects cpusets / taskset)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def read_model_files():
+    """
+    Read every model file once before forking so the bytes sit in the shared
+    page cache and each child's session load is a memory copy, not disk I/O.
+    """
+    paths = glob.glob(os.path.join(INSIGHTFACE_ROOT, "models", "buffalo_l", "*.onnx"))
+    paths.append(SWAPPER_MODEL_PATH)
+    if MODEL_PRECISION == "int8":
+        paths += glob.glob(os.path.join(INT8_MODEL_DIR, "*.int8.onnx"))
+
+    total = 0
+    for path in paths:
+        if not os.path.exists(path):
+            print(f" Model file not found (skipping read-ahead): {path}")
+            continue
+        with open(path, "rb") as f:
+            while chunk := f.read(16 * 1024 * 1024):
+                total += len(chunk)
+    print(f" Read {total / 1024 / 1024:.0f} MB of model files into page cache")
+
+
+def run_child(index, threads):
+    """Child process: pin ORT threads, then load models and consume like a single worker"""
+    os.environ["ORT_INTRA_OP_THREADS"] = str(threads)
+    os.environ["WORKER_INDEX"] = str(index)  # per-child metrics port
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    print(f" Worker process {index} (pid {os.getpid()}) starting with {threads} ORT threads")
+
+    # Imported here so models, Mongo and RabbitMQ connections are created per process, after fork
+    import app
+    app.main()
+    sys.exit(1)  # main() only returns if the consumer stopped
+
+
+def main():
+    """Fork WORKER_PROCESSES consumers and restart any that crash"""
+    cores = available_cores()
+    threads = max(cores // WORKER_PROCESSES, 1)
+    print(f" Supervisor: {WORKER_PROCESSES} processes x {threads} threads on {cores} cores")
+
+    if SWAPPER_MODE != "stub":
+        read_model_files()
+
+    # The health check needs every child's ready file; drop any left over from the previous run
+    from metrics import clear_ready_files
+    clear_ready_files()
+
+    # Import the heavy libraries once so their pages are shared copy-on-write by every child;
+    # no ONNX Runtime session exists yet, so forking is safe. Stub mode loads none of them.
+    if SWAPPER_MODE != "stub":
+        import numpy, cv2, onnxruntime, insightface  # noqa: F401
+
+    ctx = multiprocessing.get_context("fork")
+    children = {}
+    started_at = {}
+    failures = {}
+    restart_at = {}  # index -> monotonic time its crashed child may be started again
+    stopping = False
+
+    def start(index):
+        proc = ctx.Process(target=run_child, args=(index, threads), name=f"worker-{index}")
+        proc.start()
+        children[index] = proc
+        started_at[index] = time.monotonic()
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        print("\n🛑 Supervisor stopping workers")
+        for proc in children.values():
+            if proc.is_alive():
+                proc.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for index in range(WORKER_PROCESSES):
+        start(index)
+
+    # Backoff is a per-child deadline, so one crash-looping child never delays reaping or restarting the others
+    while not stopping:
+        time.sleep(1)
+        now = time.monotonic()
+        for index, proc in list(children.items()):
+            if stopping:
+                break
+            if index in restart_at:
+                if now >= restart_at[index]:
+                    del restart_at[index]
+                    start(index)
+                continue
+            if proc.is_alive():
+                continue
+
+            proc.join()  # reap
+            if now - started_at[index] >= HEALTHY_RUNTIME:
+                failures[index] = 0
+            failures[index] = failures.get(index, 0) + 1
+            backoff = min(2 ** (failures[index] - 1), RESTART_BACKOFF_MAX)
+            print(f"❌ Worker process {index} exited with code {proc.exitcode}, restarting in {backoff}s")
+            restart_at[index] = now + backoff
+
+    for proc in children.values():
+        proc.join(timeout=30)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import time
+import threading
+from contextlib import contextmanager
+
+
+class JobTimings:
+    """
+    Per-job stage durations (monotonic clock) and counters, stored on the job
+    document as the `timings` sub-document: {"<stage>Ms": float, "<counter>": int}.
+    A stage can also feed the matching Prometheus histogram. Safe to share between
+    threads (a multi-target job encodes and uploads while it swaps the next target).
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, histogram=None):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.add(name, elapsed)
+            if histogram is not None:
+                histogram.observe(elapsed)
+
+    def add(self, name, seconds):
+        """Add to a stage (stages that run more than once, e.g. two uploads, accumulate)"""
+        with self._lock:
+            self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def document(self):
+        """The timings sub-document, including workerMs (dequeue to now)"""
+        with self._lock:
+            doc = {f"{name}Ms": round(seconds * 1000, 1) for name, seconds in self.durations.items()}
+            doc.update(self.counters)
+        doc["workerMs"] = round((time.perf_counter() - self.started) * 1000, 1)
+        return doc
@@ -0,0 +1,197 @@
+import os
+import json
+import tempfile
+import subprocess
+import numpy as np
+from PIL import Image
+from encoder import THUMBNAIL_MAX_EDGE, THUMBNAIL_QUALITY
+
+# Video jobs: clips are decoded and encoded by ffmpeg through pipes, one raw RGB frame at a time
+FFMPEG_BIN = os.getenv("FFMPEG_BIN", "ffmpeg")
+FFPROBE_BIN = os.getenv("FFPROBE_BIN", "ffprobe")
+VIDEO_MAX_EDGE = int(os.getenv("VIDEO_MAX_EDGE", 1280))  # frames are downscaled to this longest edge
+VIDEO_MAX_FPS = float(os.getenv("VIDEO_MAX_FPS", 30))  # higher frame rates are resampled down
+VIDEO_MAX_FRAMES = int(os.getenv("VIDEO_MAX_FRAMES", 900))  # longer clips fail before any work
+VIDEO_CRF = int(os.getenv("VIDEO_CRF", 23))  # x264 quality of MP4 results
+VIDEO_PRESET = os.getenv("VIDEO_PRESET", "veryfast")
+
+# One palette per frame keeps GIF output streaming (a global palette needs the whole clip first)
+GIF_FILTER = "split[a][b];[a]palettegen=stats_mode=single[p];[b][p]paletteuse=new=1"
+
+
+class VideoError(Exception):
+    """Unusable clip (no video stream, too long, ffmpeg failure); the message is shown to the user"""
+
+
+class Clip:
+    """What a clip decodes to: output size, frame rate, expected frame count and result format"""
+
+    def __init__(self, path, width, height, fps, frames, has_audio, is_gif):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.frames = frames
+        self.has_audio = has_audio
+        self.is_gif = is_gif
+
+    @property
+    def ext(self):
+        """Result extension: animated GIFs stay GIFs, everything else becomes MP4"""
+        return ".gif" if self.is_gif else ".mp4"
+
+
+def parse_rate(rate):
+    """ffprobe frame rate ("30000/1001") as a float, or 0.0"""
+    try:
+        num, _, den = (rate or "").partition("/")
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+
+def even(value):
+    """yuv420p needs even dimensions"""
+    return max(int(value) // 2 * 2, 2)
+
+
+def probe(path):
+    """Read a clip's stream info with ffprobe and work out how it will be decoded"""
+    try:
+        out = subprocess.run(
+            [FFPROBE_BIN, "-v", "error", "-print_format", "json", "-show_streams", "-show_format", path],
+            capture_output=True, check=True, timeout=30
+        ).stdout
+        info = json.loads(out)
+    except (subprocess.SubprocessError, ValueError) as e:
+        raise VideoError(f"Video could not be read: {e}")
+
+    streams = info.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), None)
+    if video is None:
+        raise VideoError("Video has no video stream")
+
+    width, height = int(video["width"]), int(video["height"])
+    # ffmpeg applies rotation metadata while decoding, so phone clips come out upright
+    rotation = int(float(video.get("tags", {}).get("rotate", 0)))
+    for side_data in video.get("side_data_list", []):
+        rotation = int(side_data.get("rotation", rotation))
+    if rotation % 180:
+        width, height = height, width
+
+    scale = min(1.0, VIDEO_MAX_EDGE / max(width, height))
+    source_fps = parse_rate(video.get("avg_frame_rate")) or parse_rate(video.get("r_frame_rate")) or 25.0
+    fps = round(min(source_fps, VIDEO_MAX_FPS), 3)
+    duration = float(video.get("duration") or info.get("format", {}).get("duration") or 0)
+    nb_frames = int(video.get("nb_frames") or 0)
+    frames = nb_frames if nb_frames and fps == round(source_fps, 3) else round(duration * fps)
+    if frames > VIDEO_MAX_FRAMES:
+        raise VideoError(f"Video is too long: {frames} frames at {fps:g} fps (max {VIDEO_MAX_FRAMES})")
+
+    return Clip(
+        path, even(width * scale), even(height * scale), fps, max(frames, 1),
+        has_audio=any(s.get("codec_type") == "audio" for s in streams),
+        is_gif="gif" in info.get("format", {}).get("format_name", ""),
+    )
+
+
+def ffmpeg_error(proc, log):
+    log.seek(0)
+    message = log.read().decode("utf-8", "replace").strip().splitlines()
+    return VideoError(f"Video processing failed (ffmpeg exit {proc.returncode}): {message[-1] if message else ''}")
+
+
+def read_frames(clip):
+    """
+    Yield the clip's frames one at a time as writable RGB arrays, at clip.fps and
+    clip.width x clip.height. Never more than one frame is held here; at most
+    VIDEO_MAX_FRAMES are yielded.
+    """
+    cmd = [
+        FFMPEG_BIN, "-v", "error", "-nostdin", "-i", clip.path,
+        "-vf", f"fps={clip.fps},scale={clip.width}:{clip.height}",
+        "-f", "rawvideo", "-pix_fmt", "rgb24", "pipe:1",
+    ]
+    frame_bytes = clip.width * clip.height * 3
+    # ffmpeg's log goes to a file: a full stderr pipe would stall the decoder
+    with tempfile.TemporaryFile() as log:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=log)
+        try:
+            for _ in range(VIDEO_MAX_FRAMES):
+                # A fresh buffer per frame: swaps paste into it in place, and the poster keeps one
+                data = bytearray(frame_bytes)
+                if proc.stdout.readinto(data) < frame_bytes:
+                    break
+                yield np.frombuffer(data, dtype=np.uint8).reshape(clip.height, clip.width, 3)
+        finally:
+            proc.stdout.close()
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+        if proc.returncode not in (0, -9):
+            raise ffmpeg_error(proc, log)
+
+
+class VideoWriter:
+    """
+    Encode RGB frames as they are written: MP4 (H.264, with the source clip's audio)
+    or GIF, per clip.ext. Use as a context manager; the file is complete after exit.
+    """
+
+    def __init__(self, clip, output_path):
+        cmd = [
+            FFMPEG_BIN, "-v", "error", "-y",
+            "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{clip.width}x{clip.height}", "-r", f"{clip.fps}",
+            "-i", "pipe:0",
+        ]
+        if clip.is_gif:
+            cmd += ["-filter_complex", GIF_FILTER, "-loop", "0"]
+        else:
+            if clip.has_audio:
+                cmd += ["-i", clip.path, "-map", "0:v", "-map", "1:a:0", "-c:a", "aac", "-shortest"]
+            cmd += [
+                "-c:v", "libx264", "-preset", VIDEO_PRESET, "-crf", str(VIDEO_CRF),
+                "-pix_fmt", "yuv420p", "-movflags", "+faststart",
+            ]
+        cmd.append(output_path)
+        self.frames = 0
+        self._log = tempfile.TemporaryFile()
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=self._log)
+
+    def write(self, frame):
+        try:
+            self._proc.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+        except BrokenPipeError:
+            self._proc.wait()
+            raise ffmpeg_error(self._proc, self._log)
+        self.frames += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is not None:
+                self._proc.kill()
+                self._proc.wait()
+                return False
+            try:
+                self._proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            if self._proc.wait() != 0:
+                raise ffmpeg_error(self._proc, self._log)
+            if self.frames == 0:
+                raise VideoError("Video has no frames")
+        finally:
+            self._log.close()
+
+
+def save_poster(frame, path):
+    """JPEG preview of one result frame (the video's thumbnail); returns path, or None when thumbnails are off"""
+    if THUMBNAIL_MAX_EDGE <= 0:
+        return None
+    img = Image.fromarray(frame)
+    img.thumbnail((THUMBNAIL_MAX_EDGE, THUMBNAIL_MAX_EDGE), Image.BILINEAR, reducing_gap=2.0)
+    img.save(path, "JPEG", quality=THUMBNAIL_QUALITY)
+    return path